@@ -0,0 +1,128 @@
+"""对比频道记忆拼装：旧版每个成员读一次整个记忆库 + 一次 users.info，新版用记忆索引 + 批量解析名字。
+
+用法: python benchmarks/bench_channel_memories.py [每次请求的模拟延迟毫秒，默认 5]
+存储和 Slack 接口都换成内存假实现，每次"请求"按给定延迟 sleep；
+输出不同频道人数下的请求次数和耗时（冷 = 进程刚启动，热 = 索引和名字缓存都已就绪）。
+"""
+import os
+import sys
+import time
+
+# import 时不启动定时任务、用户缓存预热等后台线程，免得它们拿真实存储和 Slack 去跑
+os.environ["BACKGROUND_TASKS"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+LATENCY = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.005
+
+
+class CountingStorage:
+    """load_doc/load_key 各算一次请求（相当于 JSONBin 的一次 GET）"""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.requests = 0
+
+    def _request(self):
+        self.requests += 1
+        time.sleep(LATENCY)
+
+    def load_doc(self, doc):
+        self._request()
+        return dict(self.docs.get(doc, {}))
+
+    def load_key(self, doc, key, default=None):
+        self._request()
+        return self.docs.get(doc, {}).get(key, default)
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+class FakeSlack:
+    """users.info / users.list 的假实现，每次调用算一次请求"""
+
+    def __init__(self, user_ids):
+        self.users = [{"id": u, "name": u.lower(), "real_name": f"成员{u[1:]}"} for u in user_ids]
+        self.requests = 0
+
+    def http_get(self, family, url, **kw):
+        self.requests += 1
+        time.sleep(LATENCY)
+        params = kw.get("params", {})
+        if url.endswith("users.info"):
+            user = next(u for u in self.users if u["id"] == params["user"])
+            return FakeResponse({"ok": True, "user": user})
+        if url.endswith("users.list"):
+            start = int(params.get("cursor") or 0)
+            page = self.users[start:start + params["limit"]]
+            nxt = start + params["limit"]
+            return FakeResponse({"ok": True, "members": page,
+                                 "response_metadata": {"next_cursor": str(nxt) if nxt < len(self.users) else ""}})
+        raise ValueError(url)
+
+
+def legacy_get_all_memories_for_channel(channel):
+    """改造前的实现：每个成员读一次整个记忆库，每个有记忆的成员一次 users.info"""
+    parts = []
+    for member_id in main.get_channel_members(channel):
+        memories = main.load_all_memories().get(member_id, [])
+        mem = "\n".join(f"• {m['content']}" for m in memories)
+        if mem:
+            result = main.http_get("slack", "https://slack.com/api/users.info", params={"user": member_id}).json()
+            name = result["user"]["real_name"] or result["user"]["name"] if result.get("ok") else member_id
+            parts.append(f"【{name}的记忆】\n{mem}")
+    return "\n\n".join(parts)
+
+
+def reset_caches():
+    main.invalidate_memory_block()
+    with main._user_cache_lock:
+        main._user_cache.clear()
+
+
+def measure(fn, channel, store, slack):
+    store.requests = slack.requests = 0
+    start = time.perf_counter()
+    text = fn(channel)
+    return text, store.requests + slack.requests, (time.perf_counter() - start) * 1000
+
+
+def run():
+    originals = (main.storage, main.http_get)
+    print(f"模拟请求延迟 {LATENCY * 1000:.0f} ms")
+    print(f"{'members':>8}{'legacy req':>12}{'legacy ms':>11}{'cold req':>10}{'cold ms':>9}"
+          f"{'warm req':>10}{'warm ms':>9}")
+    try:
+        for size in [5, 10, 20, 40, 80]:
+            channel = f"CBENCH{size}"
+            members = [f"U{i:04d}" for i in range(size)]
+            # 大约一半成员有记忆，另外库里还有其他频道的用户
+            memories = {u: [{"content": f"{u} 的记忆 {j}", "time": ""} for j in range(3)]
+                        for u in members[::2] + [f"X{i:04d}" for i in range(200)]}
+            store = CountingStorage({"memories": memories})
+            slack = FakeSlack(members)
+            main.storage, main.http_get = store, slack.http_get
+            with main._channel_index_lock:
+                main._channel_index[channel] = {"id": channel, "name": channel.lower(),
+                                                "is_member": True, "members": members,
+                                                "members_at": time.time()}
+
+            old, old_req, old_ms = measure(legacy_get_all_memories_for_channel, channel, store, slack)
+            reset_caches()
+            cold, cold_req, cold_ms = measure(main.get_all_memories_for_channel, channel, store, slack)
+            warm, warm_req, warm_ms = measure(main.get_all_memories_for_channel, channel, store, slack)
+            assert old == cold == warm, size
+            print(f"{size:>8}{old_req:>12}{old_ms:>11.1f}{cold_req:>10}{cold_ms:>9.1f}{warm_req:>10}{warm_ms:>9.1f}")
+    finally:
+        main.storage, main.http_get = originals
+        reset_caches()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,136 @@
+"""对比单次扫描的 parse_hidden_commands 和旧版多次 findall 实现。
+
+用法: python benchmarks/bench_hidden_commands.py
+存储换成内存计数器，不会访问 JSONBin；输出每种回复大小下的平均耗时和存储读写次数。
+带定时/每日命令的回复两种实现都要落库并重算这个用户的任务堆，这部分耗时相同，
+差距主要在不带命令（不再读写）和命令很多（一次扫描、记忆合并写）的情况。
+"""
+import os
+import re
+import sys
+import time
+
+# import 时不启动定时任务、用户缓存预热等后台线程，免得它们拿真实存储和 Slack 去跑
+os.environ["BACKGROUND_TASKS"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+
+class CountingStorage:
+    def __init__(self):
+        self.docs = {}
+        self.reads = 0
+        self.writes = 0
+
+    def load_doc(self, doc):
+        self.reads += 1
+        return dict(self.docs.get(doc, {}))
+
+    def save_doc(self, doc, data):
+        self.writes += 1
+        self.docs[doc] = dict(data)
+
+    def load_key(self, doc, key, default=None):
+        self.reads += 1
+        return self.docs.get(doc, {}).get(key, default)
+
+    def save_key(self, doc, key, value):
+        self.writes += 1
+        self.docs.setdefault(doc, {})[key] = value
+
+
+def legacy_parse_hidden_commands(reply, user_id, current_channel=None):
+    """改造前的实现（每种命令一次 findall + replace，无论有没有命令都读写 schedules）"""
+    schedules = {user_id: main.load_user_schedules(user_id)}
+    has_hidden = False
+    original_reply = reply
+    extra_actions = []
+    for date_str, time_str, hint in re.findall(r'\[\[定时\|(\d{4}-\d{2}-\d{2})\|(\d{1,2}:\d{2})\|(.+?)\]\]', reply):
+        h, m = time_str.split(":")
+        schedules[user_id]["timed"].append({"date": date_str, "time": f"{int(h):02d}:{m}", "hint": hint})
+        reply = reply.replace(f"[[定时|{date_str}|{time_str}|{hint}]]", "")
+        has_hidden = True
+    for time_str, hint in re.findall(r'\[\[定时\|(\d{1,2}:\d{2})\|([^\]]+?)\]\]', reply):
+        h, m = time_str.split(":")
+        schedules[user_id]["timed"].append({
+            "date": main.get_cn_time().strftime("%Y-%m-%d"), "time": f"{int(h):02d}:{m}", "hint": hint
+        })
+        reply = reply.replace(f"[[定时|{time_str}|{hint}]]", "")
+        has_hidden = True
+    for time_str, topic in re.findall(r'\[\[每日\|(\d{1,2}:\d{2})\|(.+?)\]\]', reply):
+        h, m = time_str.split(":")
+        schedules[user_id]["daily"].append({"time": f"{int(h):02d}:{m}", "topic": topic})
+        reply = reply.replace(f"[[每日|{time_str}|{topic}]]", "")
+        has_hidden = True
+    for mem_uid, content in re.findall(r'\[\[记忆\|([A-Z0-9]+)\|(.+?)\]\]', reply):
+        main.add_memory(mem_uid, content)
+        reply = reply.replace(f"[[记忆|{mem_uid}|{content}]]", "")
+        has_hidden = True
+    for content in re.findall(r'\[\[记忆\|([^|]+?)\]\]', reply):
+        if not re.match(r'^[A-Z0-9]+$', content):
+            main.add_memory(user_id, content)
+            reply = reply.replace(f"[[记忆|{content}]]", "")
+            has_hidden = True
+    for date, desc in re.findall(r'\[\[特殊日期\|(\d{2}-\d{2})\|(.+?)\]\]', reply):
+        schedules[user_id]["special_dates"][date] = desc
+        reply = reply.replace(f"[[特殊日期|{date}|{desc}]]", "")
+        has_hidden = True
+    for msg in re.findall(r'\[\[私聊\|(.+?)\]\]', reply):
+        extra_actions.append({"type": "dm", "content": msg})
+        reply = reply.replace(f"[[私聊|{msg}]]", "")
+        has_hidden = True
+    for ch, msg in re.findall(r'\[\[发到频道\|(\w+)\|(.+?)\]\]', reply):
+        extra_actions.append({"type": "to_channel", "channel_name": ch, "content": msg})
+        reply = reply.replace(f"[[发到频道|{ch}|{msg}]]", "")
+        has_hidden = True
+    for emoji in re.findall(r'\[\[反应\|(\w+)\]\]', reply):
+        extra_actions.append({"type": "reaction", "emoji": emoji.lower()})
+        reply = reply.replace(f"[[反应|{emoji}]]", "")
+        has_hidden = True
+    main.save_user_schedules(user_id, schedules[user_id])
+    return re.sub(r'\n{3,}', '\n\n', reply).strip(), has_hidden, original_reply, extra_actions
+
+
+COMMANDS = ["[[反应|heart]]", "[[私聊|悄悄话]]", "[[每日|8:00|早安]]", "[[记忆|喜欢猫]]",
+            "[[发到频道|chat|大家好]]", "[[特殊日期|05-20|纪念日]]"]
+
+
+def make_reply(paragraphs, commands):
+    body = "\n".join("今天天气不错，我们聊聊最近在忙的事情吧。" * 3 for _ in range(paragraphs))
+    return body + "".join(COMMANDS[i % len(COMMANDS)] for i in range(commands))
+
+
+def bench(fn, reply, rounds):
+    """每轮都从空存储、空任务堆开始，否则 schedules 和任务堆一轮轮变长，后跑的实现吃亏"""
+    store = CountingStorage()
+    main.storage = store
+    elapsed = 0.0
+    for _ in range(rounds):
+        store.docs = {}
+        with main._sched_cond:
+            main._sched_heap.clear()
+        start = time.perf_counter()
+        result = fn(reply, "U000BENCH", "C000BENCH")
+        elapsed += time.perf_counter() - start
+    return result, elapsed / rounds * 1e6, store.reads / rounds, store.writes / rounds
+
+
+def run():
+    cases = [("在~", "在~"), ("短回复", make_reply(1, 0)), ("短回复+1命令", make_reply(1, 1)),
+             ("中等+6命令", make_reply(10, 6)), ("长回复+30命令", make_reply(100, 30))]
+    original_storage = main.storage
+    print(f"{'case':<14}{'chars':>8}{'legacy us':>12}{'new us':>10}{'legacy r/w':>12}{'new r/w':>10}")
+    try:
+        for name, reply in cases:
+            rounds = 200
+            old, old_us, old_r, old_w = bench(legacy_parse_hidden_commands, reply, rounds)
+            new, new_us, new_r, new_w = bench(main.parse_hidden_commands, reply, rounds)
+            assert old[0] == new[0] and old[1] == new[1], name
+            print(f"{name:<14}{len(reply):>8}{old_us:>12.1f}{new_us:>10.1f}"
+                  f"{f'{old_r:.0f}/{old_w:.0f}':>12}{f'{new_r:.0f}/{new_w:.0f}':>10}")
+    finally:
+        main.storage = original_storage
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,151 @@
+"""检查多轮对话里 prompt 前缀是不是逐轮原样保留，估算服务商前缀缓存能命中多少。
+
+用法: python benchmarks/bench_prompt_prefix.py [轮数，默认 8]
+注册一个本地假 API "stub"（不发网络请求），把 main.http_post 换成转发到它的版本；
+按私聊的真实拼法（system + 历史 + 带 [系统信息] 的本轮消息）跑若干轮，
+假 API 按前缀哈希模拟缓存：断点处写入，从断点往前回溯找命中（和服务商的规则一样），
+另外检查上一次请求里 [系统信息] 之前的部分是不是原样出现在这次的开头。
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+# import 时不启动定时任务、用户缓存预热等后台线程；存储换成临时 SQLite，不会访问 JSONBin
+os.environ["BACKGROUND_TASKS"] = "0"
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+TURNS = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+STUB_URL = "https://stub.local/v1/chat/completions"
+STUB_REPLY = "好的~"
+STUB_SEEN_MAX = 10000
+STUB_LOOKBACK = 20  # 断点往前找已有缓存的范围（按消息数近似服务商按块回溯的规则）
+
+
+class StubResponse:
+    status_code = 200
+    headers = {"Content-Type": "application/json"}
+
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+def prefix_hashes(messages):
+    """逐条累积的哈希：第 i 个值代表 messages[:i+1]。cache_control 不算内容，单个文本块和字符串等价"""
+    h, hashes = hashlib.sha256(), []
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, list):
+            content = [{k: v for k, v in part.items() if k != "cache_control"} for part in content]
+            if len(content) == 1 and content[0].get("type") == "text":
+                content = content[0]["text"]
+        h.update(json.dumps([m.get("role"), content], ensure_ascii=False, sort_keys=True).encode("utf-8"))
+        hashes.append(h.hexdigest())
+    return hashes
+
+
+def message_text(content):
+    if isinstance(content, list):
+        return next((part.get("text", "") for part in content if part.get("type") == "text"), "")
+    return content or ""
+
+
+class StubProvider:
+    def __init__(self):
+        self.seen = OrderedDict()  # 见过的前缀哈希（按 LRU 保留最近的）
+        self.last = {}  # {第一条历史消息的哈希: 上一次请求里 [系统信息] 之前那段的前缀哈希列表}
+        self.stats = {"requests": 0, "extends_previous": 0, "prefix_breaks": 0, "cached_tokens": 0, "prompt_tokens": 0}
+        self.lock = threading.Lock()
+
+    def complete(self, payload):
+        messages = payload.get("messages", [])
+        hashes = prefix_hashes(messages)
+        conversation = prefix_hashes(messages[1:2])[0] if len(messages) > 1 else None
+        first_turn = next((i for i, m in enumerate(messages) if m.get("role") == "user" and
+                           message_text(m.get("content")).startswith("[系统信息]")), len(messages))
+        tokens = [main.estimate_tokens(json.dumps(m.get("content"), ensure_ascii=False)) + main.TOKEN_MSG_OVERHEAD
+                  for m in messages]
+        breakpoints = [i for i, m in enumerate(messages)
+                       if isinstance(m.get("content"), list) and any("cache_control" in p for p in m["content"])]
+        with self.lock:
+            hit = max((j for i in breakpoints for j in range(max(0, i - STUB_LOOKBACK), i + 1) if hashes[j] in self.seen),
+                      default=-1)
+            cached = sum(tokens[:hit + 1])
+            stable = self.last.get(conversation)
+            if stable:
+                if len(stable) <= len(hashes) and hashes[len(stable) - 1] == stable[-1]:
+                    self.stats["extends_previous"] += 1
+                else:
+                    diverged = next((i for i, (a, b) in enumerate(zip(stable, hashes)) if a != b),
+                                    min(len(stable), len(hashes)))
+                    self.stats["prefix_breaks"] += 1
+                    print(f"  前缀变了：上一次请求 [系统信息] 之前有 {len(stable)} 条，这次从第 {diverged} 条开始不同")
+            if conversation and first_turn:
+                self.last[conversation] = hashes[:first_turn]
+            for i in breakpoints:
+                self.seen[hashes[i]] = None
+                self.seen.move_to_end(hashes[i])
+            while len(self.seen) > STUB_SEEN_MAX:
+                self.seen.popitem(last=False)
+            self.stats["requests"] += 1
+            self.stats["cached_tokens"] += cached
+            self.stats["prompt_tokens"] += sum(tokens)
+        return StubResponse({
+            "choices": [{"message": {"role": "assistant", "content": STUB_REPLY}}],
+            "usage": {"prompt_tokens": sum(tokens), "completion_tokens": main.estimate_tokens(STUB_REPLY),
+                      "prompt_tokens_details": {"cached_tokens": cached}},
+        }), len(messages), breakpoints, hit, cached, sum(tokens)
+
+
+def run():
+    stub = StubProvider()
+    last = {}
+    original_post = main.http_post
+
+    def http_post(family, url, **kwargs):
+        if url != STUB_URL:
+            return original_post(family, url, **kwargs)
+        resp, *last["turn"] = stub.complete(kwargs.get("json") or {})
+        return resp
+
+    main.APIS["stub"] = {"url": STUB_URL, "key": "", "model": "stub", "vision": True, "cost": 0, "stream": False}
+    main.PROMPT_CACHE_APIS.add("stub")
+    main.http_post = http_post
+    user_id, channel = "U000BENCH", "D000BENCH"
+    main.save_user(user_id, {"dm_history": [], "api": "stub", "mode": "long", "points_used": 0,
+                             "user_id": user_id, "ai_points": main.AI_POINTS_DEFAULT})
+    start = main.get_cn_time().timestamp()
+    print(f"{'turn':>5}{'msgs':>6}{'breakpoints':>14}{'hit msgs':>10}{'cached':>9}{'prompt':>9}")
+    try:
+        for turn in range(1, TURNS + 1):
+            user = main.load_user(user_id)
+            text = f"第 {turn} 条消息，随便聊聊今天的安排。"
+            messages = [{"role": "system", "content": main.get_system_prompt("long", user_id, channel)}]
+            messages.extend(main.build_history_messages(user, channel, "stub"))
+            messages.append({"role": "user", "content": main.with_turn_context(
+                main.get_turn_context("long", user_id, 1, user), text)})
+            reply = main.call_ai(messages, "stub")
+            main._append_dm_history(user_id, text, reply, start + turn * 60)  # 模拟每轮隔一分钟，历史按时间排序
+            n, breakpoints, hit, cached, total = last["turn"]
+            print(f"{turn:>5}{n:>6}{str(breakpoints):>14}{hit + 1:>10}{cached:>9}{total:>9}")
+    finally:
+        main.http_post = original_post
+        main.APIS.pop("stub", None)
+        main.PROMPT_CACHE_APIS.discard("stub")
+    st = stub.stats
+    ratio = st["cached_tokens"] / st["prompt_tokens"] if st["prompt_tokens"] else 0
+    print(f"请求 {st['requests']} 次，前缀延续 {st['extends_previous']} 次，前缀被打断 {st['prefix_breaks']} 次，"
+          f"缓存命中 {st['cached_tokens']}/{st['prompt_tokens']} tokens ({ratio:.0%})")
+
+
+if __name__ == "__main__":
+    run()
@@ -8,12 +8,31 @@ import threading
 import time
 import base64
 import io
+import copy
+import atexit
+import sqlite3
+import sys
+from collections import OrderedDict, deque
+import heapq
+import bisect
+import itertools
+import traceback
+import hashlib
+import tempfile
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 文件解析库
 import PyPDF2
 import docx
 import openpyxl
 import pptx
+from PIL import Image, ImageOps
 
 app = Flask(__name__)
 
@@ -25,6 +44,7 @@ JSONBIN_SCHEDULES = os.environ.get("JSONBIN_SCHEDULES")
 JSONBIN_MEMORIES = os.environ.get("JSONBIN_MEMORIES")
 JSONBIN_CHAT_LOGS = os.environ.get("JSONBIN_CHAT_LOGS")
 JSONBIN_CHANNEL_MESSAGES = os.environ.get("JSONBIN_CHANNEL_MESSAGES")
+JSONBIN_AI_POINTS_LOG = os.environ.get("JSONBIN_AI_POINTS_LOG")
 
 API_TOKEN_LIMITS = {
     "第三方sonnet": 110000,
@@ -169,6 +189,7 @@ AI_POINTS_DEFAULT = 10
 AI_MSG_LENGTH_LIMIT = 50  # 超过就审查
 AI_MSG_LENGTH_IDEAL = 20  # 理想长度
 REVIEW_TOKEN_LIMIT = 110000  # 审查时的 token 限制
+REVIEW_API = "第三方sonnet"  # 审查用的模型
 MAX_REWORK_ATTEMPTS = 3  # 最大返工次数
 
 CN_TIMEZONE = timezone(timedelta(hours=8))
@@ -194,8 +215,7 @@ def _get_channel_msgs_from_cache(channel_id):
             return list(_channel_messages_cache[channel_id])
     # 缓存没有，直接从JSONBin加载原始数据（不走get_channel_messages_since_reset避免循环）
     try:
-        messages = load_channel_messages()
-        msgs = messages.get(channel_id, [])
+        msgs = storage.load_key("channel_messages", channel_id, [])
         with _channel_cache_lock:
             _channel_messages_cache[channel_id] = list(msgs)
         return list(msgs)
@@ -215,7 +235,6 @@ def _add_to_channel_cache(channel_id, msg_dict):
 processed_events = set()
 processed_file_events = set()
 pending_messages = {}
-pending_timers = {}
 pending_clear_logs = {}
 channel_message_counts = {}
 
@@ -254,67 +273,320 @@ VALID_EMOJIS = [
 
 TEXT_EXTENSIONS = ['.txt', '.md', '.py', '.js', '.ts', '.html', '.css', '.json', '.xml', '.yaml', '.yml', '.csv', '.log', '.sh', '.bash', '.c', '.cpp', '.h', '.java', '.rb', '.php', '.go', '.rs', '.swift', '.kt', '.r', '.sql']
 
+# ========== HTTP 连接池 ==========
+# 所有外部请求走按业务分组的 requests.Session：每个 host 一个 keep-alive 连接池，
+# 各组有自己的超时和重试策略（urllib3 Retry，只在安全的情况下重试）。
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", 10))  # 每个 Session 缓存的 host 池数
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 20))  # 每个 host 的最大连接数
+
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+
+def _http_timeout(family, default_read):
+    """(连接超时, 读超时)，读超时可用 HTTP_TIMEOUT_<FAMILY> 覆盖"""
+    return (HTTP_CONNECT_TIMEOUT, float(os.environ.get(f"HTTP_TIMEOUT_{family.upper()}", default_read)))
+
+HTTP_POLICIES = {
+    # Slack 的 429 是在处理前拒绝的，POST 也可以按 Retry-After 重试；读超时不重试避免重复发消息
+    "slack": {"timeout": _http_timeout("slack", 30), "retry": Retry(
+        total=3, connect=3, read=0, status=3, status_forcelist=[429], allowed_methods=None,
+        backoff_factor=1, respect_retry_after_header=True, raise_on_status=False)},
+    "jsonbin": {"timeout": _http_timeout("jsonbin", 30), "retry": Retry(
+        total=3, connect=3, read=2, status=3, status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "PUT"], backoff_factor=0.5, raise_on_status=False)},
+    "files": {"timeout": _http_timeout("files", 30), "retry": Retry(
+        total=2, connect=2, read=1, status=2, status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["GET"], backoff_factor=0.5, raise_on_status=False)},
+    # AI 请求的重试由 call_ai 自己控制，这里只重试建连失败
+    "ai": {"timeout": _http_timeout("ai", 120), "retry": Retry(
+        total=1, connect=1, read=0, status=0, allowed_methods=None, raise_on_status=False)},
+}
+
+HTTP_LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+_http_latency = {}  # {label: {"count", "errors", "total_ms", "buckets"}}
+_http_latency_lock = threading.Lock()
+
+def _get_http_session(family):
+    with _http_sessions_lock:
+        session = _http_sessions.get(family)
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                                  max_retries=HTTP_POLICIES[family]["retry"])
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_sessions[family] = session
+        return session
+
+def _record_http_latency(label, elapsed_ms, error):
+    with _http_latency_lock:
+        h = _http_latency.setdefault(label, {"count": 0, "errors": 0, "total_ms": 0.0,
+                                             "buckets": [0] * (len(HTTP_LATENCY_BUCKETS_MS) + 1)})
+        h["count"] += 1
+        h["total_ms"] += elapsed_ms
+        if error:
+            h["errors"] += 1
+        for i, bound in enumerate(HTTP_LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                h["buckets"][i] += 1
+                break
+        else:
+            h["buckets"][-1] += 1
+
+def http_request(family, method, url, **kwargs):
+    kwargs.setdefault("timeout", HTTP_POLICIES[family]["timeout"])
+    parsed = urlparse(url)
+    labels = [parsed.netloc]
+    if parsed.netloc == "slack.com":
+        # Slack 按方法单独统计，方便看 chat.postMessage / chat.update 这条热路径
+        labels.append(parsed.netloc + parsed.path)
+    start = time.time()
+    error = True
+    try:
+        resp = _get_http_session(family).request(method, url, **kwargs)
+        error = resp.status_code >= 500
+        return resp
+    finally:
+        elapsed_ms = (time.time() - start) * 1000
+        for label in labels:
+            _record_http_latency(label, elapsed_ms, error)
+
+def http_get(family, url, **kwargs):
+    return http_request(family, "GET", url, **kwargs)
+
+def http_post(family, url, **kwargs):
+    return http_request(family, "POST", url, **kwargs)
+
+def http_put(family, url, **kwargs):
+    return http_request(family, "PUT", url, **kwargs)
+
+def _histogram_percentile(h, pct):
+    """按桶估算分位数（返回所在桶的上界）"""
+    target = h["count"] * pct
+    seen = 0
+    for i, n in enumerate(h["buckets"]):
+        seen += n
+        if seen >= target and n:
+            return HTTP_LATENCY_BUCKETS_MS[i] if i < len(HTTP_LATENCY_BUCKETS_MS) else None
+    return None
+
+def get_http_stats():
+    with _http_latency_lock:
+        latency = {}
+        for label, h in _http_latency.items():
+            latency[label] = {
+                "count": h["count"], "errors": h["errors"],
+                "avg_ms": round(h["total_ms"] / h["count"], 1) if h["count"] else 0,
+                "p50_ms": _histogram_percentile(h, 0.5), "p95_ms": _histogram_percentile(h, 0.95),
+                "buckets": dict(zip([f"<={b}" for b in HTTP_LATENCY_BUCKETS_MS] + ["inf"], h["buckets"])),
+            }
+    # 连接复用情况：新建连接数远小于请求数说明 keep-alive 生效
+    pools = {}
+    with _http_sessions_lock:
+        for family, session in _http_sessions.items():
+            adapter = session.get_adapter("https://")
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools[key]
+                pools[f"{family}:{pool.host}"] = {"connections": pool.num_connections,
+                                                  "requests": pool.num_requests}
+    return {"latency": latency, "pools": pools}
+
 # ========== 文件解析函数 ==========
 
-def download_file(url):
+# 下载按块流式读取，实际字节数一超过 MAX_FILE_SIZE 就中断（不信任事件里的 size）；
+# 超过 FILE_SPOOL_THRESHOLD 的内容落到临时文件，解析器通过路径读，内存里只留一块缓冲。
+FILE_DOWNLOAD_CHUNK = 64 * 1024
+FILE_SPOOL_THRESHOLD = int(os.environ.get("FILE_SPOOL_THRESHOLD", 1024 * 1024))
+FILE_SPOOL_DIR = os.environ.get("FILE_SPOOL_DIR") or None  # 默认系统临时目录
+
+class FileTooLarge(Exception):
+    pass
+
+class DownloadedFile:
+    """下载结果：小文件在内存（data），大文件在临时文件（path）"""
+
+    def __init__(self, data, path, size, sha256, peak_bytes):
+        self.data = data
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.peak_bytes = peak_bytes  # 下载过程中内存里最多同时持有的字节数
+
+    def source(self):
+        """给解析器的输入：临时文件路径或 bytes（都能跨进程传）"""
+        return self.path if self.path else self.data
+
+    def read_bytes(self):
+        if self.path:
+            with open(self.path, "rb") as f:
+                return f.read()
+        return self.data
+
+    def cleanup(self):
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+def download_file(url, suffix=""):
+    """流式下载，返回 DownloadedFile；失败返回 None，超过 MAX_FILE_SIZE 抛 FileTooLarge"""
+    spool = None
     try:
-        resp = requests.get(url, headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}, timeout=30)
-        if resp.status_code == 200:
-            return resp.content
+        resp = http_get("files", url, headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}, stream=True)
+        with resp:
+            if resp.status_code != 200:
+                return None
+            if int(resp.headers.get("Content-Length") or 0) > MAX_FILE_SIZE:
+                raise FileTooLarge()
+            buf, size, peak = bytearray(), 0, 0
+            digest = hashlib.sha256()
+            for chunk in resp.iter_content(FILE_DOWNLOAD_CHUNK):
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise FileTooLarge()
+                digest.update(chunk)
+                if spool is None:
+                    buf += chunk
+                    peak = max(peak, len(buf))
+                    if len(buf) > FILE_SPOOL_THRESHOLD:
+                        spool = tempfile.NamedTemporaryFile(prefix="slackfile-", suffix=suffix,
+                                                            dir=FILE_SPOOL_DIR, delete=False)
+                        spool.write(buf)
+                        buf = bytearray()
+                else:
+                    peak = max(peak, len(chunk))
+                    spool.write(chunk)
+        if spool is not None:
+            spool.close()
+            _file_pool_stats["spooled"] += 1
+            return DownloadedFile(None, spool.name, size, digest.hexdigest(), peak)
+        return DownloadedFile(bytes(buf), None, size, digest.hexdigest(), peak)
+    except FileTooLarge:
+        _file_pool_stats["too_large_aborts"] += 1
+        print(f"[File] 下载超过 {MAX_FILE_SIZE} 字节，已中断")
+        _discard_spool(spool)
+        raise
     except Exception as e:
         print(f"[File] 下载失败: {e}")
+        _discard_spool(spool)
     return None
 
-def extract_pdf_text(content):
+def _discard_spool(spool):
+    if spool is not None:
+        spool.close()
+        try:
+            os.remove(spool.name)
+        except OSError:
+            pass
+
+# 提取器都是生成器，按页 / 行 / 幻灯片 / 段落逐块产出；_join_within_budget 累计 token，
+# 到 FILE_TOKEN_BUDGET 就停止读取后面的内容，并在末尾注明保留了多少、跳过了多少。
+FILE_TOKEN_BUDGET = int(os.environ.get("FILE_TOKEN_BUDGET", 12000))
+
+def _join_within_budget(chunks, unit, total=None, budget=None):
+    """拼接 chunks 直到 token 预算用完，返回 (文本或 None, 截断信息或 None)。
+    最后一块放不下时按字符比例截一段；total 是总块数（不知道就传 None）"""
+    budget = FILE_TOKEN_BUDGET if budget is None else budget
+    parts, used, kept = [], 0, 0
+    truncation = None
+    for chunk in chunks:
+        cost = estimate_tokens(chunk)
+        if used + cost > budget:
+            remaining = budget - used
+            if remaining > 0 and cost:
+                parts.append(chunk[:int(len(chunk) * remaining / cost)])
+            truncation = {"unit": unit, "kept": kept, "total": total,
+                          "skipped": total - kept if total is not None else None, "budget": budget}
+            break
+        parts.append(chunk)
+        used += cost
+        kept += 1
+    text = "".join(parts).strip()
+    if truncation:
+        if truncation["skipped"] is not None:
+            detail = f"完整读取前 {kept}/{total} {unit}，跳过其余 {truncation['skipped']} {unit}"
+        else:
+            detail = f"完整读取前 {kept} {unit}，其余未读取"
+        text += f"\n...(已截断：超出 {budget} token 预算，{detail})"
+    return text or None, truncation
+
+def iter_pdf_pages(pdf):
+    """每页产出一块，空白页产出空串，这样读取的页数和 total 是同一种计数"""
+    for page in pdf.pages:
+        page_text = page.extract_text()
+        yield page_text + "\n" if page_text else ""
+
+def iter_docx_paragraphs(paragraphs):
+    for para in paragraphs:
+        yield para.text + "\n"
+
+def iter_xlsx_rows(wb):
+    """每行产出一块（空行产出空串），工作表标题并进该表的第一行，不单独算一行"""
+    for sheet in wb.sheetnames:
+        header = f"[工作表: {sheet}]\n"
+        for row in wb[sheet].iter_rows(values_only=True):
+            row_text = "\t".join([str(cell) if cell else "" for cell in row])
+            yield header + (row_text + "\n" if row_text.strip() else "")
+            header = ""
+
+def iter_pptx_slides(prs):
+    for i, slide in enumerate(prs.slides, 1):
+        lines = [f"[幻灯片 {i}]\n"]
+        for shape in slide.shapes:
+            if hasattr(shape, "text") and shape.text:
+                lines.append(shape.text + "\n")
+        yield "".join(lines)
+
+def iter_text_lines(text):
+    """逐行产出（带换行符），不预先切分整个文本"""
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start)
+        end = len(text) if end == -1 else end + 1
+        yield text[start:end]
+        start = end
+
+def extract_pdf_text(source):
     try:
-        pdf = PyPDF2.PdfReader(io.BytesIO(content))
-        text = ""
-        for page in pdf.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
-        return text.strip() if text.strip() else None
+        pdf = PyPDF2.PdfReader(source)
+        return _join_within_budget(iter_pdf_pages(pdf), "页", total=len(pdf.pages))
     except Exception as e:
         print(f"[File] PDF 解析失败: {e}")
-        return None
+        return None, None
 
-def extract_docx_text(content):
+def extract_docx_text(source):
     try:
-        doc = docx.Document(io.BytesIO(content))
-        return "\n".join([para.text for para in doc.paragraphs]).strip() or None
+        doc = docx.Document(source)
+        paragraphs = doc.paragraphs
+        return _join_within_budget(iter_docx_paragraphs(paragraphs), "段", total=len(paragraphs))
     except Exception as e:
         print(f"[File] Word 解析失败: {e}")
-        return None
+        return None, None
 
-def extract_xlsx_text(content):
+def extract_xlsx_text(source):
     try:
-        wb = openpyxl.load_workbook(io.BytesIO(content), read_only=True)
-        text = ""
-        for sheet in wb.sheetnames:
-            ws = wb[sheet]
-            text += f"[工作表: {sheet}]\n"
-            for row in ws.iter_rows(values_only=True):
-                row_text = "\t".join([str(cell) if cell else "" for cell in row])
-                if row_text.strip():
-                    text += row_text + "\n"
-        return text.strip() or None
+        wb = openpyxl.load_workbook(source, read_only=True)
+        try:
+            # 只读模式下行数来自表头的 dimension，可能不准，只用来估计跳过了多少
+            total = sum(wb[sheet].max_row or 0 for sheet in wb.sheetnames) or None
+            return _join_within_budget(iter_xlsx_rows(wb), "行", total=total)
+        finally:
+            wb.close()
     except Exception as e:
         print(f"[File] Excel 解析失败: {e}")
-        return None
+        return None, None
 
-def extract_pptx_text(content):
+def extract_pptx_text(source):
     try:
-        prs = pptx.Presentation(io.BytesIO(content))
-        text = ""
-        for i, slide in enumerate(prs.slides, 1):
-            text += f"[幻灯片 {i}]\n"
-            for shape in slide.shapes:
-                if hasattr(shape, "text") and shape.text:
-                    text += shape.text + "\n"
-        return text.strip() or None
+        prs = pptx.Presentation(source)
+        return _join_within_budget(iter_pptx_slides(prs), "页幻灯片", total=len(prs.slides))
     except Exception as e:
         print(f"[File] PPT 解析失败: {e}")
-        return None
+        return None, None
 
 def extract_text_file(content):
     for encoding in ['utf-8', 'gbk', 'gb2312', 'latin-1']:
@@ -324,81 +596,779 @@ def extract_text_file(content):
             continue
     return None
 
-def process_file(file_info):
+FILE_PARSERS = {
+    ".pdf": extract_pdf_text,
+    ".docx": extract_docx_text,
+    ".xlsx": extract_xlsx_text,
+    ".pptx": extract_pptx_text,
+}
+
+def parse_file_content(ext, source):
+    """在解析进程里运行：source 是临时文件路径或 bytes，解析器都按文件对象/路径读。
+    返回 (文本或 None, 解析耗时秒, 截断信息或 None)"""
+    start = time.perf_counter()
+    text, truncation = FILE_PARSERS[ext](io.BytesIO(source) if isinstance(source, bytes) else source)
+    return text, time.perf_counter() - start, truncation
+
+def _classify_file(file_info):
+    """不需要下载就能决定结果的返回 (类型, 内容)；需要下载的返回 None"""
     filename = file_info.get("name", "未知文件")
     mimetype = file_info.get("mimetype", "")
-    file_size = file_info.get("size", 0)
-    url = file_info.get("url_private")
-    
-    if not url:
+    ext = os.path.splitext(filename)[1].lower()
+    if not file_info.get("url_private"):
         return None, None
-    if file_size > MAX_FILE_SIZE:
+    if file_info.get("size", 0) > MAX_FILE_SIZE:
         return "too_large", f"[文件: {filename}]（超过 10MB 限制）"
-    
-    ext = os.path.splitext(filename)[1].lower()
-    
     if mimetype.startswith("image/"):
-        return "image", url
-    
-    content = download_file(url)
-    if not content:
-        return "error", f"[文件: {filename}]（下载失败）"
-    
-    parsers = {
-        ".pdf": extract_pdf_text,
-        ".docx": extract_docx_text,
-        ".xlsx": extract_xlsx_text,
-        ".pptx": extract_pptx_text,
-    }
-    
-    if ext in parsers:
-        text = parsers[ext](content)
-        return ("text", f"[文件: {filename}]\n{text}") if text else ("error", f"[文件: {filename}]（解析失败）")
-    
+        return "image", file_info
+    if ext in FILE_PARSERS:
+        return None
     if ext in [".doc", ".xls", ".ppt"]:
         return "unsupported", f"[文件: {filename}]（不支持旧版格式）"
-    
     if ext in TEXT_EXTENSIONS or mimetype.startswith("text/"):
-        text = extract_text_file(content)
-        if text:
-            if len(text) > 50000:
-                text = text[:50000] + "\n...(已截断)"
-            return "text", f"[文件: {filename}]\n{text}"
-    
+        return None
     return "unsupported", f"[文件: {filename}]（不支持此格式）"
 
-# ========== JSONBin 工具 ==========
+def _timed_download(url, suffix):
+    """返回 (DownloadedFile / None / "too_large", 耗时秒)"""
+    start = time.perf_counter()
+    try:
+        downloaded = download_file(url, suffix)
+    except FileTooLarge:
+        downloaded = "too_large"
+    return downloaded, time.perf_counter() - start
+
+def _decode_text_file(content):
+    """返回 (文本或 None, 截断信息或 None)"""
+    text = extract_text_file(content)
+    if not text:
+        return None, None
+    total = text.count("\n") + (0 if text.endswith("\n") else 1)
+    return _join_within_budget(iter_text_lines(text), "行", total=total)
 
-def jsonbin_save(bin_id, data):
-    if not bin_id:
+def process_file(file_info):
+    return process_files([file_info])[0]
+
+def process_files(files):
+    """附件流水线：先按 file id 查解析缓存；没命中的在 I/O 线程池里并发下载，
+    再按内容哈希查一次缓存，仍没命中才交给进程池解析（每个文件有超时）。
+    结果按附件原顺序返回 [(类型, 内容)]"""
+    results = [_classify_file(f) for f in files]
+    timings = {}  # {index: {"download_ms", "bytes", "parse_ms", "wall_ms", "cache"}}
+    pending = []
+    for i, r in enumerate(results):
+        if r is not None:
+            continue
+        text = file_cache_get_by_id(files[i].get("id"))
+        if text is not None:
+            results[i] = ("text", f"[文件: {files[i].get('name', '未知文件')}]\n{text}")
+            timings[i] = {"cache": "file id"}
+        else:
+            pending.append(i)
+
+    io_pool = _get_file_io_pool() if pending else None
+    downloads = {io_pool.submit(_timed_download, files[i]["url_private"],
+                                os.path.splitext(files[i].get("name", ""))[1].lower()): i for i in pending}
+    spooled = []  # 解析完要删掉的临时文件
+    parses = {}  # {index: (解析任务, 提交时间, 内容哈希)}
+    try:
+        for fut in as_completed(downloads):
+            i = downloads[fut]
+            filename = files[i].get("name", "未知文件")
+            ext = os.path.splitext(filename)[1].lower()
+            downloaded, download_s = fut.result()
+            timings[i] = {"download_ms": round(download_s * 1000)}
+            if downloaded == "too_large":
+                results[i] = ("too_large", f"[文件: {filename}]（超过 10MB 限制）")
+                continue
+            if not downloaded or not downloaded.size:
+                results[i] = ("error", f"[文件: {filename}]（下载失败）")
+                continue
+            spooled.append(downloaded)
+            timings[i].update(bytes=downloaded.size, peak=downloaded.peak_bytes, spooled=bool(downloaded.path))
+            _record_peak_bytes(downloaded.peak_bytes)
+            digest = file_cache_key(downloaded.sha256)
+            text = file_cache_get_by_hash(files[i].get("id"), digest)
+            if text is not None:
+                results[i] = ("text", f"[文件: {filename}]\n{text}")
+                timings[i]["cache"] = "内容哈希"
+            elif ext in FILE_PARSERS:
+                parses[i] = (_submit_parse(ext, downloaded.source()), time.perf_counter(), digest)
+            else:
+                text, truncation = _decode_text_file(downloaded.read_bytes())
+                _record_truncation(timings[i], truncation)
+                if text:
+                    file_cache_put(files[i].get("id"), digest, text)
+                    results[i] = ("text", f"[文件: {filename}]\n{text}")
+                else:
+                    results[i] = ("unsupported", f"[文件: {filename}]（不支持此格式）")
+        _collect_parses(files, parses, results, timings)
+    finally:
+        for downloaded in spooled:
+            downloaded.cleanup()
+
+    for i, t in sorted(timings.items()):
+        name = files[i].get("name", "未知文件")
+        if "download_ms" not in t:
+            print(f"[File] {name}: 缓存命中（{t['cache']}），跳过下载和解析")
+            continue
+        if "bytes" not in t:
+            print(f"[File] {name}: 下载 {t['download_ms']}ms，失败或超限")
+            continue
+        print(f"[File] {name}: 下载 {t['download_ms']}ms {t['bytes']}B，峰值内存 {t['peak']}B"
+              + ("（已落盘）" if t["spooled"] else "")
+              + (f"，缓存命中（{t['cache']}），跳过解析" if "cache" in t else "")
+              + (f"，解析 {t['parse_ms']}ms（含排队 {t['wall_ms']}ms）" if "wall_ms" in t else "")
+              + (f"，{t['truncated']}" if "truncated" in t else ""))
+    return results
+
+def _collect_parses(files, parses, results, timings):
+    """按附件顺序等进程池的解析结果，写回 results"""
+    for i, (submitted, submitted_at, digest) in parses.items():
+        filename = files[i].get("name", "未知文件")
+        text, parse_s, truncation = _wait_parse(submitted, filename)
+        _record_truncation(timings[i], truncation)
+        timings[i]["parse_ms"] = round(parse_s * 1000) if parse_s is not None else None
+        timings[i]["wall_ms"] = round((time.perf_counter() - submitted_at) * 1000)
+        if text:
+            file_cache_put(files[i].get("id"), digest, text)
+            results[i] = ("text", f"[文件: {filename}]\n{text}")
+        elif parse_s is None:
+            results[i] = ("error", f"[文件: {filename}]（解析超时）")
+        else:
+            results[i] = ("error", f"[文件: {filename}]（解析失败）")
+
+# ========== 附件线程池 / 进程池 ==========
+# 解析器（PyPDF2 / python-docx / openpyxl / python-pptx）是纯 CPU 活并且持有 GIL，
+# 放到 spawn 出来的子进程里跑；子进程会重新 import 本模块，所以后台线程只在主进程启动。
+FILE_DOWNLOAD_WORKERS = int(os.environ.get("FILE_DOWNLOAD_WORKERS", 4))
+FILE_PARSE_PROCESSES = int(os.environ.get("FILE_PARSE_PROCESSES", 2))
+FILE_PARSE_TIMEOUT = float(os.environ.get("FILE_PARSE_TIMEOUT", 30))
+FILE_PARSE_RETRIES = int(os.environ.get("FILE_PARSE_RETRIES", 1))  # 解析进程崩溃（不是超时）时换个进程重跑几次
+
+_file_io_pool = None
+_file_parse_pool = None
+_file_pool_lock = threading.Lock()
+_file_pool_stats = {"parsed": 0, "timeouts": 0, "worker_restarts": 0, "crash_retries": 0, "failed": 0,
+                    "spooled": 0, "too_large_aborts": 0, "peak_bytes_max": 0,
+                    "truncated_files": 0, "skipped_units": 0}
+
+def _get_file_io_pool():
+    global _file_io_pool
+    with _file_pool_lock:
+        if _file_io_pool is None:
+            _file_io_pool = ThreadPoolExecutor(max_workers=FILE_DOWNLOAD_WORKERS, thread_name_prefix="file-io")
+        return _file_io_pool
+
+def _parse_worker_main(conn):
+    """解析子进程的主循环：一次收一个 (ext, content)，回 ("ok", 结果) 或 ("error", 说明)"""
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        try:
+            result = ("ok", parse_file_content(*job))
+        except Exception as e:
+            result = ("error", repr(e))
+        conn.send(result)
+
+class _ParseWorker:
+    """一个常驻解析子进程，经 Pipe 收发任务；task 是正在跑的 (future, ext, content, 已重试次数)"""
+
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_parse_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started_at = None
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.kill()
+        self.conn.close()
+
+class FileParsePool:
+    """固定数量的常驻解析进程，任务由这里分派（不用 ProcessPoolExecutor：它一个进程死掉整个池都会作废）：
+    任务交给空闲进程时才开始计时，排队等进程的时间不算进 FILE_PARSE_TIMEOUT；
+    超时只杀掉跑这个任务的进程再补一个，其他进程上的解析不受影响；
+    进程意外退出时它手上的任务换新进程重跑，最多 FILE_PARSE_RETRIES 次。
+    返回的 future 一定会有结果：(文本, 解析耗时秒, 截断信息)，超时是 (None, None, None)，失败是 (None, 0.0, None)"""
+
+    def __init__(self, size):
+        self._ctx = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._queue = deque()  # 等空闲进程的任务
+        self._wake_r, self._wake_w = self._ctx.Pipe(duplex=False)
+        self._workers = [_ParseWorker(self._ctx) for _ in range(size)]
+        threading.Thread(target=self._supervise, name="file-parse", daemon=True).start()
+
+    def submit(self, ext, content):
+        fut = Future()
+        with self._lock:
+            self._queue.append((fut, ext, content, 0))
+            self._assign()
+            self._wake_w.send_bytes(b"")
+        return fut
+
+    def _replace(self, worker):
+        worker.stop()
+        self._workers[self._workers.index(worker)] = _ParseWorker(self._ctx)
+        _file_pool_stats["worker_restarts"] += 1
+
+    def _assign(self):
+        """把排队的任务交给空闲进程（调用方持有 _lock）"""
+        for worker in list(self._workers):
+            if not self._queue:
+                return
+            if worker.task is not None:
+                continue
+            task = self._queue.popleft()
+            try:
+                worker.conn.send(task[1:3])
+            except OSError:
+                # 空闲时已经死掉的进程：换一个，任务放回队首
+                self._queue.appendleft(task)
+                self._replace(worker)
+                continue
+            worker.task, worker.started_at = task, time.perf_counter()
+
+    def _crashed(self, worker):
+        fut, ext, content, retries = worker.task
+        self._replace(worker)
+        if retries < FILE_PARSE_RETRIES:
+            _file_pool_stats["crash_retries"] += 1
+            self._queue.appendleft((fut, ext, content, retries + 1))
+        else:
+            _file_pool_stats["failed"] += 1
+            fut.set_result((None, 0.0, None))
+
+    def _supervise(self):
+        while True:
+            with self._lock:
+                busy = {w.conn: w for w in self._workers if w.task is not None}
+                deadlines = [w.started_at + FILE_PARSE_TIMEOUT for w in busy.values()]
+            timeout = max(0, min(deadlines) - time.perf_counter()) if deadlines else None
+            ready = multiprocessing.connection.wait(list(busy) + [self._wake_r], timeout)
+            with self._lock:
+                while self._wake_r.poll():
+                    self._wake_r.recv_bytes()
+                for conn in ready:
+                    worker = busy.get(conn)
+                    if worker is None:
+                        continue
+                    try:
+                        status, payload = conn.recv()
+                    except (EOFError, OSError):
+                        print("[File] 解析进程异常退出，换新进程")
+                        self._crashed(worker)
+                        continue
+                    fut, worker.task = worker.task[0], None
+                    if status == "ok":
+                        _file_pool_stats["parsed"] += 1
+                        fut.set_result(payload)
+                    else:
+                        print(f"[File] 解析出错: {payload}")
+                        _file_pool_stats["failed"] += 1
+                        fut.set_result((None, 0.0, None))
+                now = time.perf_counter()
+                for worker in list(self._workers):
+                    if worker.task is not None and now - worker.started_at >= FILE_PARSE_TIMEOUT:
+                        _file_pool_stats["timeouts"] += 1
+                        fut = worker.task[0]
+                        self._replace(worker)
+                        fut.set_result((None, None, None))
+                self._assign()
+
+def _get_file_parse_pool():
+    global _file_parse_pool
+    with _file_pool_lock:
+        if _file_parse_pool is None:
+            _file_parse_pool = FileParsePool(FILE_PARSE_PROCESSES)
+        return _file_parse_pool
+
+def _submit_parse(ext, content):
+    """返回解析任务的 future；解析进程起不来时返回已经是失败结果的 future"""
+    try:
+        return _get_file_parse_pool().submit(ext, content)
+    except Exception as e:
+        print(f"[File] 解析进程池不可用: {e}")
+        _file_pool_stats["failed"] += 1
+        fut = Future()
+        fut.set_result((None, 0.0, None))
+        return fut
+
+def _wait_parse(fut, filename):
+    """等解析结果，返回 (文本, 解析耗时秒, 截断信息)；超时返回 (None, None, None)。
+    超时由 FileParsePool 从开始解析时算，这里不用再设"""
+    result = fut.result()
+    if result[1] is None:
+        print(f"[File] {filename} 解析超过 {FILE_PARSE_TIMEOUT}s，放弃")
+    return result
+
+# ========== 附件解析缓存 ==========
+# 解析出的文本按内容哈希存在磁盘上（<sha256>-<token 预算>.txt，预算变了旧结果自然失效），
+# 另有 file id → 哈希 的索引：
+# 同一个文件再次出现（重复分享、事件重投）直接按 file id 命中，不下载也不解析；
+# 换了 file id 但内容相同的，下载后按哈希命中，跳过解析。总大小超过 FILE_CACHE_MAX_BYTES
+# 时按最近使用时间（文件 mtime）淘汰最旧的。
+FILE_CACHE_DIR = os.environ.get("FILE_CACHE_DIR", "file_cache")
+FILE_CACHE_MAX_BYTES = int(os.environ.get("FILE_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+
+_file_cache_lru = None  # OrderedDict {哈希: 字节数}，最旧的在前；首次使用时扫描目录
+_file_cache_ids = {}  # {file_id: 哈希}
+_file_cache_bytes = 0
+_file_cache_lock = threading.Lock()
+_file_cache_stats = {"id_hits": 0, "hash_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+def _file_cache_path(name):
+    return os.path.join(FILE_CACHE_DIR, name)
+
+def _load_file_cache():
+    """调用方持有 _file_cache_lock"""
+    global _file_cache_lru, _file_cache_ids, _file_cache_bytes
+    if _file_cache_lru is not None:
+        return
+    os.makedirs(FILE_CACHE_DIR, exist_ok=True)
+    blobs = []
+    for entry in os.scandir(FILE_CACHE_DIR):
+        if entry.name.endswith(".txt"):
+            st = entry.stat()
+            blobs.append((st.st_mtime, entry.name[:-4], st.st_size))
+    _file_cache_lru = OrderedDict((digest, size) for _, digest, size in sorted(blobs))
+    _file_cache_bytes = sum(_file_cache_lru.values())
+    try:
+        with open(_file_cache_path("index.json"), encoding="utf-8") as f:
+            _file_cache_ids = {fid: digest for fid, digest in json.load(f).items() if digest in _file_cache_lru}
+    except (OSError, ValueError):
+        _file_cache_ids = {}
+
+def _save_file_cache_index():
+    """调用方持有 _file_cache_lock；先写临时文件再替换"""
+    tmp = _file_cache_path("index.json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(_file_cache_ids, f)
+    os.replace(tmp, _file_cache_path("index.json"))
+
+def _read_cached_text(digest):
+    """调用方持有 _file_cache_lock；读到就挪到 LRU 末尾"""
+    if digest not in _file_cache_lru:
+        return None
+    path = _file_cache_path(digest + ".txt")
+    try:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        os.utime(path)
+    except OSError:
+        _file_cache_lru.pop(digest, None)
+        return None
+    _file_cache_lru.move_to_end(digest)
+    return text
+
+def file_cache_key(sha256):
+    return f"{sha256}-{FILE_TOKEN_BUDGET}"
+
+def file_cache_get_by_id(file_id):
+    if not file_id:
+        return None
+    with _file_cache_lock:
+        _load_file_cache()
+        digest = _file_cache_ids.get(file_id)
+        current = digest and digest.endswith(f"-{FILE_TOKEN_BUDGET}")
+        text = _read_cached_text(digest) if current else None
+        if text is not None:
+            _file_cache_stats["id_hits"] += 1
+        return text
+
+def file_cache_get_by_hash(file_id, digest):
+    with _file_cache_lock:
+        _load_file_cache()
+        text = _read_cached_text(digest)
+        if text is None:
+            _file_cache_stats["misses"] += 1
+            return None
+        _file_cache_stats["hash_hits"] += 1
+        if file_id and _file_cache_ids.get(file_id) != digest:
+            _file_cache_ids[file_id] = digest
+            _save_file_cache_index()
+        return text
+
+def file_cache_put(file_id, digest, text):
+    global _file_cache_bytes
+    data = text.encode("utf-8")
+    if len(data) > FILE_CACHE_MAX_BYTES:
         return
     try:
-        requests.put(
-            f"https://api.jsonbin.io/v3/b/{bin_id}",
+        with _file_cache_lock:
+            _load_file_cache()
+            if digest not in _file_cache_lru:
+                with open(_file_cache_path(digest + ".txt"), "wb") as f:
+                    f.write(data)
+                _file_cache_lru[digest] = len(data)
+                _file_cache_bytes += len(data)
+                _file_cache_stats["stores"] += 1
+            _file_cache_lru.move_to_end(digest)
+            while _file_cache_bytes > FILE_CACHE_MAX_BYTES:
+                old_digest, size = _file_cache_lru.popitem(last=False)
+                _file_cache_bytes -= size
+                _file_cache_stats["evictions"] += 1
+                try:
+                    os.remove(_file_cache_path(old_digest + ".txt"))
+                except OSError:
+                    pass
+            live = set(_file_cache_lru)
+            for fid in [fid for fid, d in _file_cache_ids.items() if d not in live]:
+                del _file_cache_ids[fid]
+            if file_id:
+                _file_cache_ids[file_id] = digest
+            _save_file_cache_index()
+    except OSError as e:
+        print(f"[FileCache] 写入失败: {e}")
+
+def get_file_cache_stats():
+    with _file_cache_lock:
+        return dict(_file_cache_stats, entries=len(_file_cache_lru or {}), bytes=_file_cache_bytes,
+                    file_ids=len(_file_cache_ids))
+
+def _record_truncation(timing, truncation):
+    if not truncation:
+        return
+    skipped = truncation["skipped"]
+    timing["truncated"] = (f"超出 token 预算，保留 {truncation['kept']} {truncation['unit']}"
+                           + (f"，跳过 {skipped} {truncation['unit']}" if skipped is not None else ""))
+    with _file_pool_lock:
+        _file_pool_stats["truncated_files"] += 1
+        _file_pool_stats["skipped_units"] += skipped or 0
+
+def _record_peak_bytes(peak):
+    with _file_pool_lock:
+        _file_pool_stats["peak_bytes_max"] = max(_file_pool_stats["peak_bytes_max"], peak)
+
+def get_file_pipeline_stats():
+    return dict(_file_pool_stats)
+
+# ========== JSONBin 工具 ==========
+
+def _jsonbin_put(bin_id, data):
+    """直接写 JSONBin，成功返回 True"""
+    try:
+        resp = http_put(
+            "jsonbin", f"https://api.jsonbin.io/v3/b/{bin_id}",
             headers={"X-Master-Key": JSONBIN_API_KEY, "Content-Type": "application/json"},
-            json=data, timeout=30
+            json=data
         )
+        if resp.status_code == 200:
+            return True
+        print(f"[JSONBin] save 失败: {resp.status_code} {resp.text[:200]}")
     except Exception as e:
         print(f"JSONBin 保存失败: {e}")
+    return False
 
-def jsonbin_load(bin_id, default=None):
-    if not bin_id:
-        return default or {}
+def _jsonbin_get(bin_id):
+    """直接读 JSONBin，失败返回 None"""
     try:
-        resp = requests.get(
-            f"https://api.jsonbin.io/v3/b/{bin_id}/latest",
-            headers={"X-Master-Key": JSONBIN_API_KEY}, timeout=30
+        resp = http_get(
+            "jsonbin", f"https://api.jsonbin.io/v3/b/{bin_id}/latest",
+            headers={"X-Master-Key": JSONBIN_API_KEY}
         )
         print(f"[JSONBin] load {bin_id}: status={resp.status_code}")
         if resp.status_code == 200:
-            record = resp.json().get("record", default or {})
+            record = resp.json().get("record", {})
             record.pop("init", None)
             return record
         else:
             print(f"[JSONBin] load 失败: {resp.text[:200]}")
     except Exception as e:
         print(f"[JSONBin] load 出错: {e}")
-    return default or {}
+    return None
+
+# ========== JSONBin 写回缓存 ==========
+# 每个 bin 的整份文档常驻内存：读直接走内存，写只标记 dirty，
+# 由后台线程按 JSONBIN_FLUSH_INTERVAL 合并回写，进程退出时再刷一次。
+# 注意缓存是进程内的，多 worker 部署时各进程互相看不到对方的未刷写入。
+JSONBIN_FLUSH_INTERVAL = float(os.environ.get("JSONBIN_FLUSH_INTERVAL", 5))
+
+_doc_cache = {}  # {bin_id: record}
+_doc_cache_dirty = set()
+_doc_cache_lock = threading.Lock()
+_doc_load_locks = {}  # {bin_id: Lock}，避免同一个 bin 并发 miss 时重复下载
+_doc_cache_stats = {"hits": 0, "misses": 0, "load_errors": 0, "writes": 0,
+                    "flushes": 0, "flushed_docs": 0, "flush_errors": 0}
+
+def jsonbin_save(bin_id, data):
+    if not bin_id:
+        return
+    with _doc_cache_lock:
+        _doc_cache[bin_id] = copy.deepcopy(data)
+        _doc_cache_dirty.add(bin_id)
+        _doc_cache_stats["writes"] += 1
+
+def jsonbin_load(bin_id, default=None):
+    if not bin_id:
+        return default or {}
+    with _doc_cache_lock:
+        if bin_id in _doc_cache:
+            _doc_cache_stats["hits"] += 1
+            return copy.deepcopy(_doc_cache[bin_id])
+        load_lock = _doc_load_locks.setdefault(bin_id, threading.Lock())
+    with load_lock:
+        # 等锁期间可能已经被别的线程加载好了
+        with _doc_cache_lock:
+            if bin_id in _doc_cache:
+                _doc_cache_stats["hits"] += 1
+                return copy.deepcopy(_doc_cache[bin_id])
+            _doc_cache_stats["misses"] += 1
+        record = _jsonbin_get(bin_id)
+        if record is None:
+            with _doc_cache_lock:
+                _doc_cache_stats["load_errors"] += 1
+            return default or {}
+        with _doc_cache_lock:
+            # 下载期间有人写入的话以内存里的为准
+            _doc_cache.setdefault(bin_id, record)
+            return copy.deepcopy(_doc_cache[bin_id])
+
+def flush_jsonbin_cache():
+    """把所有 dirty 的文档写回 JSONBin，返回成功写回的数量"""
+    with _doc_cache_lock:
+        pending = {bin_id: _doc_cache[bin_id] for bin_id in _doc_cache_dirty}
+        _doc_cache_dirty.clear()
+    if not pending:
+        return 0
+    flushed = 0
+    for bin_id, record in pending.items():
+        # 缓存里的文档只会被整体替换、不会原地修改，所以这里不用再拷贝
+        if _jsonbin_put(bin_id, record):
+            flushed += 1
+        else:
+            with _doc_cache_lock:
+                _doc_cache_dirty.add(bin_id)
+                _doc_cache_stats["flush_errors"] += 1
+    with _doc_cache_lock:
+        _doc_cache_stats["flushes"] += 1
+        _doc_cache_stats["flushed_docs"] += flushed
+    print(f"[JSONBin] 回写 {flushed}/{len(pending)} 个文档")
+    return flushed
+
+def get_jsonbin_cache_stats():
+    with _doc_cache_lock:
+        stats = dict(_doc_cache_stats)
+        stats["cached_docs"] = len(_doc_cache)
+        stats["dirty_docs"] = len(_doc_cache_dirty)
+    reads = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / reads, 4) if reads else 0.0
+    # 每次 load 命中省一次 GET，每次 save 被合并省一次 PUT
+    stats["round_trips_saved"] = stats["hits"] + max(0, stats["writes"] - stats["flushed_docs"] - stats["dirty_docs"])
+    return stats
+
+def jsonbin_load_key(bin_id, key, default=None):
+    """只拷贝文档里的一个 key，避免为了一条记录深拷贝整份文档"""
+    if not bin_id:
+        return default
+    with _doc_cache_lock:
+        cached = bin_id in _doc_cache
+    if not cached:
+        jsonbin_load(bin_id, {})
+    with _doc_cache_lock:
+        doc = _doc_cache.get(bin_id, {})
+        if cached:
+            _doc_cache_stats["hits"] += 1
+        return copy.deepcopy(doc[key]) if key in doc else default
+
+def jsonbin_save_key(bin_id, key, value, delete=False):
+    """写文档里的一个 key（写时复制，缓存里的旧文档不会被原地修改）"""
+    if delete:
+        jsonbin_save_keys(bin_id, {}, deletes=[key])
+    else:
+        jsonbin_save_keys(bin_id, {key: value})
+
+def jsonbin_save_keys(bin_id, items, deletes=()):
+    """一次写文档里的多个 key，只复制一次文档、计一次写入"""
+    if not bin_id:
+        return
+    with _doc_cache_lock:
+        cached = bin_id in _doc_cache
+    if not cached:
+        jsonbin_load(bin_id, {})
+    with _doc_cache_lock:
+        doc = dict(_doc_cache.get(bin_id, {}))
+        for key in deletes:
+            doc.pop(key, None)
+        for key, value in items.items():
+            doc[key] = copy.deepcopy(value)
+        _doc_cache[bin_id] = doc
+        _doc_cache_dirty.add(bin_id)
+        _doc_cache_stats["writes"] += 1
+
+def _run_jsonbin_flusher():
+    while True:
+        time.sleep(JSONBIN_FLUSH_INTERVAL)
+        try:
+            flush_jsonbin_cache()
+        except Exception as e:
+            print(f"[JSONBin] 回写出错: {e}")
+
+# ========== 存储后端 ==========
+# load_*/save_* 都通过这里读写，STORAGE_BACKEND 选择 jsonbin（默认）或 sqlite。
+# 文档按 key 拆分：user_data/memories/schedules 以 user_id 为 key，channel_messages 以 channel_id 为 key。
+# chat_logs 里是按用户分段的聊天记录（见“聊天记录”一节），ai_points_log 是按 user_id 存的积分事件历史。
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "jsonbin")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "bot_data.db")
+
+STORE_BINS = {
+    "user_data": JSONBIN_USER_DATA,
+    "schedules": JSONBIN_SCHEDULES,
+    "memories": JSONBIN_MEMORIES,
+    "chat_logs": JSONBIN_CHAT_LOGS,
+    "channel_messages": JSONBIN_CHANNEL_MESSAGES,
+    "ai_points_log": JSONBIN_AI_POINTS_LOG,
+}
+
+class JsonBinStorage:
+    """每个文档是一个 JSONBin，单 key 写入也会在下次回写时整份上传（由写回缓存合并）"""
+    name = "jsonbin"
+
+    def load_doc(self, doc):
+        return jsonbin_load(STORE_BINS.get(doc), {})
+
+    def save_doc(self, doc, data):
+        jsonbin_save(STORE_BINS.get(doc), data)
+
+    def load_key(self, doc, key, default=None):
+        return jsonbin_load_key(STORE_BINS.get(doc), key, default)
+
+    def save_key(self, doc, key, value):
+        jsonbin_save_key(STORE_BINS.get(doc), key, value)
+
+    def save_keys(self, doc, items):
+        jsonbin_save_keys(STORE_BINS.get(doc), items)
+
+    def delete_key(self, doc, key):
+        jsonbin_save_key(STORE_BINS.get(doc), key, None, delete=True)
+
+    def stats(self):
+        return {"backend": self.name}
+
+class SqliteStorage:
+    """本地 SQLite（WAL），每个用户/频道一行，只写变化的行"""
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._stats = {"reads": 0, "rows_written": 0, "rows_deleted": 0, "bytes_written": 0}
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS kv (
+            doc TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+            PRIMARY KEY (doc, key))""")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load_doc(self, doc):
+        rows = self._conn().execute("SELECT key, value FROM kv WHERE doc = ?", (doc,)).fetchall()
+        self._stats["reads"] += 1
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_doc(self, doc, data):
+        # 整份保存时也只写有变化的行
+        conn = self._conn()
+        with self._write_lock:
+            existing = dict(conn.execute("SELECT key, value FROM kv WHERE doc = ?", (doc,)).fetchall())
+            changed = []
+            for key, value in data.items():
+                encoded = json.dumps(value, ensure_ascii=False)
+                if existing.get(key) != encoded:
+                    changed.append((doc, key, encoded))
+            removed = [(doc, key) for key in existing if key not in data]
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO kv (doc, key, value) VALUES (?, ?, ?)", changed)
+                conn.executemany("DELETE FROM kv WHERE doc = ? AND key = ?", removed)
+            self._stats["rows_written"] += len(changed)
+            self._stats["rows_deleted"] += len(removed)
+            self._stats["bytes_written"] += sum(len(v) for _, _, v in changed)
+
+    def load_key(self, doc, key, default=None):
+        row = self._conn().execute("SELECT value FROM kv WHERE doc = ? AND key = ?", (doc, key)).fetchone()
+        self._stats["reads"] += 1
+        return json.loads(row[0]) if row else default
+
+    def save_key(self, doc, key, value):
+        encoded = json.dumps(value, ensure_ascii=False)
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.execute("INSERT OR REPLACE INTO kv (doc, key, value) VALUES (?, ?, ?)", (doc, key, encoded))
+            self._stats["rows_written"] += 1
+            self._stats["bytes_written"] += len(encoded)
+
+    def save_keys(self, doc, items):
+        # 多行放在同一个事务里
+        rows = [(doc, key, json.dumps(value, ensure_ascii=False)) for key, value in items.items()]
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.executemany("INSERT OR REPLACE INTO kv (doc, key, value) VALUES (?, ?, ?)", rows)
+            self._stats["rows_written"] += len(rows)
+            self._stats["bytes_written"] += sum(len(v) for _, _, v in rows)
+
+    def delete_key(self, doc, key):
+        conn = self._conn()
+        with self._write_lock, conn:
+            conn.execute("DELETE FROM kv WHERE doc = ? AND key = ?", (doc, key))
+            self._stats["rows_deleted"] += 1
+
+    def stats(self):
+        return dict(self._stats, backend=self.name, path=self.path)
+
+def create_storage(backend):
+    if backend == "sqlite":
+        return SqliteStorage(SQLITE_PATH)
+    return JsonBinStorage()
+
+storage = create_storage(STORAGE_BACKEND)
+
+def migrate_jsonbin_to_sqlite():
+    """一次性把各个 JSONBin 的内容拷到 SQLite"""
+    target = SqliteStorage(SQLITE_PATH)
+    for doc, bin_id in STORE_BINS.items():
+        if not bin_id:
+            print(f"[Migrate] {doc}: 未配置 bin，跳过")
+            continue
+        data = _jsonbin_get(bin_id)
+        if data is None:
+            print(f"[Migrate] {doc}: 读取失败，跳过")
+            continue
+        if doc == "chat_logs":
+            # 旧格式的整份记录顺便切成分段
+            converted = {}
+            for key, value in data.items():
+                if ":" not in key and isinstance(value, list):
+                    converted.update(_chat_log_segments(key, sorted(value, key=lambda x: x.get("time", "")))[1])
+                else:
+                    converted[key] = value
+            data = converted
+        target.save_doc(doc, data)
+        print(f"[Migrate] {doc}: {len(data)} 条 -> {SQLITE_PATH}")
+
+_user_locks = {}
+_user_locks_lock = threading.Lock()
+
+def _get_user_lock(user_id):
+    with _user_locks_lock:
+        return _user_locks.setdefault(user_id, threading.Lock())
 
 # ========== 时间工具 ==========
 
@@ -431,22 +1401,49 @@ def get_time_period():
 # ========== 数据持久化 ==========
 
 def load_user_data():
-    return jsonbin_load(JSONBIN_USER_DATA, {})
+    return storage.load_doc("user_data")
 
 def save_user_data(data):
-    jsonbin_save(JSONBIN_USER_DATA, data)
+    storage.save_doc("user_data", data)
+
+def load_user(user_id, default=None):
+    return storage.load_key("user_data", user_id, default if default is not None else {})
+
+def save_user(user_id, user):
+    storage.save_key("user_data", user_id, user)
+
+def update_user(user_id, fn):
+    """读-改-写单个用户记录，fn 原地修改 user，返回值透传"""
+    with _get_user_lock(user_id):
+        user = load_user(user_id)
+        result = fn(user)
+        save_user(user_id, user)
+        return result
 
 def load_schedules():
-    return jsonbin_load(JSONBIN_SCHEDULES, {})
+    return storage.load_doc("schedules")
 
 def save_schedules(data):
-    jsonbin_save(JSONBIN_SCHEDULES, data)
+    storage.save_doc("schedules", data)
+
+def load_user_schedules(user_id):
+    return storage.load_key("schedules", user_id, {"timed": [], "daily": [], "special_dates": {}})
+
+def save_user_schedules(user_id, scheds):
+    storage.save_key("schedules", user_id, scheds)
+    scheduler_notify(user_id)
+
+_schedule_locks = {}
+
+def _get_schedule_lock(user_id):
+    with _user_locks_lock:
+        return _schedule_locks.setdefault(user_id, threading.Lock())
 
 def load_channel_messages():
-    return jsonbin_load(JSONBIN_CHANNEL_MESSAGES, {})
+    return storage.load_doc("channel_messages")
 
 def save_channel_messages(data):
-    jsonbin_save(JSONBIN_CHANNEL_MESSAGES, data)
+    storage.save_doc("channel_messages", data)
 
 def add_channel_message(channel_id, user_id, username, content, is_bot=False):
     try:
@@ -457,6 +1454,7 @@ def add_channel_message(channel_id, user_id, username, content, is_bot=False):
             "user_id": user_id,
             "username": username,
             "content": content,
+            "token_features": token_features(content),
             "timestamp": get_cn_time().timestamp(),
             "time_str": get_timestamp(),
             "is_bot": is_bot
@@ -465,13 +1463,9 @@ def add_channel_message(channel_id, user_id, username, content, is_bot=False):
         _add_to_channel_cache(channel_id, msg_dict)
         # 异步回写JSONBin
         with _channel_msg_lock:
-            messages = load_channel_messages()
-            if channel_id not in messages:
-                messages[channel_id] = []
-            messages[channel_id].append(msg_dict)
-            if len(messages[channel_id]) > 200:
-                messages[channel_id] = messages[channel_id][-200:]
-            save_channel_messages(messages)
+            msgs = storage.load_key("channel_messages", channel_id, [])
+            msgs.append(msg_dict)
+            storage.save_key("channel_messages", channel_id, msgs[-200:])
         return len(_get_channel_msgs_from_cache(channel_id))
     except Exception as e:
         print(f"add_channel_message 出错: {e}")
@@ -484,8 +1478,7 @@ def get_channel_messages_since_reset(channel_id, reset_time=None):
             if channel_id in _channel_messages_cache:
                 msgs = list(_channel_messages_cache[channel_id])
             else:
-                messages = load_channel_messages()
-                msgs = messages.get(channel_id, [])
+                msgs = storage.load_key("channel_messages", channel_id, [])
                 _channel_messages_cache[channel_id] = list(msgs)
         if reset_time:
             msgs = [m for m in msgs if m.get("timestamp", 0) > reset_time]
@@ -499,95 +1492,240 @@ def get_recent_channel_messages(channel_id, count=10):
         with _channel_cache_lock:
             if channel_id in _channel_messages_cache:
                 return list(_channel_messages_cache[channel_id][-count:])
-        messages = load_channel_messages()
-        return messages.get(channel_id, [])[-count:]
+        return storage.load_key("channel_messages", channel_id, [])[-count:]
     except:
         return []
 
 # ========== 聊天记录 ==========
-
-def load_chat_logs():
-    return jsonbin_load(JSONBIN_CHAT_LOGS, {})
-
-def save_chat_logs(data):
-    jsonbin_save(JSONBIN_CHAT_LOGS, data)
+# 按用户分段的追加日志，和其他数据一样经 storage 存在 chat_logs 文档里（jsonbin 后端就是原来的聊天记录 bin）：
+# "<user_id>:index" 记录分段列表，"<user_id>:000001" ... 每段最多 CHAT_LOG_SEGMENT_SIZE 条。
+# 追加只改写当前分段；按频道清空写一条 tombstone，整体清空直接删分段。
+# 旧格式的整份记录（"<user_id>": [...]）在这个用户第一次写入时转换成分段。
+CHAT_LOG_SEGMENT_SIZE = int(os.environ.get("CHAT_LOG_SEGMENT_SIZE", 200))  # 每个分段最多条数
+
+_chat_log_indexes = {}  # {user_id: index}
+_chat_log_active = {}  # {user_id: 当前分段的记录列表}
+_chat_log_locks = {}
+_chat_log_locks_lock = threading.Lock()
+_chat_log_stats = {"appends": 0, "tombstones": 0, "segments_created": 0, "segments_dropped": 0,
+                   "legacy_converted": 0}
+
+def _get_chat_log_lock(user_id):
+    with _chat_log_locks_lock:
+        return _chat_log_locks.setdefault(user_id, threading.Lock())
+
+def _chat_log_key(user_id, name):
+    return f"{user_id}:{name}"
+
+def _chat_log_segments(user_id, entries):
+    """把一个用户的整份记录切成分段，返回 (索引, {key: 值})，索引也在里面"""
+    index = {"segments": [], "next": 1}
+    items = {}
+    for start in range(0, len(entries), CHAT_LOG_SEGMENT_SIZE):
+        chunk = entries[start:start + CHAT_LOG_SEGMENT_SIZE]
+        name = f"{index['next']:06d}"
+        index["segments"].append({"name": name, "count": len(chunk),
+                                  "first": chunk[0].get("time"), "last": chunk[-1].get("time")})
+        index["next"] += 1
+        items[_chat_log_key(user_id, name)] = chunk
+    items[_chat_log_key(user_id, "index")] = index
+    return index, items
+
+def _load_chat_log_index(user_id):
+    """读取（并缓存）用户的分段索引和当前分段，调用方需持有该用户的日志锁"""
+    if user_id in _chat_log_indexes:
+        return _chat_log_indexes[user_id]
+    index = storage.load_key("chat_logs", _chat_log_key(user_id, "index"))
+    if index is None:
+        legacy = storage.load_key("chat_logs", user_id)
+        if isinstance(legacy, list) and legacy:
+            index, items = _chat_log_segments(user_id, sorted(legacy, key=lambda x: x.get("time", "")))
+            storage.save_keys("chat_logs", items)
+            storage.delete_key("chat_logs", user_id)
+            _chat_log_stats["legacy_converted"] += 1
+        else:
+            index = {"segments": [], "next": 1}
+    active = []
+    if index["segments"]:
+        # 活动分段的条数不随每次追加写回索引，以分段本身为准
+        active = storage.load_key("chat_logs", _chat_log_key(user_id, index["segments"][-1]["name"]), [])
+        index["segments"][-1]["count"] = len(active)
+    _chat_log_indexes[user_id] = index
+    _chat_log_active[user_id] = active
+    return index
+
+def _append_chat_log_entry(user_id, entry):
+    with _get_chat_log_lock(user_id):
+        index = _load_chat_log_index(user_id)
+        segments = index["segments"]
+        items = {}
+        if not segments or segments[-1]["count"] >= CHAT_LOG_SEGMENT_SIZE:
+            segments.append({"name": f"{index['next']:06d}", "count": 0,
+                             "first": entry.get("time"), "last": entry.get("time")})
+            index["next"] += 1
+            _chat_log_active[user_id] = []
+            items[_chat_log_key(user_id, "index")] = index
+            _chat_log_stats["segments_created"] += 1
+        active = segments[-1]
+        entries = _chat_log_active[user_id]
+        entries.append(entry)
+        active["count"] = len(entries)
+        active["last"] = entry.get("time")
+        items[_chat_log_key(user_id, active["name"])] = entries
+        storage.save_keys("chat_logs", items)
+        _chat_log_stats["appends"] += 1
+        if entry.get("type") == "tombstone":
+            _chat_log_stats["tombstones"] += 1
+
+def get_chat_log_stats():
+    return dict(_chat_log_stats, users_indexed=len(_chat_log_indexes))
 
 def log_message(user_id, channel, role, content, username=None, model=None, is_reset=False, hidden=False):
     try:
-        logs = load_chat_logs()
-        if user_id not in logs:
-            logs[user_id] = []
-        
         timestamp = get_timestamp()
         scene = "私聊" if is_dm_channel(channel) else get_channel_name(channel)
         
         if is_reset:
-            logs[user_id].append({"type": "reset", "time": timestamp, "scene": scene})
+            entry = {"type": "reset", "time": timestamp, "scene": scene}
         else:
             entry = {"time": timestamp, "scene": scene, "role": role, "content": content, "hidden": hidden}
             if role == "user":
                 entry["username"] = username or "未知"
             else:
                 entry["model"] = model or "未知"
-            logs[user_id].append(entry)
-        
-        logs[user_id] = sorted(logs[user_id], key=lambda x: x.get("time", ""))
-        save_chat_logs(logs)
+        _append_chat_log_entry(user_id, entry)
     except Exception as e:
         print(f"log_message 出错: {e}")
 
 def clear_user_chat_logs(user_id, channel_only=None):
     try:
-        logs = load_chat_logs()
-        if user_id not in logs:
-            return
         if channel_only:
             channel_name = get_channel_name(channel_only)
-            logs[user_id] = [e for e in logs[user_id] if e.get("scene") != channel_name]
-        else:
-            logs[user_id] = []
-        save_chat_logs(logs)
+            _append_chat_log_entry(user_id, {"type": "tombstone", "time": get_timestamp(), "scene": channel_name})
+            return
+        with _get_chat_log_lock(user_id):
+            index = _load_chat_log_index(user_id)
+            if not index["segments"]:
+                return
+            for seg in index["segments"]:
+                storage.delete_key("chat_logs", _chat_log_key(user_id, seg["name"]))
+            _chat_log_stats["segments_dropped"] += len(index["segments"])
+            index["segments"] = []
+            _chat_log_active[user_id] = []
+            storage.save_key("chat_logs", _chat_log_key(user_id, "index"), index)
     except Exception as e:
         print(f"clear_user_chat_logs 出错: {e}")
 
 # ========== AI 积分系统 ==========
+# 一条消息里的扣分/加分先记在 AiPointsLedger 里（按消息开始时的积分推演，决定是否返工），
+# 消息处理完在用户锁内一次提交：读最新积分、按顺序重放这批事件、写回积分，再把事件追加到历史里。
+# 事件历史不放在用户记录里（load_user/save_user 每条消息都要走），单独存在 ai_points_log 文档里，key 为 user_id：
+# {"base": 第一条事件之前的积分, "events": [[时间, "+"/"-", 之后积分, 原因], ...]}，
+# 超过 AI_POINTS_LOG_MAX 条时把最旧的折进 base，replay_ai_points 可以从 base 重算校验。
+# 旧版本存在 user["ai_points_log"] 里的历史在下一次提交时搬过去。
+AI_POINTS_LOG_MAX = int(os.environ.get("AI_POINTS_LOG_MAX", 200))
+
+_ai_points_stats = {"commits": 0, "events": 0, "reworks": 0, "stale_starts": 0}
+_ai_points_stats_lock = threading.Lock()
 
 def get_ai_points(user_id):
-    all_data = load_user_data()
-    return all_data.get(user_id, {}).get("ai_points", AI_POINTS_DEFAULT)
-
-def set_ai_points(user_id, points):
-    points = max(AI_POINTS_MIN, min(AI_POINTS_MAX, points))
-    all_data = load_user_data()
-    if user_id not in all_data:
-        all_data[user_id] = {}
-    old_points = all_data[user_id].get("ai_points", AI_POINTS_DEFAULT)
-    all_data[user_id]["ai_points"] = points
-    save_user_data(all_data)
-    return old_points, points
-
-def deduct_ai_points(user_id, reason=""):
-    current = get_ai_points(user_id)
-    if current <= AI_POINTS_MIN:
-        print(f"[AI积分] 用户 {user_id} 已经是最低分 {AI_POINTS_MIN}，无法再扣")
-        return current, current, True  # 返回 True 表示需要返工
-    
-    deduct = 2 if current > 0 else 5
-    old, new = set_ai_points(user_id, current - deduct)
-    print(f"[AI积分] 用户 {user_id} 扣分: {old} -> {new} (扣{deduct}), 原因: {reason}")
-    return old, new, False
-
-def reward_ai_points(user_id):
-    current = get_ai_points(user_id)
-    if current < AI_POINTS_MAX:
-        old, new = set_ai_points(user_id, current + 1)
-        print(f"[AI积分] 用户 {user_id} 加分: {old} -> {new}")
-        return old, new
-    return current, current
-
-def get_ai_points_status(user_id):
-    """获取积分状态和对应的提示信息"""
-    points = get_ai_points(user_id)
+    return load_user(user_id).get("ai_points", AI_POINTS_DEFAULT)
+
+def apply_ai_points_event(points, kind):
+    """按规则算一次变动，kind 为 "-"（扣分）或 "+"（加分），返回 (新积分, 是否需要返工)"""
+    if kind == "-":
+        if points <= AI_POINTS_MIN:
+            return points, True
+        return max(AI_POINTS_MIN, points - (2 if points > 0 else 5)), False
+    return min(AI_POINTS_MAX, points + 1), False
+
+def replay_ai_points(user, log):
+    """从事件历史重算积分，返回 (重算结果, 和记录对不上的事件数)"""
+    if not log:
+        return user.get("ai_points", AI_POINTS_DEFAULT), 0
+    points, mismatches = log["base"], 0
+    for _, kind, after, _ in log["events"]:
+        points, _ = apply_ai_points_event(points, kind)
+        if points != after:
+            mismatches += 1
+            points = after
+    if points != user.get("ai_points", AI_POINTS_DEFAULT):
+        mismatches += 1
+    return points, mismatches
+
+class AiPointsLedger:
+    """一条消息内的积分账本：deduct/reward 只改内存，commit 一次写入"""
+
+    def __init__(self, user_id, points=None):
+        self.user_id = user_id
+        self.start = get_ai_points(user_id) if points is None else points
+        self.points = self.start
+        self.events = []
+
+    def deduct(self, reason=""):
+        old = self.points
+        self.points, rework = apply_ai_points_event(old, "-")
+        self.events.append(("-", reason))
+        if rework:
+            print(f"[AI积分] 用户 {self.user_id} 已经是最低分 {AI_POINTS_MIN}，无法再扣")
+        else:
+            print(f"[AI积分] 用户 {self.user_id} 扣分: {old} -> {self.points} (扣{old - self.points}), 原因: {reason}")
+        return old, self.points, rework  # rework 为 True 表示需要返工
+
+    def reward(self):
+        old = self.points
+        if old >= AI_POINTS_MAX:
+            return old, old
+        self.points, _ = apply_ai_points_event(old, "+")
+        self.events.append(("+", ""))
+        print(f"[AI积分] 用户 {self.user_id} 加分: {old} -> {self.points}")
+        return old, self.points
+
+    def commit(self):
+        """在用户锁内按最新积分重放事件并写回，返回提交后的积分"""
+        if not self.events:
+            return self.points
+        events, self.events = self.events, []
+        now = int(time.time())
+
+        def apply(user):
+            points = user.get("ai_points", AI_POINTS_DEFAULT)
+            stale = points != self.start
+            legacy = user.pop("ai_points_log", None)
+            log = legacy or storage.load_key("ai_points_log", self.user_id) or {"base": points, "events": []}
+            reworks = 0
+            for kind, reason in events:
+                points, rework = apply_ai_points_event(points, kind)
+                reworks += rework
+                log["events"].append([now, kind, points, reason])
+            overflow = len(log["events"]) - AI_POINTS_LOG_MAX
+            if overflow > 0:
+                log["base"] = log["events"][overflow - 1][2]
+                del log["events"][:overflow]
+            user["ai_points"] = points
+            # 在用户锁内写，同一用户的两次提交不会把历史写乱序
+            storage.save_key("ai_points_log", self.user_id, log)
+            return points, stale, reworks
+
+        self.points, stale, reworks = update_user(self.user_id, apply)
+        self.start = self.points
+        with _ai_points_stats_lock:
+            _ai_points_stats["commits"] += 1
+            _ai_points_stats["events"] += len(events)
+            _ai_points_stats["reworks"] += reworks
+            _ai_points_stats["stale_starts"] += stale
+        if stale:
+            print(f"[AI积分] 用户 {self.user_id} 积分在本条消息期间被改过，已按最新值重放: -> {self.points}")
+        return self.points
+
+def get_ai_points_stats():
+    with _ai_points_stats_lock:
+        return dict(_ai_points_stats)
+
+def get_ai_points_status(user_id, points=None):
+    """获取积分状态和对应的提示信息；已经拿到用户记录的调用方可以直接传 points"""
+    if points is None:
+        points = get_ai_points(user_id)
     
     if points <= AI_POINTS_MIN:
         return points, "min", f"""
@@ -624,54 +1762,137 @@ def get_ai_points_status(user_id):
     else:
         return points, "ok", f"当前积分: {points}/{AI_POINTS_MAX}"
 
-def estimate_tokens(text):
+# ========== Token 估算 ==========
+# 文本按 中日韩字符 / 代码 / 其他 三类计字数，各乘基础系数（1/1.5, 1/3, 1/3）再乘每个 API 的校正系数。
+# 校正系数用 call_ai 返回的 usage.prompt_tokens 在线拟合（归一化 LMS），持久化到 TOKEN_CALIBRATION_PATH。
+TOKEN_CALIBRATION_PATH = os.environ.get("TOKEN_CALIBRATION_PATH", "token_calibration.json")
+TOKEN_BASE_RATES = [1 / 1.5, 1 / 3.0, 1 / 3.0]  # cjk, latin, code
+TOKEN_FACTOR_MIN, TOKEN_FACTOR_MAX = 0.25, 4.0
+TOKEN_FIT_RATE = 0.3
+TOKEN_MSG_OVERHEAD = 4  # 每条消息的角色/分隔符开销
+HISTORY_BUDGET_RATIO = float(os.environ.get("HISTORY_BUDGET_RATIO", 0.7))  # 历史占模型上下文的比例
+
+_CODE_RE = re.compile(r'```.*?```|`[^`\n]+`', re.DOTALL)
+_CJK_RE = re.compile(r'[\u4e00-\u9fff]')
+
+_token_calibration = {}  # {api_name: {"factors": [...], "samples", "mape", "bias", "last_error"}}
+_token_calibration_lock = threading.Lock()
+_token_calibration_saved_at = 0.0
+
+def _load_token_calibration():
+    if os.path.exists(TOKEN_CALIBRATION_PATH):
+        try:
+            with open(TOKEN_CALIBRATION_PATH, encoding="utf-8") as f:
+                _token_calibration.update(json.load(f))
+        except Exception as e:
+            print(f"[Tokens] 读取校正系数失败: {e}")
+
+def save_token_calibration():
+    global _token_calibration_saved_at
+    with _token_calibration_lock:
+        data = json.dumps(_token_calibration, ensure_ascii=False)
+        _token_calibration_saved_at = time.time()
+    try:
+        tmp = TOKEN_CALIBRATION_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, TOKEN_CALIBRATION_PATH)
+    except Exception as e:
+        print(f"[Tokens] 保存校正系数失败: {e}")
+
+def token_features(text):
+    """返回 [中日韩字数, 其他字数, 代码字数]"""
+    if not text:
+        return [0, 0, 0]
+    text = str(text)
+    code = sum(len(m) for m in _CODE_RE.findall(text))
+    if code:
+        text = _CODE_RE.sub("", text)
+    cjk = len(_CJK_RE.findall(text))
+    return [cjk, len(text) - cjk, code]
+
+def _token_factors(api_name):
+    entry = _token_calibration.get(api_name) if api_name else None
+    return entry["factors"] if entry else [1.0, 1.0, 1.0]
+
+def tokens_from_features(features, api_name=None):
+    factors = _token_factors(api_name)
+    return int(sum(x * r * f for x, r, f in zip(features, TOKEN_BASE_RATES, factors)))
+
+def estimate_tokens(text, api_name=None):
     if not text:
         return 0
-    chinese = len(re.findall(r'[\u4e00-\u9fff]', str(text)))
-    other = len(str(text)) - chinese
-    return int(chinese / 1.5 + other / 3.0)
-
-def build_review_context(user, current_channel, user_message, ai_reply, msg_count):
-    """构建用于审查的上下文，限制在 REVIEW_TOKEN_LIMIT 内"""
-    context_parts = []
-    
-    # 收集所有历史消息
-    all_messages = []
-    
-    # 私聊历史
-    if "dm_history" in user: # Ensure dm_history exists
-        for m in user.get("dm_history", []):
-            if m.get("content"):
-                all_messages.append({
-                    "content": f"[私聊][{'用户' if m['role']=='user' else 'AI'}] {m['content']}",
-                    "timestamp": m.get("timestamp", 0)
-                })
-    
-    # 频道历史
-    if not is_dm_channel(current_channel):
-        reset_time = user.get("channel_reset_times", {}).get(current_channel, 0)
-        channel_msgs = get_channel_messages_since_reset(current_channel, reset_time)
-        for m in channel_msgs:
-            sender = "AI" if m.get("is_bot") else m.get("username", "某人")
-            all_messages.append({
-                "content": f"[频道][{sender}] {m.get('content', '')}",
-                "timestamp": m.get("timestamp", 0)
-            })
-    
-    # 按时间排序
-    all_messages.sort(key=lambda x: x["timestamp"])
-    
-    # 计算 token 并删除旧消息
-    total_tokens = 0
-    for m in all_messages:
-        total_tokens += estimate_tokens(m["content"])
-    
-    while total_tokens > REVIEW_TOKEN_LIMIT and all_messages:
-        removed = all_messages.pop(0)
-        total_tokens -= estimate_tokens(removed["content"])
-    
-    context = "\n".join([m["content"] for m in all_messages])
-    return context
+    return tokens_from_features(token_features(text), api_name)
+
+def message_tokens(m, api_name=None):
+    """存储的消息在写入时带上 token_features；旧数据没有的话现算一次并记在消息上"""
+    features = m.get("token_features")
+    if features is None:
+        features = token_features(m.get("content"))
+        m["token_features"] = features
+    return tokens_from_features(features, api_name)
+
+def record_prompt_usage(api_name, messages, usage):
+    """用 API 实际返回的 prompt_tokens 校正该 API 的系数（带图片的请求不参与）"""
+    prompt_tokens = (usage or {}).get("prompt_tokens")
+    if not prompt_tokens or api_name not in APIS:
+        return
+    totals = [0, 0, 0]
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, list):
+            if any(part.get("type") != "text" for part in content):
+                return
+            content = "".join(part.get("text", "") for part in content)
+        for i, x in enumerate(token_features(content)):
+            totals[i] += x
+    z = [x * r for x, r in zip(totals, TOKEN_BASE_RATES)]
+    norm = sum(v * v for v in z)
+    if not norm:
+        return
+    target = prompt_tokens - TOKEN_MSG_OVERHEAD * len(messages)
+    with _token_calibration_lock:
+        entry = _token_calibration.setdefault(api_name, {"factors": [1.0, 1.0, 1.0], "samples": 0,
+                                                         "mape": 0.0, "bias": 0.0, "last_error": 0.0})
+        factors = entry["factors"]
+        predicted = sum(f * v for f, v in zip(factors, z))
+        err = target - predicted
+        # 先记录拟合前的误差，反映的是实际用来做预算的那套系数的准确度
+        rel = (predicted + TOKEN_MSG_OVERHEAD * len(messages) - prompt_tokens) / prompt_tokens
+        alpha = 1 / (entry["samples"] + 1) if entry["samples"] < 20 else 0.05
+        entry["mape"] += alpha * (abs(rel) - entry["mape"])
+        entry["bias"] += alpha * (rel - entry["bias"])
+        entry["last_error"] = round(rel, 4)
+        entry["samples"] += 1
+        for i in range(3):
+            factors[i] = min(TOKEN_FACTOR_MAX, max(TOKEN_FACTOR_MIN, factors[i] + TOKEN_FIT_RATE * err * z[i] / norm))
+        should_save = time.time() - _token_calibration_saved_at > 60
+    if should_save:
+        save_token_calibration()
+
+def get_token_calibration_stats():
+    with _token_calibration_lock:
+        return {api_name: {"factors": [round(f, 3) for f in e["factors"]], "samples": e["samples"],
+                           "mape": round(e["mape"], 4), "bias": round(e["bias"], 4),
+                           "last_error": e["last_error"]}
+                for api_name, e in _token_calibration.items()}
+
+_load_token_calibration()
+
+def trim_oldest(msgs, tokens, budget):
+    """从最旧的开始丢，直到剩下的 token 总和不超过 budget。
+    用前缀和 + 二分找切点，返回 (剩下的消息, 剩下的 token 数)"""
+    prefix = list(itertools.accumulate(tokens, initial=0))
+    total = prefix[-1]
+    if total <= budget:
+        return msgs, total
+    cut = bisect.bisect_left(prefix, total - budget)
+    return msgs[cut:], total - prefix[cut] if cut < len(prefix) else 0
+
+def build_review_context(history, history_tokens):
+    """把 build_history_messages 已经拼好的历史渲染成审查用的聊天记录，限制在 REVIEW_TOKEN_LIMIT 内"""
+    history, _ = trim_oldest(history, history_tokens, REVIEW_TOKEN_LIMIT)
+    return "\n".join(f"[{'用户' if m['role'] == 'user' else 'AI'}] {m['content']}" for m in history)
 
 def check_reply_format_violation(reply):
     """检查分点列举（直接扣分不审查）"""
@@ -691,17 +1912,30 @@ def check_messages_too_long(messages):
             return True, msg, len(msg)
     return False, None, 0
 
-def review_with_ai(user, current_channel, user_message, ai_reply, msg_count, issue_type, details=""):
-    """用第三方 sonnet 审查，带完整上下文"""
-    try:
-        api = APIS["第三方sonnet"]
-        
-        # 构建上下文
-        context = build_review_context(user, current_channel, user_message, ai_reply, msg_count)
-        
-        if issue_type == "count":
-            reply_count = len([m.strip() for m in ai_reply.split("|||") if m.strip()]) if "|||" in ai_reply else 1
-            prompt = f"""你是一个审查员，需要判断 AI 的回复是否合理。
+REVIEW_CRITERIA = {
+    "length": lambda msg_count, details: (
+        f"AI 有一条回复长度为 {details} 字（超过了 50 字限制）。",
+        "单条消息超过 50 字，且用户的问题并不需要长篇回复。"),
+    "count": lambda msg_count, details: (
+        f"AI 回复了 {details} 条消息。",
+        f"AI 回复条数超过用户消息数的 3 倍（即超过 {msg_count * 3} 条），且用户的问题并不复杂，也没有要求 AI 回复多条。"),
+}
+REVIEW_ANSWER_RE = re.compile(r'(\d+)\s*[:：.、]\s*(不合理|合理)')
+
+def _review_prompt(context, user_message, ai_reply, msg_count, issues):
+    """issues: [(类型, 细节)]；一个问题时只要求回答合理/不合理，多个时逐条编号回答"""
+    numbered = len(issues) > 1
+    lines = []
+    for n, (issue_type, details) in enumerate(issues, 1):
+        situation, rule = REVIEW_CRITERIA[issue_type](msg_count, details)
+        prefix = f"{n}. " if numbered else ""
+        lines.append(f"{prefix}{situation}\n\"不合理\"的定义：{rule}")
+    if numbered:
+        ask = '请根据聊天记录和当前情况逐条判断，每个问题一行，格式为"编号: 合理"或"编号: 不合理"，不要输出别的内容。'
+    else:
+        ask = '请根据聊天记录和当前情况判断。\n只回答"合理"或"不合理"。'
+    issues_text = "\n\n".join(lines)
+    return f"""你是一个审查员，需要判断 AI 的回复是否合理。
 
 === 聊天记录 ===
 {context}
@@ -710,59 +1944,104 @@ def review_with_ai(user, current_channel, user_message, ai_reply, msg_count, iss
 用户发了 {msg_count} 条消息：
 {user_message}
 
-AI 回复了 {reply_count} 条消息。
-
-=== 判断标准 ===
-"不合理"的定义：AI 回复条数超过用户消息数的 3 倍（即超过 {msg_count * 3} 条），且用户的问题并不复杂，也没有要求 AI 回复多条。
+AI 的回复：
+{ai_reply}
 
-请根据聊天记录和当前情况，判断 AI 回复 {reply_count} 条是否合理。
-只回答"合理"或"不合理"。"""
+=== 需要判断的问题 ===
+{issues_text}
 
-        elif issue_type == "length":
-            prompt = f"""你是一个审查员，需要判断 AI 的回复是否合理。
+{ask}"""
 
-=== 聊天记录 ===
-{context}
-
-=== 当前情况 ===
-用户发了 {msg_count} 条消息：
-{user_message}
-
-AI 有一条回复长度为 {details} 字（超过了 50 字限制）。
-
-=== 判断标准 ===
-"不合理"的定义：单条消息超过 50 字，且用户的问题并不需要长篇回复。
-
-请根据聊天记录和当前情况，判断这条长消息是否合理。
-只回答"合理"或"不合理"。"""
-        else:
-            return True
-        
-        resp = requests.post(
-            api["url"],
+def _call_reviewer(prompt):
+    api = APIS[REVIEW_API]
+    gate = provider_gate(REVIEW_API)
+    try:
+        probe = gate.acquire()
+    except ProviderUnavailable as e:
+        print(f"[AI审查] 跳过: {e}")
+        return None
+    outcome = "error"
+    try:
+        resp = http_post(
+            "ai", api["url"],
             headers={"Authorization": f"Bearer {api['key']}", "Content-Type": "application/json"},
             json={"model": api["model"], "messages": [{"role": "user", "content": prompt}]},
             timeout=60
         )
-        
         result = resp.json()
         if "choices" in result:
-            answer = result["choices"][0]["message"]["content"].strip()
-            print(f"[AI审查] 类型: {issue_type}, 用户消息数: {msg_count}, 结果: {answer}")
-            return "合理" in answer
-        else:
-            print(f"[AI审查] API 返回无 choices: {result.get('error')}")
+            outcome = "ok"
+            return result["choices"][0]["message"]["content"].strip()
+        print(f"[AI审查] API 返回无 choices: {result.get('error')}")
+        err = str(result.get("error", "")).lower()
+        if resp.status_code < 500 and not any(x in err for x in ["upstream", "timeout", "do_request"]):
+            outcome = "client_error"
+        return None
+    except requests.exceptions.Timeout:
+        outcome = "timeout"
+        raise
+    finally:
+        gate.release(outcome, probe)
+
+def _review_single(context, user_message, ai_reply, msg_count, issue):
+    try:
+        answer = _call_reviewer(_review_prompt(context, user_message, ai_reply, msg_count, [issue]))
     except Exception as e:
         print(f"[AI审查] 出错: {e}")
-    
-    return True  # 出错默认合理
-
-def evaluate_ai_response(user_id, user, current_channel, user_message, reply, msg_count):
+        return True
+    if answer is None:
+        return True  # 出错默认合理
+    print(f"[AI审查] 类型: {issue[0]}, 用户消息数: {msg_count}, 结果: {answer}")
+    return "不合理" not in answer
+
+def review_with_ai(history, history_tokens, user_message, ai_reply, msg_count, issues):
+    """一次请求审查所有被标记的问题，返回 {类型: 是否合理}。
+    合并回答里缺了某条的话，剩下的各自单独问，并发进行，总共最多多一轮往返"""
+    if not issues:
+        return {}
+    context = build_review_context(history, history_tokens)
+    verdicts = {}
+    if len(issues) > 1:
+        try:
+            answer = _call_reviewer(_review_prompt(context, user_message, ai_reply, msg_count, issues))
+        except Exception as e:
+            print(f"[AI审查] 出错: {e}")
+            answer = None
+        if answer is not None:
+            print(f"[AI审查] 合并审查 {[t for t, _ in issues]}, 用户消息数: {msg_count}, 结果: {answer}")
+            for n, verdict in REVIEW_ANSWER_RE.findall(answer):
+                if 1 <= int(n) <= len(issues):
+                    verdicts[issues[int(n) - 1][0]] = verdict == "合理"
+        else:
+            for issue_type, _ in issues:
+                verdicts[issue_type] = True  # 出错默认合理
+    remaining = [issue for issue in issues if issue[0] not in verdicts]
+    if len(remaining) == 1:
+        verdicts[remaining[0][0]] = _review_single(context, user_message, ai_reply, msg_count, remaining[0])
+    elif remaining:
+        with ThreadPoolExecutor(max_workers=len(remaining)) as pool:
+            futures = {issue[0]: pool.submit(_review_single, context, user_message, ai_reply, msg_count, issue)
+                       for issue in remaining}
+            verdicts.update({issue_type: fut.result() for issue_type, fut in futures.items()})
+    return verdicts
+
+def evaluate_ai_response(user_id, user, current_channel, user_message, reply, msg_count,
+                         history=None, history_tokens=None, ledger=None):
     """
     评估 AI 回复，返回 (violations, need_rework)
     violations: 违规列表
     need_rework: 是否需要返工
+    history / history_tokens: 生成回复时 build_history_messages 拼好的历史，审查直接复用
+    ledger: 本条消息的积分账本，由调用方统一提交；不传则评估完立刻提交
     """
+    if ledger is None:
+        ledger = AiPointsLedger(user_id, user.get("ai_points") if user else None)
+        try:
+            return evaluate_ai_response(user_id, user, current_channel, user_message, reply, msg_count,
+                                        history, history_tokens, ledger)
+        finally:
+            ledger.commit()
+
     print(f"[Debug] evaluate_ai_response 被调用: user_id={user_id}, msg_count={msg_count}")
     messages = [m.strip() for m in reply.split("|||") if m.strip()] if "|||" in reply else [reply.strip()]
     reply_count = len(messages)
@@ -773,79 +2052,244 @@ def evaluate_ai_response(user_id, user, current_channel, user_message, reply, ms
     # 1. 检查分点列举（直接扣分）
     has_list, list_reason = check_reply_format_violation(reply)
     if has_list:
-        old, new, rework = deduct_ai_points(user_id, list_reason)
+        old, new, rework = ledger.deduct(list_reason)
         violations.append(f"分点列举: {list_reason}")
         if rework:
             need_rework = True
     
-    # 2. 检查消息过长（审查）
+    # 2. 检查消息过长、回复条数（合并成一次审查）
     is_long, long_msg, length = check_messages_too_long(messages)
+    issues = []
     if is_long:
-        if not review_with_ai(user, current_channel, user_message, reply, msg_count, "length", str(length)):
-            old, new, rework = deduct_ai_points(user_id, f"消息过长: {length}字")
+        issues.append(("length", length))
+    if reply_count > msg_count * 3:
+        issues.append(("count", reply_count))
+    verdicts = {}
+    if issues:
+        if history is None:
+            history, history_tokens = build_history_messages(user, current_channel, REVIEW_API, with_tokens=True)
+        verdicts = review_with_ai(history, history_tokens, user_message, reply, msg_count, issues)
+
+    if is_long:
+        if not verdicts.get("length", True):
+            old, new, rework = ledger.deduct(f"消息过长: {length}字")
             violations.append(f"消息过长: {length}字")
             if rework:
                 need_rework = True
     
-    # 3. 检查回复条数（审查）
+    # 3. 回复条数的审查结果
     if reply_count > msg_count * 3:
-        if not review_with_ai(user, current_channel, user_message, reply, msg_count, "count"):
-            old, new, rework = deduct_ai_points(user_id, f"回复过多: {reply_count}条")
+        if not verdicts.get("count", True):
+            old, new, rework = ledger.deduct(f"回复过多: {reply_count}条")
             violations.append(f"回复过多: {reply_count}条")
             if rework:
                 need_rework = True
     
     # 4. 没有违规就加分
     if not violations:
-        reward_ai_points(user_id)
+        ledger.reward()
     
     return violations, need_rework
 
 # ========== 频道和记忆工具 ==========
 
-def get_all_channels():
-    try:
-        resp = requests.get(
-            "https://slack.com/api/conversations.list",
+# ========== 频道目录 ==========
+# 内存里维护 {channel_id: 频道信息}：conversations.list 带 cursor 分页全量拉取，
+# 后台定时刷新，并由 channel_created / channel_rename / member_joined_channel /
+# member_left_channel 等事件增量更新。成员列表按需拉取后也存在这里，超过 CHANNEL_MEMBERS_RESYNC 秒
+# 下次用到时重新拉一次（漏掉的事件不会一直错下去）。刷新失败后按指数退避，期间不再现场翻 conversations.list。
+CHANNEL_DIRECTORY_REFRESH = int(os.environ.get("CHANNEL_DIRECTORY_REFRESH", 600))
+CHANNEL_DIRECTORY_RETRY_MIN = float(os.environ.get("CHANNEL_DIRECTORY_RETRY_MIN", 5))
+CHANNEL_MEMBERS_RESYNC = int(os.environ.get("CHANNEL_MEMBERS_RESYNC", 3600))
+
+_channel_index = {}  # {channel_id: {"id", "name", "is_member", "members", "members_at"}}
+_channel_index_lock = threading.Lock()
+_channel_directory_loaded = threading.Event()
+_channel_refresh_lock = threading.Lock()
+_channel_refresh_retry_at = 0.0  # 上次失败后，这个时间之前不再现场刷新
+_channel_refresh_backoff = 0.0
+_channel_directory_stats = {"refreshes": 0, "refresh_errors": 0, "refresh_skipped": 0, "events": 0,
+                            "info_lookups": 0, "member_fetches": 0, "member_resyncs": 0, "version": 0}
+_bot_user_id = None
+
+CHANNEL_DIRECTORY_EVENTS = [
+    "channel_created", "channel_rename", "channel_deleted", "channel_archive",
+    "group_rename", "group_archive", "group_deleted",
+    "member_joined_channel", "member_left_channel",
+]
+
+def _slack_paginate(method, key, params):
+    """按 cursor 翻完 Slack 的分页接口，返回合并后的 key 列表；失败返回 None"""
+    items, cursor = [], None
+    while True:
+        page_params = dict(params, limit=200)
+        if cursor:
+            page_params["cursor"] = cursor
+        resp = http_get(
+            "slack", f"https://slack.com/api/{method}",
             headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
-            params={"types": "public_channel,private_channel", "limit": 200}
+            params=page_params
         )
         result = resp.json()
-        if result.get("ok"):
-            return [{"id": ch["id"], "name": ch["name"], "is_member": ch.get("is_member", False)} 
-                    for ch in result.get("channels", [])]
-    except:
-        pass
-    return []
+        if not result.get("ok"):
+            print(f"[Slack] {method} 失败: {result.get('error')}")
+            return None
+        items.extend(result.get(key, []))
+        cursor = result.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return items
+
+def _bump_channel_directory_version():
+    _channel_directory_stats["version"] += 1
+
+def get_bot_user_id():
+    global _bot_user_id
+    if _bot_user_id is None:
+        try:
+            resp = http_post(
+                "slack", "https://slack.com/api/auth.test",
+                headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}
+            )
+            _bot_user_id = resp.json().get("user_id")
+        except Exception as e:
+            print(f"[ChannelDir] auth.test 出错: {e}")
+    return _bot_user_id
+
+def refresh_channel_directory():
+    global _channel_refresh_retry_at, _channel_refresh_backoff
+    with _channel_refresh_lock:
+        try:
+            channels = _slack_paginate("conversations.list", "channels",
+                                       {"types": "public_channel,private_channel", "exclude_archived": "true"})
+        except Exception as e:
+            channels = None
+            print(f"[ChannelDir] 刷新出错: {e}")
+        if channels is None:
+            _channel_refresh_backoff = min(max(_channel_refresh_backoff * 2, CHANNEL_DIRECTORY_RETRY_MIN),
+                                           CHANNEL_DIRECTORY_REFRESH)
+            _channel_refresh_retry_at = time.time() + _channel_refresh_backoff
+            _channel_directory_stats["refresh_errors"] += 1
+            return False
+        _channel_refresh_backoff = 0.0
+        _channel_refresh_retry_at = 0.0
+    with _channel_index_lock:
+        old = dict(_channel_index)
+        _channel_index.clear()
+        for ch in channels:
+            prev = old.get(ch["id"], {})
+            _channel_index[ch["id"]] = {
+                "id": ch["id"], "name": ch["name"], "is_member": ch.get("is_member", False),
+                # 成员列表由事件维护，刷新时保留
+                "members": prev.get("members"), "members_at": prev.get("members_at", 0),
+            }
+        _channel_directory_stats["refreshes"] += 1
+        # 频道名和 bot 是否在频道里都没变就不动版本号，拼好的频道列表 / 场景说明继续有效
+        if ({cid: (ch["name"], ch["is_member"]) for cid, ch in old.items()}
+                != {cid: (ch["name"], ch["is_member"]) for cid, ch in _channel_index.items()}):
+            _bump_channel_directory_version()
+    _channel_directory_loaded.set()
+    print(f"[ChannelDir] 已加载 {len(channels)} 个频道")
+    return True
+
+def _ensure_channel_directory():
+    """还没加载成功时现场刷新一次；上次失败还在退避期、或者别的线程正在刷新时直接用现有的（可能为空）"""
+    if _channel_directory_loaded.is_set():
+        return
+    if time.time() < _channel_refresh_retry_at or _channel_refresh_lock.locked():
+        _channel_directory_stats["refresh_skipped"] += 1
+        return
+    refresh_channel_directory()
+
+def _run_channel_directory_refresher():
+    get_bot_user_id()
+    while True:
+        refresh_channel_directory()
+        time.sleep(CHANNEL_DIRECTORY_REFRESH)
+
+def handle_channel_event(event):
+    """用频道相关事件增量更新目录"""
+    etype = event.get("type")
+    with _channel_index_lock:
+        _channel_directory_stats["events"] += 1
+        if etype in ["channel_created", "channel_rename", "group_rename"]:
+            ch = event.get("channel", {})
+            entry = _channel_index.setdefault(ch["id"], {"id": ch["id"], "name": ch["name"],
+                                                         "is_member": False, "members": None, "members_at": 0})
+            entry["name"] = ch["name"]
+        elif etype in ["channel_deleted", "channel_archive", "group_archive", "group_deleted"]:
+            _channel_index.pop(event.get("channel"), None)
+        elif etype in ["member_joined_channel", "member_left_channel"]:
+            entry = _channel_index.get(event.get("channel"))
+            if entry is None:
+                return
+            user_id = event.get("user")
+            joined = etype == "member_joined_channel"
+            if user_id == _bot_user_id:
+                entry["is_member"] = joined
+            if entry["members"] is not None:
+                if joined and user_id not in entry["members"]:
+                    entry["members"].append(user_id)
+                elif not joined and user_id in entry["members"]:
+                    entry["members"].remove(user_id)
+        else:
+            return
+        _bump_channel_directory_version()
+
+def get_channel_directory_stats():
+    with _channel_index_lock:
+        return dict(_channel_directory_stats, channels=len(_channel_index),
+                    member_lists=sum(1 for ch in _channel_index.values() if ch["members"] is not None))
+
+def get_all_channels():
+    _ensure_channel_directory()
+    with _channel_index_lock:
+        return [{"id": ch["id"], "name": ch["name"], "is_member": ch["is_member"]}
+                for ch in _channel_index.values()]
 
 def get_channel_list_for_ai():
+    """按目录版本缓存，目录有变化（刷新或事件）才重新拼"""
+    global _channel_list_cache
+    version = _channel_directory_stats["version"]
+    cached = _channel_list_cache
+    if cached and cached[0] == version and _channel_directory_loaded.is_set():
+        _prompt_cache_stats["channel_list_hits"] += 1
+        return cached[1]
+    _prompt_cache_stats["channel_list_misses"] += 1
     channels = get_all_channels()
     member_channels = [ch for ch in channels if ch.get("is_member")]
-    return "、".join([f"#{ch['name']}" for ch in member_channels]) if member_channels else "（无）"
+    text = "、".join([f"#{ch['name']}" for ch in member_channels]) if member_channels else "（无）"
+    _channel_list_cache = (version, text)
+    return text
 
 def load_all_memories():
-    return jsonbin_load(JSONBIN_MEMORIES, {})
+    return storage.load_doc("memories")
 
 def save_all_memories(data):
-    jsonbin_save(JSONBIN_MEMORIES, data)
+    storage.save_doc("memories", data)
+    invalidate_memory_block()
 
 def load_memories(user_id):
-    return load_all_memories().get(user_id, [])
+    return storage.load_key("memories", user_id, [])
 
 def save_memories(user_id, memories):
-    all_mem = load_all_memories()
-    all_mem[user_id] = memories
-    save_all_memories(all_mem)
+    storage.save_key("memories", user_id, memories)
+    invalidate_memory_block(user_id)
 
-def add_memory(user_id, content):
+def add_memories(user_id, contents):
+    """一次读写追加多条记忆，超出 MEMORY_LIMIT 时从最旧的开始删"""
     memories = load_memories(user_id)
     total = sum(len(m["content"]) for m in memories)
-    while total + len(content) > MEMORY_LIMIT and memories:
-        removed = memories.pop(0)
-        total -= len(removed["content"])
-    memories.append({"content": content, "time": get_time_str()})
+    for content in contents:
+        while total + len(content) > MEMORY_LIMIT and memories:
+            removed = memories.pop(0)
+            total -= len(removed["content"])
+        memories.append({"content": content, "time": get_time_str()})
+        total += len(content)
     save_memories(user_id, memories)
 
+def add_memory(user_id, content):
+    add_memories(user_id, [content])
+
 def delete_memory(user_id, index):
     memories = load_memories(user_id)
     if 1 <= index <= len(memories):
@@ -864,26 +2308,105 @@ def format_memories(user_id, show_numbers=True):
     return "\n".join([f"{i}. {m['content']}" if show_numbers else f"• {m['content']}" 
                       for i, m in enumerate(memories, 1)])
 
+# 记忆索引：{user_id: 渲染好的 "• 内容" 文本}。第一次用时整库读一次、把所有用户渲染好；
+# 增删清记忆（都走 save_memories）时让该用户失效，下次只读这一个 key。
+# 每个用户有版本号，索引加载后版本没变、又不在索引里的用户就是没有记忆，不用再读。
+_memory_block_cache = {}
+_memory_block_versions = {}
+_memory_index_versions = None  # 整库加载时的版本快照；None 表示还没加载或已整体失效
+_memory_block_lock = threading.Lock()
+
+def _render_memory_block(memories):
+    return "\n".join(f"• {m['content']}" for m in memories)
+
+def invalidate_memory_block(user_id=None):
+    global _memory_index_versions
+    with _memory_block_lock:
+        if user_id is None:
+            _memory_block_cache.clear()
+            _memory_index_versions = None
+        else:
+            _memory_block_cache.pop(user_id, None)
+        _memory_block_versions[user_id] = _memory_block_versions.get(user_id, 0) + 1
+        _prompt_cache_stats["memory_invalidations"] += 1
+
+def load_memory_index():
+    """整库读一次，渲染所有用户的记忆块"""
+    global _memory_index_versions
+    with _memory_block_lock:
+        versions = dict(_memory_block_versions)
+    all_memories = load_all_memories()
+    rendered = {user_id: _render_memory_block(memories) for user_id, memories in all_memories.items()}
+    with _memory_block_lock:
+        if _memory_block_versions.get(None, 0) != versions.get(None, 0):
+            return  # 加载期间被整体失效了，下次再来
+        for user_id, text in rendered.items():
+            if _memory_block_versions.get(user_id, 0) == versions.get(user_id, 0):
+                _memory_block_cache[user_id] = text
+        _memory_index_versions = versions
+        _prompt_cache_stats["memory_index_loads"] += 1
+
+def get_memory_blocks(user_ids):
+    """批量取渲染好的记忆块 {user_id: 文本}，没有记忆的是空字符串"""
+    if _memory_index_versions is None:
+        load_memory_index()
+    result, missing = {}, []
+    with _memory_block_lock:
+        index_versions = _memory_index_versions
+        for user_id in user_ids:
+            text = _memory_block_cache.get(user_id)
+            if text is not None:
+                result[user_id] = text
+            elif index_versions is not None and \
+                    _memory_block_versions.get(user_id, 0) == index_versions.get(user_id, 0):
+                result[user_id] = ""  # 整库里就没有这个用户
+            else:
+                missing.append((user_id, _memory_block_versions.get(user_id, 0)))
+    _prompt_cache_stats["memory_hits"] += len(result)
+    _prompt_cache_stats["memory_misses"] += len(missing)
+    for user_id, version in missing:
+        text = _render_memory_block(load_memories(user_id))
+        with _memory_block_lock:
+            if _memory_block_versions.get(user_id, 0) == version:
+                _memory_block_cache[user_id] = text
+        result[user_id] = text
+    return result
+
+def get_memory_block(user_id):
+    """format_memories(user_id, show_numbers=False) 的缓存版本"""
+    return get_memory_blocks([user_id])[user_id]
+
 def get_channel_members(channel):
+    """优先用目录里的成员列表；没有或超过 CHANNEL_MEMBERS_RESYNC 秒就重新拉，拉失败时先用旧的"""
+    stale = None
+    with _channel_index_lock:
+        entry = _channel_index.get(channel)
+        if entry and entry["members"] is not None:
+            if time.time() - entry.get("members_at", 0) < CHANNEL_MEMBERS_RESYNC:
+                return list(entry["members"])
+            stale = list(entry["members"])
     try:
-        resp = requests.get(
-            "https://slack.com/api/conversations.members",
-            headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
-            params={"channel": channel}
-        )
-        result = resp.json()
-        return result.get("members", []) if result.get("ok") else []
-    except:
-        return []
+        members = _slack_paginate("conversations.members", "members", {"channel": channel})
+    except Exception:
+        members = None
+    if members is None:
+        return stale or []
+    with _channel_index_lock:
+        _channel_directory_stats["member_fetches"] += 1
+        if stale is not None:
+            _channel_directory_stats["member_resyncs"] += 1
+        entry = _channel_index.get(channel)
+        if entry is not None:
+            entry["members"] = list(members)
+            entry["members_at"] = time.time()
+    return members
 
 def get_all_memories_for_channel(channel):
     members = get_channel_members(channel)
-    parts = []
-    for member_id in members:
-        mem = format_memories(member_id, show_numbers=False)
-        if mem:
-            parts.append(f"【{get_display_name(member_id)}的记忆】\n{mem}")
-    return "\n\n".join(parts)
+    blocks = get_memory_blocks(members)
+    with_memories = [member_id for member_id in members if blocks[member_id]]
+    names = get_display_names(with_memories)
+    return "\n\n".join(f"【{names[member_id]}的记忆】\n{blocks[member_id]}" for member_id in with_memories)
 
 def is_dm_channel(channel):
     return channel.startswith("D")
@@ -891,15 +2414,27 @@ def is_dm_channel(channel):
 def get_channel_name(channel_id):
     if is_dm_channel(channel_id):
         return "私聊"
+    _ensure_channel_directory()
+    with _channel_index_lock:
+        entry = _channel_index.get(channel_id)
+        if entry:
+            return "#" + entry["name"]
     try:
-        resp = requests.get(
-            "https://slack.com/api/conversations.info",
+        resp = http_get(
+            "slack", "https://slack.com/api/conversations.info",
             headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
             params={"channel": channel_id}
         )
         result = resp.json()
         if result.get("ok"):
-            return "#" + result["channel"]["name"]
+            ch = result["channel"]
+            with _channel_index_lock:
+                _channel_directory_stats["info_lookups"] += 1
+                _channel_index[ch["id"]] = {"id": ch["id"], "name": ch["name"],
+                                            "is_member": ch.get("is_member", False), "members": None,
+                                            "members_at": 0}
+                _bump_channel_directory_version()
+            return "#" + ch["name"]
     except:
         pass
     return f"#{channel_id}"
@@ -919,9 +2454,7 @@ def get_channel_id_by_name(name):
 def should_include_dm_history(user_id, channel):
     if is_dm_channel(channel):
         return True
-    all_data = load_user_data()
-    user = all_data.get(user_id, {})
-    settings = user.get("channel_dm_settings", {})
+    settings = load_user(user_id).get("channel_dm_settings", {})
     if channel in settings:
         return settings[channel]
     if get_channel_name_only(channel).lower() in [c.lower() for c in NO_DM_HISTORY_CHANNELS]:
@@ -929,46 +2462,152 @@ def should_include_dm_history(user_id, channel):
     return True
 
 def set_channel_dm_setting(user_id, channel, include_dm):
-    all_data = load_user_data()
-    if user_id not in all_data:
-        all_data[user_id] = {}
-    if "channel_dm_settings" not in all_data[user_id]:
-        all_data[user_id]["channel_dm_settings"] = {}
-    all_data[user_id]["channel_dm_settings"][channel] = include_dm
-    save_user_data(all_data)
-
-def get_username(user_id):
+    def apply(user):
+        user.setdefault("channel_dm_settings", {})[channel] = include_dm
+    update_user(user_id, apply)
+
+# ========== 用户资料缓存 ==========
+# users.info 的结果按 TTL + LRU 缓存，启动时用 users.list 批量预热，
+# 收到 user_change / team_join 事件时直接用事件里的资料覆盖。
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 6 * 3600))
+USER_CACHE_MAX = int(os.environ.get("USER_CACHE_MAX", 5000))
+USER_LOOKUP_WORKERS = int(os.environ.get("USER_LOOKUP_WORKERS", 8))  # 批量解析名字时并发的 users.info 请求数
+
+_user_cache = OrderedDict()  # {user_id: (expires_at, profile)}
+_user_cache_lock = threading.Lock()
+_user_lookup_pool = None
+_user_cache_stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0,
+                     "invalidations": 0, "warmed": 0, "fetch_errors": 0}
+
+def _profile_from_slack(u):
+    return {"name": u.get("name") or u.get("id"),
+            "real_name": u.get("real_name") or u.get("profile", {}).get("real_name", "")}
+
+def _cache_user_profile(user_id, profile):
+    with _user_cache_lock:
+        _user_cache[user_id] = (time.time() + USER_CACHE_TTL, profile)
+        _user_cache.move_to_end(user_id)
+        while len(_user_cache) > USER_CACHE_MAX:
+            _user_cache.popitem(last=False)
+            _user_cache_stats["evictions"] += 1
+
+def get_cached_user_profile(user_id):
+    """只查缓存，不发请求；没有或过期返回 None"""
+    with _user_cache_lock:
+        item = _user_cache.get(user_id)
+        if item is None:
+            _user_cache_stats["misses"] += 1
+            return None
+        expires_at, profile = item
+        if expires_at < time.time():
+            del _user_cache[user_id]
+            _user_cache_stats["expired"] += 1
+            _user_cache_stats["misses"] += 1
+            return None
+        _user_cache.move_to_end(user_id)
+        _user_cache_stats["hits"] += 1
+        return profile
+
+def get_user_profile(user_id):
+    profile = get_cached_user_profile(user_id)
+    if profile is not None:
+        return profile
     try:
-        resp = requests.get(
-            "https://slack.com/api/users.info",
+        resp = http_get(
+            "slack", "https://slack.com/api/users.info",
             headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
             params={"user": user_id}
         )
         result = resp.json()
         if result.get("ok"):
-            return result["user"]["name"]
+            profile = _profile_from_slack(result["user"])
+            _cache_user_profile(user_id, profile)
+            return profile
     except:
         pass
-    return user_id
+    with _user_cache_lock:
+        _user_cache_stats["fetch_errors"] += 1
+    return None
 
-def get_display_name(user_id):
+def warm_user_cache():
+    """用 users.list 分页批量预热缓存"""
+    cursor, warmed = None, 0
     try:
-        resp = requests.get(
-            "https://slack.com/api/users.info",
-            headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
-            params={"user": user_id}
-        )
-        result = resp.json()
-        if result.get("ok"):
-            return result["user"]["real_name"] or result["user"]["name"]
-    except:
-        pass
+        while True:
+            params = {"limit": 200}
+            if cursor:
+                params["cursor"] = cursor
+            resp = http_get(
+                "slack", "https://slack.com/api/users.list",
+                headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
+                params=params
+            )
+            result = resp.json()
+            if not result.get("ok"):
+                print(f"[UserCache] users.list 失败: {result.get('error')}")
+                break
+            for u in result.get("members", []):
+                _cache_user_profile(u["id"], _profile_from_slack(u))
+                warmed += 1
+            cursor = result.get("response_metadata", {}).get("next_cursor")
+            # 再往后翻只会把刚预热的挤出 LRU
+            if not cursor or warmed >= USER_CACHE_MAX:
+                break
+    except Exception as e:
+        print(f"[UserCache] 预热出错: {e}")
+    with _user_cache_lock:
+        _user_cache_stats["warmed"] += warmed
+    print(f"[UserCache] 预热 {warmed} 个用户")
+    return warmed
+
+def handle_user_change(slack_user):
+    """user_change / team_join 事件：用事件里的最新资料覆盖缓存"""
+    user_id = slack_user.get("id")
+    if not user_id:
+        return
+    _cache_user_profile(user_id, _profile_from_slack(slack_user))
+    with _user_cache_lock:
+        _user_cache_stats["invalidations"] += 1
+
+def get_user_cache_stats():
+    with _user_cache_lock:
+        stats = dict(_user_cache_stats, size=len(_user_cache))
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    return stats
+
+def get_username(user_id):
+    profile = get_user_profile(user_id)
+    return profile["name"] if profile else user_id
+
+def get_display_name(user_id):
+    profile = get_user_profile(user_id)
+    if profile:
+        return profile["real_name"] or profile["name"]
     return user_id
 
+def _get_user_lookup_pool():
+    global _user_lookup_pool
+    with _user_cache_lock:
+        if _user_lookup_pool is None:
+            _user_lookup_pool = ThreadPoolExecutor(max_workers=USER_LOOKUP_WORKERS, thread_name_prefix="user-info")
+        return _user_lookup_pool
+
+def get_display_names(user_ids):
+    """批量解析显示名：先查缓存，缺的只对这些 ID 并发 users.info（不翻整个 users.list）"""
+    profiles = {user_id: get_cached_user_profile(user_id) for user_id in user_ids}
+    missing = [user_id for user_id, profile in profiles.items() if profile is None]
+    if len(missing) > 1:
+        profiles.update(zip(missing, _get_user_lookup_pool().map(get_user_profile, missing)))
+    elif missing:
+        profiles[missing[0]] = get_user_profile(missing[0])
+    return {user_id: (profile["real_name"] or profile["name"]) if profile else user_id
+            for user_id, profile in profiles.items()}
+
 def get_user_dm_channel(user_id):
     try:
-        resp = requests.post(
-            "https://slack.com/api/conversations.open",
+        resp = http_post(
+            "slack", "https://slack.com/api/conversations.open",
             headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}", "Content-Type": "application/json"},
             json={"users": user_id}
         )
@@ -986,67 +2625,57 @@ def check_and_use_points(user_id, api_name):
     if is_unlimited_user(user_id):
         return True, -1, None
     
-    cost = APIS.get(api_name, {}).get("cost", 1)
-    all_data = load_user_data()
-    user = all_data.get(user_id, {})
-    used = user.get("points_used", 0)
-    remaining = POINTS_LIMIT - used
-    
-    if remaining < cost:
-        return False, remaining, f"积分不足！剩余 {remaining}，需要 {cost}。"
-    
-    user["points_used"] = used + cost
-    all_data[user_id] = user
-    save_user_data(all_data)
+    cost = APIS.get(api_name, {}).get("cost", 1)
+    with _get_user_lock(user_id):
+        user = load_user(user_id)
+        used = user.get("points_used", 0)
+        remaining = POINTS_LIMIT - used
+        
+        if remaining < cost:
+            return False, remaining, f"积分不足！剩余 {remaining}，需要 {cost}。"
+        
+        user["points_used"] = used + cost
+        save_user(user_id, user)
     return True, POINTS_LIMIT - user["points_used"], None
 
 def is_in_conversation(user_id, channel):
-    all_data = load_user_data()
-    user = all_data.get(user_id, {})
-    last_active = user.get("channel_last_active", {}).get(channel, 0)
+    last_active = load_user(user_id).get("channel_last_active", {}).get(channel, 0)
     return (get_cn_time().timestamp() - last_active) < CONVERSATION_TIMEOUT
 
 def activate_channel_conversation(user_id, channel):
     """激活频道对话状态"""
-    all_data = load_user_data()
-    if user_id not in all_data:
-        all_data[user_id] = {}
-    if "channel_last_active" not in all_data[user_id]:
-        all_data[user_id]["channel_last_active"] = {}
-    all_data[user_id]["channel_last_active"][channel] = get_cn_time().timestamp()
-    save_user_data(all_data)
+    def apply(user):
+        user.setdefault("channel_last_active", {})[channel] = get_cn_time().timestamp()
+    update_user(user_id, apply)
     print(f"[Conversation] 激活用户 {user_id} 在频道 {channel} 的对话状态")
 
 # ========== 历史记录构建 ==========
 
-def build_history_messages(user, current_channel, api_name):
+def build_history_messages(user, current_channel, api_name, with_tokens=False):
+    """with_tokens=True 时返回 (消息列表, 每条的 token 数)，给审查复用"""
     max_tokens = API_TOKEN_LIMITS.get(api_name, 100000)
-    available = int(max_tokens * 0.7)
+    available = int(max_tokens * HISTORY_BUDGET_RATIO)
     
     current_is_dm = is_dm_channel(current_channel)
     user_id = user.get("user_id", "")
     include_dm = should_include_dm_history(user_id, current_channel)
     
-    all_msgs = []
-    
     # 私聊历史（限制在频道上下文中的token占比）
+    dm_msgs = []
     if include_dm or current_is_dm:
-        dm_msgs = []
         for m in user.get("dm_history", []):
             if m.get("content"):
                 dm_msgs.append({
                     "role": m["role"], "content": m["content"],
-                    "timestamp": m.get("timestamp", 0),
+                    "timestamp": m.get("timestamp", 0), "tokens": message_tokens(m, api_name),
                     "scene": "dm", "is_current": current_is_dm
                 })
         # 在频道上下文中，限制DM历史最多占MAX_DM_TOKENS_FOR_CHANNEL
         if not current_is_dm and dm_msgs:
-            dm_total = sum(estimate_tokens(m["content"]) for m in dm_msgs)
-            while dm_total > MAX_DM_TOKENS_FOR_CHANNEL and dm_msgs:
-                dm_total -= estimate_tokens(dm_msgs.pop(0)["content"])
-        all_msgs.extend(dm_msgs)
+            dm_msgs, _ = trim_oldest(dm_msgs, [m["tokens"] for m in dm_msgs], MAX_DM_TOKENS_FOR_CHANNEL)
     
     # 频道历史
+    ch_msgs = []
     if not current_is_dm:
         reset_time = user.get("channel_reset_times", {}).get(current_channel, 0)
         for m in get_channel_messages_since_reset(current_channel, reset_time):
@@ -1054,46 +2683,36 @@ def build_history_messages(user, current_channel, api_name):
             if not content:
                 continue
             
+            tokens = message_tokens(m, api_name)
             if m.get("is_bot"):
                 role, formatted = "assistant", content
             elif m.get("user_id") == user_id:
                 role, formatted = "user", content
             else:
-                role, formatted = "user", f"[{m.get('username', '某人')}说] {content}"
+                prefix = f"[{m.get('username', '某人')}说] "
+                role, formatted = "user", prefix + content
+                tokens += estimate_tokens(prefix, api_name)
             
-            all_msgs.append({
+            ch_msgs.append({
                 "role": role, "content": formatted,
-                "timestamp": m.get("timestamp", 0),
+                "timestamp": m.get("timestamp", 0), "tokens": tokens,
                 "scene": "channel", "is_current": True
             })
     
     # ========== 新截断策略：DM和频道完全分离，频道消息强制保留最近N条 ==========
-    dm_msgs = [m for m in all_msgs if m["scene"] == "dm"]
-    ch_msgs = [m for m in all_msgs if m["scene"] == "channel"]
-    
-    ch_total = sum(estimate_tokens(m["content"]) for m in ch_msgs)
-    dm_total = sum(estimate_tokens(m["content"]) for m in dm_msgs)
-    
     # 强制保留最近MIN_CHANNEL_MSGS_KEEP条频道消息，确保短期记忆完整
     ch_protected = ch_msgs[-MIN_CHANNEL_MSGS_KEEP:] if len(ch_msgs) > MIN_CHANNEL_MSGS_KEEP else list(ch_msgs)
-    ch_protected_tokens = sum(estimate_tokens(m["content"]) for m in ch_protected)
+    ch_protected_tokens = sum(m["tokens"] for m in ch_protected)
     
     # 可截断的频道消息（保护范围之外的旧消息）
     ch_trimmable = ch_msgs[:-MIN_CHANNEL_MSGS_KEEP] if len(ch_msgs) > MIN_CHANNEL_MSGS_KEEP else []
-    ch_trimmable_tokens = sum(estimate_tokens(m["content"]) for m in ch_trimmable)
     
-    # 计算DM可用空间：总预算 - 保护频道消息
-    dm_budget = available - ch_protected_tokens
-    
-    # 截断DM到预算内
-    while dm_total > dm_budget and dm_msgs:
-        removed = dm_msgs.pop(0)
-        dm_total -= estimate_tokens(removed["content"])
+    # 截断DM到预算内：总预算 - 保护频道消息
+    dm_msgs, dm_total = trim_oldest(dm_msgs, [m["tokens"] for m in dm_msgs], available - ch_protected_tokens)
     
     # 如果DM截完还不够，再截频道旧消息（不碰保护的最近N条）
-    while ch_protected_tokens + ch_trimmable_tokens + dm_total > available and ch_trimmable:
-        removed = ch_trimmable.pop(0)
-        ch_trimmable_tokens -= estimate_tokens(removed["content"])
+    ch_trimmable, _ = trim_oldest(ch_trimmable, [m["tokens"] for m in ch_trimmable],
+                                  available - ch_protected_tokens - dm_total)
     
     # 最终合并：DM + 可截断频道（剩余） + 保护频道（完整保留）
     all_msgs = sorted(dm_msgs + ch_trimmable + ch_protected, key=lambda x: x["timestamp"])
@@ -1105,44 +2724,27 @@ def build_history_messages(user, current_channel, api_name):
             content = f"[私聊] {content}"
         result.append({"role": m["role"], "content": content})
     
+    if with_tokens:
+        return result, [m["tokens"] for m in all_msgs]
     return result
 
 # ========== System Prompt ==========
+# 拆成几个片段分别缓存：固定规则是常量；频道列表按目录版本缓存；记忆块按用户缓存，
+# 改记忆时失效；场景头按 (频道, 用户) 缓存，目录版本变了失效。稳态下拼 prompt 不做 I/O。
+# 时间、消息数、积分提醒这些每轮都变的内容不进 system prompt，由 get_turn_context 拼到
+# 最后一条用户消息开头，这样 system + 历史在相邻几轮和返工的几次请求之间字节不变，能吃到服务商的前缀缓存。
 
-def get_system_prompt(mode="long", user_id=None, channel=None, msg_count=1):
-    memories_text = ""
-    if channel:
-        if is_dm_channel(channel) and user_id:
-            mem = format_memories(user_id, show_numbers=False)
-            if mem:
-                memories_text = f"\n\n【{get_display_name(user_id)}的记忆】\n{mem}"
-        else:
-            mem = get_all_memories_for_channel(channel)
-            if mem:
-                memories_text = f"\n\n{mem}"
-
-    current_scene = "私聊" if is_dm_channel(channel) else get_channel_name(channel)
-    time_period, time_greeting = get_time_period()
-    user_id_hint = f"\n当前用户 ID：{user_id}" if user_id else ""
-    channel_list = get_channel_list_for_ai()
-    
-    base = f"""你是一个友好的AI助手。
-当前时间: {get_time_str()}
-现在是{time_period}（{time_greeting}）
-当前场景：{current_scene}{user_id_hint}
-可用频道：{channel_list}
-{memories_text}
-
-Slack 格式：*粗体* _斜体_ ~删除线~ `代码` ```代码块``` > 引用 <@用户ID>
+SYSTEM_PROMPT_RULES = """Slack 格式：*粗体* _斜体_ ~删除线~ `代码` ```代码块``` > 引用 <@用户ID>
 禁止：# 标题、LaTeX、Markdown 表格
 
 === 场景意识 ===
 - [私聊] 标签 = 私聊中的对话
 - [某人说] 标签 = 频道里其他人说的话
+- [系统信息] 标签 = 系统在用户消息前附上的当前时间等信息，不是用户说的
 - 私聊内容不要在频道里主动提起
 
 *重要：你回复时绝对不要加这些标签！*
-- 不要在回复开头加 [私聊]、[频道] 之类的标签
+- 不要在回复开头加 [私聊]、[频道]、[系统信息] 之类的标签
 - 不要在回复开头加 # 号
 - 这些标签是系统用来标记历史消息的，不是你该加的
 - 你的回复直接写内容就好
@@ -1158,20 +2760,7 @@ Slack 格式：*粗体* _斜体_ ~删除线~ `代码` ```代码块``` > 引用 <
 
 不需要回复时用：[不回]"""
 
-    if mode == "short":
-        points, status, points_prompt = get_ai_points_status(user_id) if user_id else (10, "ok", "")
-        
-        base += f"""
-
-=== 短句模式 ===
-
-像朋友发微信一样聊天。
-
-*用户发了 {msg_count} 条消息*
-
-{points_prompt}
-
-*字数要求*：
+SHORT_MODE_RULES = """*字数要求*：
 - 最好 20 字以内
 - 最多 50 字（超过要审查）
 - 超过且不合理会扣分
@@ -1196,135 +2785,776 @@ Slack 格式：*粗体* _斜体_ ~删除线~ `代码` ```代码块``` > 引用 <
 用户：今天好累
 你：怎么啦|||工作太多了？"""
 
+_channel_list_cache = None  # (目录版本, 文本)
+SCENE_HEADER_CACHE_MAX = int(os.environ.get("SCENE_HEADER_CACHE_MAX", 2000))
+_scene_header_cache = OrderedDict()  # {(channel, user_id): (目录版本, 文本)}，按 LRU 最多留 SCENE_HEADER_CACHE_MAX 条
+_scene_header_lock = threading.Lock()
+_prompt_cache_stats = {"channel_list_hits": 0, "channel_list_misses": 0,
+                       "memory_hits": 0, "memory_misses": 0, "memory_invalidations": 0, "memory_index_loads": 0,
+                       "scene_hits": 0, "scene_misses": 0}
+
+def get_scene_header(user_id, channel):
+    key = (channel, user_id)
+    version = _channel_directory_stats["version"]
+    with _scene_header_lock:
+        cached = _scene_header_cache.get(key)
+        if cached and cached[0] == version:
+            _scene_header_cache.move_to_end(key)
+            _prompt_cache_stats["scene_hits"] += 1
+            return cached[1]
+    _prompt_cache_stats["scene_misses"] += 1
+    current_scene = "私聊" if is_dm_channel(channel) else get_channel_name(channel)
+    user_id_hint = f"\n当前用户 ID：{user_id}" if user_id else ""
+    text = f"当前场景：{current_scene}{user_id_hint}"
+    with _scene_header_lock:
+        _scene_header_cache[key] = (version, text)
+        _scene_header_cache.move_to_end(key)
+        while len(_scene_header_cache) > SCENE_HEADER_CACHE_MAX:
+            _scene_header_cache.popitem(last=False)
+    return text
+
+def get_memories_text(user_id, channel):
+    if not channel:
+        return ""
+    if is_dm_channel(channel) and user_id:
+        mem = get_memory_block(user_id)
+        return f"\n\n【{get_display_name(user_id)}的记忆】\n{mem}" if mem else ""
+    mem = get_all_memories_for_channel(channel)
+    return f"\n\n{mem}" if mem else ""
+
+def get_prompt_cache_stats():
+    return dict(_prompt_cache_stats, scene_headers=len(_scene_header_cache),
+                memory_blocks=len(_memory_block_cache))
+
+def get_system_prompt(mode="long", user_id=None, channel=None):
+    memories_text = get_memories_text(user_id, channel)
+
+    base = f"""你是一个友好的AI助手。
+{get_scene_header(user_id, channel)}
+可用频道：{get_channel_list_for_ai()}
+{memories_text}
+
+{SYSTEM_PROMPT_RULES}"""
+
+    if mode == "short":
+        base += f"""
+
+=== 短句模式 ===
+
+像朋友发微信一样聊天。
+
+{SHORT_MODE_RULES}"""
+
     return base
 
+def get_turn_context(mode="long", user_id=None, msg_count=1, user=None):
+    """每轮都会变的信息：当前时间，短句模式下再加用户消息数和积分提醒"""
+    time_period, time_greeting = get_time_period()
+    text = f"""当前时间: {get_time_str()}
+现在是{time_period}（{time_greeting}）"""
+
+    if mode == "short":
+        if user_id:
+            points = user.get("ai_points", AI_POINTS_DEFAULT) if user is not None else None
+            points, status, points_prompt = get_ai_points_status(user_id, points)
+        else:
+            points, status, points_prompt = (10, "ok", "")
+
+        text += f"""
+
+*用户发了 {msg_count} 条消息*
+
+{points_prompt}"""
+
+    return f"[系统信息]\n{text.strip()}\n[/系统信息]"
+
+def with_turn_context(context, text):
+    return f"{context}\n\n{text}" if text else context
+
 # ========== 解析隐藏命令 ==========
+# 一次扫描找出所有 [[命令|参数]]，按命令校验参数后生成结构化动作；格式不对的保留原文。
+
+HIDDEN_COMMAND_RE = re.compile(r'\[\[(定时|每日|记忆|特殊日期|私聊|发到频道|反应)\|(.*?)\]\]')
+_HIDDEN_ARG_PATTERNS = {
+    "timed_date": re.compile(r'(\d{4}-\d{2}-\d{2})\|(\d{1,2}:\d{2})\|(.+)'),
+    "timed_today": re.compile(r'(\d{1,2}:\d{2})\|([^\]]+)'),
+    "daily": re.compile(r'(\d{1,2}:\d{2})\|(.+)'),
+    "memory_for": re.compile(r'([A-Z0-9]+)\|(.+)'),
+    "user_id": re.compile(r'[A-Z0-9]+'),
+    "special_date": re.compile(r'(\d{2}-\d{2})\|(.+)'),
+    "to_channel": re.compile(r'(\w+)\|(.+)'),
+    "reaction": re.compile(r'\w+'),
+}
+SCHEDULE_ACTIONS = ["timed", "daily", "special_date"]
+EXTRA_ACTIONS = ["dm", "to_channel", "reaction"]
+
+def _normalize_hhmm(time_str):
+    h, m = time_str.split(":")
+    return f"{int(h):02d}:{m}"
+
+def _hidden_command_action(cmd, arg, user_id):
+    """把一条命令的参数转成动作 dict，参数不合法返回 None"""
+    P = _HIDDEN_ARG_PATTERNS
+    if cmd == "定时":
+        m = P["timed_date"].fullmatch(arg)
+        if m:
+            return {"type": "timed", "date": m.group(1), "time": _normalize_hhmm(m.group(2)), "hint": m.group(3)}
+        m = P["timed_today"].fullmatch(arg)
+        if m:
+            return {"type": "timed", "date": get_cn_time().strftime("%Y-%m-%d"),
+                    "time": _normalize_hhmm(m.group(1)), "hint": m.group(2)}
+    elif cmd == "每日":
+        m = P["daily"].fullmatch(arg)
+        if m:
+            return {"type": "daily", "time": _normalize_hhmm(m.group(1)), "topic": m.group(2)}
+    elif cmd == "记忆":
+        m = P["memory_for"].fullmatch(arg)
+        if m:
+            return {"type": "memory", "user_id": m.group(1), "content": m.group(2)}
+        # 单独一个大写 ID 不是记忆内容
+        if arg and "|" not in arg and not P["user_id"].fullmatch(arg):
+            return {"type": "memory", "user_id": user_id, "content": arg}
+    elif cmd == "特殊日期":
+        m = P["special_date"].fullmatch(arg)
+        if m:
+            return {"type": "special_date", "date": m.group(1), "desc": m.group(2)}
+    elif cmd == "私聊":
+        if arg:
+            return {"type": "dm", "content": arg}
+    elif cmd == "发到频道":
+        m = P["to_channel"].fullmatch(arg)
+        if m:
+            return {"type": "to_channel", "channel_name": m.group(1), "content": m.group(2)}
+    elif cmd == "反应":
+        if P["reaction"].fullmatch(arg):
+            return {"type": "reaction", "emoji": arg.lower()}
+    return None
+
+def tokenize_hidden_commands(reply, user_id):
+    """单次扫描，返回 (去掉命令后的文本, 动作列表)，不做任何读写"""
+    pieces, actions, pos = [], [], 0
+    for m in HIDDEN_COMMAND_RE.finditer(reply):
+        action = _hidden_command_action(m.group(1), m.group(2), user_id)
+        if action is None:
+            continue
+        pieces.append(reply[pos:m.start()])
+        pos = m.end()
+        actions.append(action)
+    pieces.append(reply[pos:])
+    return "".join(pieces), actions
+
+def apply_hidden_actions(actions, user_id):
+    """执行需要落库的动作，只写真正有变化的存储；返回需要发消息/加反应的动作"""
+    sched_actions = [a for a in actions if a["type"] in SCHEDULE_ACTIONS]
+    if sched_actions:
+        with _get_schedule_lock(user_id):
+            scheds = load_user_schedules(user_id)
+            for a in sched_actions:
+                if a["type"] == "timed":
+                    scheds.setdefault("timed", []).append({"date": a["date"], "time": a["time"], "hint": a["hint"]})
+                elif a["type"] == "daily":
+                    scheds.setdefault("daily", []).append({"time": a["time"], "topic": a["topic"]})
+                else:
+                    scheds.setdefault("special_dates", {})[a["date"]] = a["desc"]
+                    # 重新设定的日期今年还没祝福过
+                    scheds.get("special_fired", {}).pop(a["date"], None)
+            save_user_schedules(user_id, scheds)
+
+    memories = {}
+    for a in actions:
+        if a["type"] == "memory":
+            memories.setdefault(a["user_id"], []).append(a["content"])
+    for mem_uid, contents in memories.items():
+        add_memories(mem_uid, contents)
+
+    return [a for a in actions if a["type"] in EXTRA_ACTIONS]
 
 def parse_hidden_commands(reply, user_id, current_channel=None):
-    schedules = load_schedules()
-    if user_id not in schedules:
-        schedules[user_id] = {"timed": [], "daily": [], "special_dates": {}}
-
-    has_hidden = False
-    original_reply = reply
-    extra_actions = []
-
-    # 定时消息
-    for date_str, time_str, hint in re.findall(r'\[\[定时\|(\d{4}-\d{2}-\d{2})\|(\d{1,2}:\d{2})\|(.+?)\]\]', reply):
-        h, m = time_str.split(":")
-        schedules[user_id]["timed"].append({"date": date_str, "time": f"{int(h):02d}:{m}", "hint": hint})
-        reply = reply.replace(f"[[定时|{date_str}|{time_str}|{hint}]]", "")
-        has_hidden = True
-
-    for time_str, hint in re.findall(r'\[\[定时\|(\d{1,2}:\d{2})\|([^\]]+?)\]\]', reply):
-        h, m = time_str.split(":")
-        schedules[user_id]["timed"].append({
-            "date": get_cn_time().strftime("%Y-%m-%d"), "time": f"{int(h):02d}:{m}", "hint": hint
-        })
-        reply = reply.replace(f"[[定时|{time_str}|{hint}]]", "")
-        has_hidden = True
-
-    # 每日消息
-    for time_str, topic in re.findall(r'\[\[每日\|(\d{1,2}:\d{2})\|(.+?)\]\]', reply):
-        h, m = time_str.split(":")
-        schedules[user_id]["daily"].append({"time": f"{int(h):02d}:{m}", "topic": topic})
-        reply = reply.replace(f"[[每日|{time_str}|{topic}]]", "")
-        has_hidden = True
-
-    # 记忆
-    for mem_uid, content in re.findall(r'\[\[记忆\|([A-Z0-9]+)\|(.+?)\]\]', reply):
-        add_memory(mem_uid, content)
-        reply = reply.replace(f"[[记忆|{mem_uid}|{content}]]", "")
-        has_hidden = True
-
-    for content in re.findall(r'\[\[记忆\|([^|]+?)\]\]', reply):
-        if not re.match(r'^[A-Z0-9]+$', content):
-            add_memory(user_id, content)
-            reply = reply.replace(f"[[记忆|{content}]]", "")
-            has_hidden = True
-
-    # 特殊日期
-    for date, desc in re.findall(r'\[\[特殊日期\|(\d{2}-\d{2})\|(.+?)\]\]', reply):
-        schedules[user_id]["special_dates"][date] = desc
-        reply = reply.replace(f"[[特殊日期|{date}|{desc}]]", "")
-        has_hidden = True
-
-    # 私聊
-    for msg in re.findall(r'\[\[私聊\|(.+?)\]\]', reply):
-        extra_actions.append({"type": "dm", "content": msg})
-        reply = reply.replace(f"[[私聊|{msg}]]", "")
-        has_hidden = True
-
-    # 发到频道
-    for ch, msg in re.findall(r'\[\[发到频道\|(\w+)\|(.+?)\]\]', reply):
-        extra_actions.append({"type": "to_channel", "channel_name": ch, "content": msg})
-        reply = reply.replace(f"[[发到频道|{ch}|{msg}]]", "")
-        has_hidden = True
-
-    # 反应
-    for emoji in re.findall(r'\[\[反应\|(\w+)\]\]', reply):
-        extra_actions.append({"type": "reaction", "emoji": emoji.lower()})
-        reply = reply.replace(f"[[反应|{emoji}]]", "")
-        has_hidden = True
-
-    save_schedules(schedules)
-    return re.sub(r'\n{3,}', '\n\n', reply).strip(), has_hidden, original_reply, extra_actions
+    visible, actions = tokenize_hidden_commands(reply, user_id)
+    extra_actions = apply_hidden_actions(actions, user_id) if actions else []
+    return re.sub(r'\n{3,}', '\n\n', visible).strip(), bool(actions), reply, extra_actions
+
+# ========== Prompt 前缀缓存 ==========
+# PROMPT_CACHE_APIS（逗号分隔的 API 名）里的 API 发送前给 system、倒数第二条、最后一条消息打 cache_control 断点：
+# 返工时上一次请求整体是这一次的前缀，下一轮时 system + 上一轮为止的历史是前缀。
+# 服务商返回的缓存命中 token（prompt_tokens_details.cached_tokens 或 cache_read_input_tokens）按 API 记录。
+# 前缀是否真的没变可以用 benchmarks/bench_prompt_prefix.py 的本地假 API 检查。
+PROMPT_CACHE_APIS = {n.strip() for n in os.environ.get("PROMPT_CACHE_APIS", "").split(",") if n.strip()}
+
+_provider_cache_stats = {}  # {api_name: {"requests", "prompt_tokens", "cached_tokens", "cache_write_tokens"}}
+_provider_cache_lock = threading.Lock()
+
+def with_cache_breakpoints(messages, api_name):
+    """返回打好断点的副本，原 messages 不动（返工时还要接着往后加）"""
+    if api_name not in PROMPT_CACHE_APIS or not messages:
+        return messages
+    marks = {0, len(messages) - 2, len(messages) - 1}
+    result = []
+    for i, m in enumerate(messages):
+        content = m.get("content")
+        if i in marks and content:
+            parts = [dict(part) for part in content] if isinstance(content, list) else [{"type": "text", "text": content}]
+            parts[-1]["cache_control"] = {"type": "ephemeral"}
+            m = dict(m, content=parts)
+        result.append(m)
+    return result
 
-# ========== API 调用 ==========
+def record_cache_usage(api_name, usage):
+    if not usage:
+        return
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or usage.get("cache_read_input_tokens") or 0
+    written = usage.get("cache_creation_input_tokens") or 0
+    with _provider_cache_lock:
+        st = _provider_cache_stats.setdefault(api_name, {"requests": 0, "prompt_tokens": 0,
+                                                         "cached_tokens": 0, "cache_write_tokens": 0})
+        st["requests"] += 1
+        st["prompt_tokens"] += usage.get("prompt_tokens") or usage.get("input_tokens") or 0
+        st["cached_tokens"] += cached
+        st["cache_write_tokens"] += written
+
+def get_provider_cache_stats():
+    with _provider_cache_lock:
+        return {api_name: dict(st, hit_ratio=round(st["cached_tokens"] / st["prompt_tokens"], 3) if st["prompt_tokens"] else 0)
+                for api_name, st in _provider_cache_stats.items()}
+
+# ========== 熔断和自适应并发 ==========
+# 每个服务商（api_provider，按 URL 域名）一个 ProviderGate：
+# - 熔断器：连续失败 BREAKER_FAILURE_THRESHOLD 次就打开，BREAKER_OPEN_SECONDS 内直接拒绝；
+#   之后半开，只放一个探测请求，成功就关闭，失败重新打开
+# - AIMD 并发上限：成功一次上限 +1/上限（大约每轮 +1），超时一次减半，在 [AIMD_MIN_LIMIT, AIMD_MAX_LIMIT] 之间
+# 超过上限的请求最多排队 AI_QUEUE_TIMEOUT 秒，等不到就带着提示直接失败，不再占着线程重试。
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", 30))
+AIMD_INITIAL_LIMIT = float(os.environ.get("AIMD_INITIAL_LIMIT", 8))
+AIMD_MIN_LIMIT = float(os.environ.get("AIMD_MIN_LIMIT", 1))
+AIMD_MAX_LIMIT = float(os.environ.get("AIMD_MAX_LIMIT", 32))
+AIMD_DECREASE = float(os.environ.get("AIMD_DECREASE", 0.5))
+AI_QUEUE_TIMEOUT = float(os.environ.get("AI_QUEUE_TIMEOUT", 15))
+
+class ProviderUnavailable(Exception):
+    """熔断打开或排队超时；消息可以直接给用户看"""
+
+class ProviderGate:
+    def __init__(self, provider):
+        self.provider = provider
+        self.cond = threading.Condition()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.limit = AIMD_INITIAL_LIMIT
+        self.inflight = 0
+        self.waiting = 0
+        self.stats = {"ok": 0, "errors": 0, "timeouts": 0, "client_errors": 0, "opens": 0, "rejected": 0,
+                      "queued": 0, "queue_timeouts": 0}
+
+    def is_open(self):
+        with self.cond:
+            return self.state == "open" and time.time() - self.opened_at < BREAKER_OPEN_SECONDS
+
+    def acquire(self):
+        """拿到一个并发名额，返回是否是半开状态下的探测请求；拿不到抛 ProviderUnavailable"""
+        with self.cond:
+            if self.state == "open":
+                if time.time() - self.opened_at < BREAKER_OPEN_SECONDS:
+                    self.stats["rejected"] += 1
+                    wait_s = BREAKER_OPEN_SECONDS - (time.time() - self.opened_at)
+                    raise ProviderUnavailable(f"⚠️ {self.provider} 连续出错，已暂停请求（约 {wait_s:.0f} 秒后重试），可以用 /model 换一个模型")
+                self.state = "half_open"
+                print(f"[Breaker] {self.provider} 半开，放一个探测请求")
+            if self.state == "half_open":
+                if self.probing:
+                    self.stats["rejected"] += 1
+                    raise ProviderUnavailable(f"⚠️ {self.provider} 正在恢复中，请稍后再试")
+                self.probing = True
+                self.inflight += 1
+                return True
+            if self.inflight >= int(self.limit):
+                self.stats["queued"] += 1
+                self.waiting += 1
+                try:
+                    if not self.cond.wait_for(lambda: self.inflight < int(self.limit), timeout=AI_QUEUE_TIMEOUT):
+                        self.stats["queue_timeouts"] += 1
+                        raise ProviderUnavailable(f"⚠️ {self.provider} 当前请求太多（上限 {int(self.limit)}），请稍后再试")
+                finally:
+                    self.waiting -= 1
+            self.inflight += 1
+            return False
+
+    def release(self, outcome, probe=False):
+        """outcome: "ok" / "timeout" / "error" / "client_error"；probe 是 acquire 的返回值。
+        client_error 是请求本身的问题（比如某个用户的 prompt 太长），不说明服务商有问题，不计入熔断和并发调整"""
+        with self.cond:
+            self.inflight -= 1
+            was_probe = probe and self.state == "half_open"
+            if probe:
+                self.probing = False
+            if outcome == "client_error":
+                self.stats["client_errors"] += 1
+            elif outcome == "ok":
+                self.stats["ok"] += 1
+                self.failures = 0
+                self.limit = min(AIMD_MAX_LIMIT, self.limit + 1 / self.limit)
+                if was_probe:
+                    self.state = "closed"
+                    print(f"[Breaker] {self.provider} 探测成功，恢复")
+            else:
+                self.stats["timeouts" if outcome == "timeout" else "errors"] += 1
+                self.failures += 1
+                if outcome == "timeout":
+                    self.limit = max(AIMD_MIN_LIMIT, self.limit * AIMD_DECREASE)
+                if was_probe or (self.state == "closed" and self.failures >= BREAKER_FAILURE_THRESHOLD):
+                    self.state = "open"
+                    self.opened_at = time.time()
+                    self.stats["opens"] += 1
+                    print(f"[Breaker] {self.provider} 熔断打开（连续失败 {self.failures} 次），{BREAKER_OPEN_SECONDS:.0f}s 后半开")
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            state = self.state
+            if state == "open" and time.time() - self.opened_at >= BREAKER_OPEN_SECONDS:
+                state = "half_open"  # 下一个请求进来时才真正切换
+            return dict(self.stats, state=state, failures=self.failures, limit=round(self.limit, 2),
+                        inflight=self.inflight, waiting=self.waiting)
+
+_provider_gates = {}
+_provider_gates_lock = threading.Lock()
+
+def provider_gate(api_name):
+    provider = api_provider(api_name)
+    with _provider_gates_lock:
+        gate = _provider_gates.get(provider)
+        if gate is None:
+            gate = _provider_gates[provider] = ProviderGate(provider)
+        return gate
+
+def get_provider_gate_stats():
+    with _provider_gates_lock:
+        gates = list(_provider_gates.values())
+    return {gate.provider: gate.snapshot() for gate in gates}
+
+# ========== API 路由（故障切换 / 对冲请求）==========
+# 按 API（服务商 + 模型）记录最近 ROUTE_STATS_TTL 秒内的请求延迟和成败。
+# API_EQUIVALENCE_GROUPS 定义可以互相顶替的 API（分号分隔组，组内逗号分隔），比如不同服务商的 Opus 4.6 入口；
+# 默认不分组（不对冲不切换），组内要放不同上游的 API 才有冗余。
+# - 故障切换：首选 API 的服务商熔断中时改用同组里最健康的（错误率超过 ROUTE_FAILOVER_ERROR_RATE 的不当备用）；
+#   首选请求失败时直接改发到备用
+# - 对冲请求：首选 API 超过它自己的 p95 还没返回，就向同组最健康的备用再发一份，谁先回来用谁；
+#   输的那份照样跑完，它的 token 和 cost 记为重复开销
+# 样本太少时不对冲（不知道 p95），过期样本自动丢掉，被避开的 API 过一阵会重新有机会。
+API_EQUIVALENCE_GROUPS = [
+    [n.strip() for n in group.split(",") if n.strip()]
+    for group in os.environ.get("API_EQUIVALENCE_GROUPS", "").split(";")
+]
+ROUTE_HEDGING = os.environ.get("ROUTE_HEDGING", "1") == "1"
+ROUTE_WINDOW = int(os.environ.get("ROUTE_WINDOW", 200))
+ROUTE_STATS_TTL = int(os.environ.get("ROUTE_STATS_TTL", 1800))
+ROUTE_MIN_SAMPLES = int(os.environ.get("ROUTE_MIN_SAMPLES", 20))
+ROUTE_HEDGE_MIN_MS = int(os.environ.get("ROUTE_HEDGE_MIN_MS", 2000))
+ROUTE_FAILOVER_ERROR_RATE = float(os.environ.get("ROUTE_FAILOVER_ERROR_RATE", 0.5))
+ROUTE_ERROR_SAMPLES = 10  # 错误率看最近多少次
+ROUTE_HEDGE_WORKERS = int(os.environ.get("ROUTE_HEDGE_WORKERS", 0))  # 0 = 按调用方线程数自动算
+
+_route_samples = {}  # {api_name: deque[(时间, 延迟毫秒 或 None 表示失败)]}
+_route_stats = {"hedges": 0, "hedge_wins": 0, "primary_wins": 0, "failovers": 0,
+                "duplicate_calls": 0, "duplicate_tokens": 0, "duplicate_cost": 0}
+_route_lock = threading.Lock()
+_route_pool = None
+
+def _get_route_pool():
+    """每个调用 call_ai 的线程（消息工作线程 + 定时任务线程）最多同时占两个：首选 + 对冲；
+    输掉的请求还要跑完才释放，所以再留一倍余量"""
+    global _route_pool
+    with _route_lock:
+        if _route_pool is None:
+            workers = ROUTE_HEDGE_WORKERS or 4 * (WORKER_POOL_SIZE + SCHEDULER_WORKERS)
+            _route_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ai-route")
+        return _route_pool
+
+def _call_ai_started(started, messages, api_name):
+    started.set()
+    return _call_ai_once(messages, api_name)
+
+class AiCallError(Exception):
+    """一次 API 请求失败；reply 是最后一次也失败时给用户看的文字（None 用默认的）"""
+
+    def __init__(self, reply, retryable):
+        super().__init__(reply)
+        self.reply = reply
+        self.retryable = retryable
+
+def record_route_outcome(api_name, latency_ms):
+    with _route_lock:
+        _route_samples.setdefault(api_name, deque(maxlen=ROUTE_WINDOW)).append((time.time(), latency_ms))
+
+def _route_health(api_name):
+    """返回 (成功延迟排好序的列表, 最近错误率, 样本数)；调用方持有 _route_lock"""
+    cutoff = time.time() - ROUTE_STATS_TTL
+    samples = [lat for ts, lat in _route_samples.get(api_name, ()) if ts >= cutoff]
+    recent = samples[-ROUTE_ERROR_SAMPLES:]
+    error_rate = sum(lat is None for lat in recent) / len(recent) if recent else 0.0
+    return sorted(lat for lat in samples if lat is not None), error_rate, len(samples)
+
+def _route_unhealthy(error_rate, count):
+    return count >= ROUTE_ERROR_SAMPLES // 2 and error_rate >= ROUTE_FAILOVER_ERROR_RATE
+
+def _route_usable(api_name, has_image):
+    api = APIS.get(api_name)
+    return bool(api and api.get("url") and (api.get("vision") or not has_image)) and not provider_gate(api_name).is_open()
+
+def equivalent_apis(api_name):
+    """同组里的其他 API；和它同一个服务商（共用一个 ProviderGate）的不算，切过去没有冗余，只会把同一个熔断器打开得更快"""
+    provider = api_provider(api_name)
+    for group in API_EQUIVALENCE_GROUPS:
+        if api_name in group:
+            return [n for n in group if n != api_name and api_provider(n) != provider]
+    return []
 
-def call_ai(messages, api_name, has_image=False, max_retries=3):
-    api = APIS.get(api_name, APIS[DEFAULT_API])
-    
-    if has_image and not api.get("vision"):
-        return "当前模型不支持图片，请用 /model 切换。"
+def _route_best(candidates, has_image):
+    """挑同组里最健康的：排除错误率高的，有数据的按 p50 排在前面，没数据的垫底"""
+    ranked = []
+    with _route_lock:
+        for name in candidates:
+            if not _route_usable(name, has_image):
+                continue
+            latencies, error_rate, count = _route_health(name)
+            if _route_unhealthy(error_rate, count):
+                continue
+            p50 = latencies[len(latencies) // 2] if latencies else float("inf")
+            ranked.append((error_rate if latencies else 1.0, p50, name))
+    return min(ranked)[2] if ranked else None
+
+def route_primary(api_name, has_image=False):
+    """首选 API 的服务商熔断中时换成同组最健康的（没有可换的就还用它）。
+    看熔断状态而不是错误率：熔断到期后请求会回到首选，充当半开探测，恢复了就不再绕开"""
+    if not provider_gate(api_name).is_open():
+        return api_name
+    backup = _route_best(equivalent_apis(api_name), has_image)
+    if backup is None:
+        return api_name
+    with _route_lock:
+        _route_stats["failovers"] += 1
+    print(f"[Route] {api_name} 熔断中，切到 {backup}")
+    return backup
+
+def hedge_delay(api_name):
+    """超过这个秒数还没返回就发对冲请求；样本不够时返回 None（不对冲）"""
+    with _route_lock:
+        latencies, _, _ = _route_health(api_name)
+    if len(latencies) < ROUTE_MIN_SAMPLES:
+        return None
+    return max(ROUTE_HEDGE_MIN_MS, latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]) / 1000
 
-    for attempt in range(max_retries):
+def _call_ai_once(messages, api_name):
+    """向一个 API 发一次请求，返回 (回复, usage)；失败抛 AiCallError。
+    熔断打开或排队超时时不发请求，直接抛不可重试的 AiCallError"""
+    api = APIS[api_name]
+    gate = provider_gate(api_name)
+    try:
+        probe = gate.acquire()
+    except ProviderUnavailable as e:
+        raise AiCallError(str(e), False)
+    outcome = "error"
+    start = time.time()
+    try:
         try:
-            resp = requests.post(
-                api["url"],
+            resp = http_post(
+                "ai", api["url"],
                 headers={"Authorization": f"Bearer {api['key']}", "Content-Type": "application/json"},
-                json={"model": api["model"], "messages": messages},
-                timeout=120
+                json={"model": api["model"], "messages": with_cache_breakpoints(messages, api_name)}
             )
             result = resp.json()
-            
-            if "choices" in result:
-                return result["choices"][0]["message"]["content"]
-            elif "error" in result:
-                err = str(result.get("error", "")).lower()
-                if any(x in err for x in ["upstream", "timeout", "do_request"]):
-                    time.sleep(2 ** attempt)
-                    continue
-                return f"API 错误: {result.get('error')}"
         except requests.exceptions.Timeout:
-            time.sleep(2 ** attempt)
+            outcome = "timeout"
+            record_route_outcome(api_name, None)
+            raise AiCallError(None, True)
         except Exception as e:
-            if attempt == max_retries - 1:
-                return f"出错了: {e}"
+            record_route_outcome(api_name, None)
+            raise AiCallError(f"出错了: {e}", True)
+
+        if "choices" in result:
+            outcome = "ok"
+            record_route_outcome(api_name, (time.time() - start) * 1000)
+            usage = result.get("usage")
+            record_prompt_usage(api_name, messages, usage)
+            record_cache_usage(api_name, usage)
+            return result["choices"][0]["message"]["content"], usage
+        err = str(result.get("error", "")).lower()
+        if "error" in result and resp.status_code < 500 and not any(x in err for x in ["upstream", "timeout", "do_request"]):
+            # 请求本身被拒（prompt 太长、参数不对之类），不算服务商故障
+            outcome = "client_error"
+            raise AiCallError(f"API 错误: {result.get('error')}", False)
+        record_route_outcome(api_name, None)
+        if "timeout" in err:
+            outcome = "timeout"
+        if "error" in result and not any(x in err for x in ["upstream", "timeout", "do_request"]):
+            raise AiCallError(f"API 错误: {result.get('error')}", False)
+        raise AiCallError(None, True)
+    finally:
+        gate.release(outcome, probe)
+
+def _record_duplicate(api_name):
+    """输掉的那份请求跑完后记下它白花的 token 和 cost"""
+    def done(fut):
+        try:
+            _, usage = fut.result()
+        except Exception:
+            return
+        usage = usage or {}
+        with _route_lock:
+            _route_stats["duplicate_tokens"] += (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+            _route_stats["duplicate_cost"] += APIS[api_name].get("cost", 0)
+    return done
+
+def route_call(messages, api_name, has_image=False):
+    """故障切换 + 对冲：返回回复文字。都失败时抛首选的 AiCallError（保留它的可重试性，
+    不让备用的不可重试错误让 call_ai 放弃重试）"""
+    primary = route_primary(api_name, has_image)
+    backup = _route_best(equivalent_apis(primary), has_image) if ROUTE_HEDGING else None
+    delay = hedge_delay(primary) if backup else None
+    if delay is None:
+        try:
+            return _call_ai_once(messages, primary)[0]
+        except AiCallError as e:
+            if backup is None:
+                raise
+            return _failover(messages, primary, backup, e)
+
+    snapshot = list(messages)  # 返工时调用方会接着往 messages 里加
+    pool = _get_route_pool()
+    started = threading.Event()
+    first = pool.submit(_call_ai_started, started, snapshot, primary)
+    started.wait()  # 对冲延迟从请求真正发出开始算，不算在线程池里排队的时间
+    done, _ = wait([first], timeout=delay)
+    if done:
+        try:
+            return first.result()[0]
+        except AiCallError as e:
+            return _failover(snapshot, primary, backup, e)
+    # 首选超过 p95 还没回来，向备用再发一份
+    pending = {first: primary}
+    with _route_lock:
+        _route_stats["hedges"] += 1
+        _route_stats["duplicate_calls"] += 1
+    print(f"[Route] {primary} 超过 {delay:.1f}s 未完成，对冲到 {backup}")
+    pending[pool.submit(_call_ai_once, snapshot, backup)] = backup
+    errors = {}
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            name = pending.pop(fut)
+            try:
+                reply, _ = fut.result()
+            except AiCallError as e:
+                errors[name] = e
+                continue
+            with _route_lock:
+                _route_stats["hedge_wins" if name == backup else "primary_wins"] += 1
+            for loser, loser_name in pending.items():
+                loser.add_done_callback(_record_duplicate(loser_name))
+            return reply
+    raise errors.get(primary) or errors[backup]
+
+def _failover(messages, primary, backup, primary_error):
+    with _route_lock:
+        _route_stats["failovers"] += 1
+    print(f"[Route] {primary} 请求失败，改发到 {backup}")
+    try:
+        return _call_ai_once(messages, backup)[0]
+    except AiCallError:
+        raise primary_error
+
+def get_route_stats():
+    with _route_lock:
+        apis = {}
+        for api_name in _route_samples:
+            latencies, error_rate, count = _route_health(api_name)
+            if not count:
+                continue
+            apis[api_name] = {
+                "samples": count, "error_rate": round(error_rate, 3),
+                "p50_ms": round(latencies[len(latencies) // 2]) if latencies else None,
+                "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]) if latencies else None,
+            }
+        stats = dict(_route_stats)
+    stats["hedge_win_rate"] = round(stats["hedge_wins"] / stats["hedges"], 3) if stats["hedges"] else None
+    stats["apis"] = apis
+    return stats
+
+# ========== API 调用 ==========
+
+def call_ai(messages, api_name, has_image=False, max_retries=3):
+    if api_name not in APIS:
+        api_name = DEFAULT_API
+    
+    if has_image and not APIS[api_name].get("vision"):
+        return "当前模型不支持图片，请用 /model 切换。"
+
+    for attempt in range(max_retries):
+        try:
+            return route_call(messages, api_name, has_image)
+        except AiCallError as e:
+            if not e.retryable or (e.reply and attempt == max_retries - 1):
+                return e.reply
             time.sleep(2 ** attempt)
     
     return "API 请求失败 😢"
 
+# ========== 流式输出 ==========
+# 长句模式下用 SSE 流式接收回复，边收边用 chat.update 刷新 "_Typing..._" 那条消息。
+# 刷新间隔受 STREAM_UPDATE_INTERVAL 限制，避免撞上 chat.update 的频率限制。
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "1") == "1"
+STREAM_UPDATE_INTERVAL = float(os.environ.get("STREAM_UPDATE_INTERVAL", 1.5))
+STREAM_CURSOR = " ▌"
+
+_stream_stats = {}  # {api_name: {"streams", "fallbacks", "ttft_ms": [...], "updates"}}
+_stream_stats_lock = threading.Lock()
+
+def _stream_stat(api_name):
+    return _stream_stats.setdefault(api_name, {"streams": 0, "fallbacks": 0, "partials": 0, "updates": 0,
+                                               "ttft_ms": deque(maxlen=200)})
+
+def supports_streaming(api_name):
+    return STREAM_REPLIES and APIS.get(api_name, {}).get("stream", True)
+
+def stream_preview(text):
+    """流式过程中给用户看的部分：去掉完整的 [[...]]，截掉还没收完的命令和标记"""
+    text = re.sub(r'\[\[.*?\]\]', '', text, flags=re.DOTALL)
+    cut = text.find("[[")
+    if cut != -1:
+        text = text[:cut]
+    # 末尾可能是 [不回] 或 [[ 的前半截
+    text = re.sub(r'\[[^\[\]]{0,3}$', '', text)
+    return text.replace("[不回]", "").strip()
+
+def call_ai_stream(messages, api_name, on_preview, has_image=False):
+    """流式调用，每收到新内容就用当前预览文本调用 on_preview，返回完整回复。
+    接口不返回 SSE 或中途出错（包括已经收到一部分）时退回 call_ai 重新要完整回复。首选 API 最近错误率太高时先切到同组的备用。"""
+    if api_name in APIS:
+        api_name = route_primary(api_name, has_image)
+    api = APIS.get(api_name, APIS[DEFAULT_API])
+    if has_image and not api.get("vision"):
+        return "当前模型不支持图片，请用 /model 切换。"
+    gate = provider_gate(api_name)
+    try:
+        probe = gate.acquire()
+    except ProviderUnavailable as e:
+        return str(e)
+
+    start = time.time()
+    parts, last_preview, first_visible, usage = [], "", False, None
+    outcome, fallback = "error", False
+    try:
+        resp = http_post(
+            "ai", api["url"],
+            headers={"Authorization": f"Bearer {api['key']}", "Content-Type": "application/json"},
+            json={"model": api["model"], "messages": with_cache_breakpoints(messages, api_name), "stream": True,
+                  # OpenAI 兼容接口默认流式不返回 usage，要显式要求，不然长句模式永远拿不到校正样本
+                  "stream_options": {"include_usage": True}},
+            stream=True
+        )
+        if "text/event-stream" not in resp.headers.get("Content-Type", ""):
+            result = resp.json()
+            if "choices" in result:
+                outcome = "ok"
+                record_prompt_usage(api_name, messages, result.get("usage"))
+                record_cache_usage(api_name, result.get("usage"))
+                return result["choices"][0]["message"]["content"]
+            raise ValueError(f"非流式响应: {str(result.get('error', result))[:200]}")
+        # SSE 响应常常不带 charset，requests 会按 ISO-8859-1 解码，所以按字节取行自己用 UTF-8 解
+        for raw in resp.iter_lines():
+            line = raw.decode("utf-8", errors="replace")
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            choices = chunk.get("choices") or []
+            delta = choices[0].get("delta", {}).get("content") if choices else None
+            if not delta:
+                continue
+            parts.append(delta)
+            preview = stream_preview("".join(parts))
+            if preview and preview != last_preview:
+                if not first_visible:
+                    first_visible = True
+                    with _stream_stats_lock:
+                        _stream_stat(api_name)["ttft_ms"].append((time.time() - start) * 1000)
+                last_preview = preview
+                on_preview(preview)
+        outcome = "ok"
+    except Exception as e:
+        if isinstance(e, requests.exceptions.Timeout):
+            outcome = "timeout"
+        print(f"[Stream] {api_name} 流式出错: {e}")
+        # 收到一半断掉的也不能当完整回复用，整条重新要一次
+        fallback = True
+        if parts:
+            with _stream_stats_lock:
+                _stream_stat(api_name)["partials"] += 1
+    finally:
+        # 先还名额再退回 call_ai，不然半开探测或并发上限为 1 时会自己卡住自己
+        gate.release(outcome, probe)
+    if fallback:
+        with _stream_stats_lock:
+            _stream_stat(api_name)["fallbacks"] += 1
+        return call_ai(messages, api_name, has_image=has_image)
+    with _stream_stats_lock:
+        _stream_stat(api_name)["streams"] += 1
+    record_prompt_usage(api_name, messages, usage)
+    record_cache_usage(api_name, usage)
+    return "".join(parts)
+
+def make_stream_updater(channel, ts, api_name):
+    """返回 on_preview 回调：按间隔节流地把预览刷到 ts 那条消息上"""
+    state = {"last": 0.0}
+    def on_preview(preview):
+        now = time.time()
+        if now - state["last"] < STREAM_UPDATE_INTERVAL:
+            return
+        state["last"] = now
+        update_slack(channel, ts, preview + STREAM_CURSOR)
+        with _stream_stats_lock:
+            _stream_stat(api_name)["updates"] += 1
+    return on_preview
+
+def get_stream_stats():
+    with _stream_stats_lock:
+        stats = {}
+        for api_name, st in _stream_stats.items():
+            ttft = sorted(st["ttft_ms"])
+            stats[api_name] = {
+                "streams": st["streams"], "fallbacks": st["fallbacks"], "partials": st["partials"],
+                "updates": st["updates"],
+                "ttft_p50_ms": round(ttft[len(ttft) // 2]) if ttft else None,
+                "ttft_p95_ms": round(ttft[int(len(ttft) * 0.95)]) if ttft else None,
+            }
+        return stats
+
 # ========== Slack 工具 ==========
 
 def send_slack(channel, text):
-    resp = requests.post(
-        "https://slack.com/api/chat.postMessage",
+    resp = http_post(
+        "slack", "https://slack.com/api/chat.postMessage",
         headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
         json={"channel": channel, "text": text}
     )
     return resp.json().get("ts")
 
 def update_slack(channel, ts, text):
-    requests.post(
-        "https://slack.com/api/chat.update",
+    http_post(
+        "slack", "https://slack.com/api/chat.update",
         headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
         json={"channel": channel, "ts": ts, "text": text}
     )
 
 def delete_slack(channel, ts):
-    requests.post(
-        "https://slack.com/api/chat.delete",
+    http_post(
+        "slack", "https://slack.com/api/chat.delete",
         headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
         json={"channel": channel, "ts": ts}
     )
@@ -1333,8 +3563,8 @@ def add_reaction(channel, ts, emoji):
     emoji = EMOJI_ALIASES.get(emoji.lower().replace(':', ''), emoji.lower())
     if emoji not in VALID_EMOJIS:
         return
-    requests.post(
-        "https://slack.com/api/reactions.add",
+    http_post(
+        "slack", "https://slack.com/api/reactions.add",
         headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}", "Content-Type": "application/json"},
         json={"channel": channel, "timestamp": ts, "name": emoji}
     )
@@ -1345,14 +3575,104 @@ def send_multiple_slack(channel, texts):
             send_slack(channel, text.strip())
             time.sleep(0.5)
 
-def download_image(url):
+# ========== 图片预处理 ==========
+# 发给视觉模型前把长边缩到 IMAGE_MAX_EDGE 以内，按实际格式标 MIME；
+# 准备好的 data URL 按 file id 缓存在内存里（按字节数 LRU），同一张图再次出现不用重新下载和编码。
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", 1568))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", 85))
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+# 模型接受的格式，其余的（HEIC、BMP、TIFF……）转成 JPEG / PNG
+IMAGE_PASSTHROUGH_FORMATS = {"JPEG", "PNG", "GIF", "WEBP"}
+
+_image_cache = OrderedDict()  # {file_id: (data URL, 原图字节数, 发送的图片字节数)}
+_image_cache_bytes = 0
+_image_cache_lock = threading.Lock()
+# bytes_in / bytes_out 都按解码后的图片字节算（不含 base64 膨胀），只统计真正下载处理过的图；
+# 缓存命中的单独记在 cache_hit_bytes（命中的那些图发送的字节数）
+_image_stats = {"prepared": 0, "cache_hits": 0, "resized": 0, "reencoded": 0, "errors": 0,
+                "bytes_in": 0, "bytes_out": 0, "cache_hit_bytes": 0}
+
+def _encode_image(data):
+    """返回 (MIME, 图片字节)：超过最大边长就缩小，格式不被接受就转码，否则原样发送"""
+    img = Image.open(io.BytesIO(data))
+    fmt = img.format
+    too_big = max(img.size) > IMAGE_MAX_EDGE
+    if not too_big and fmt in IMAGE_PASSTHROUGH_FORMATS:
+        return Image.MIME[fmt], data
+    if getattr(img, "is_animated", False) and fmt in IMAGE_PASSTHROUGH_FORMATS:
+        return Image.MIME[fmt], data  # 动图缩放会丢帧，原样发送
+    img = ImageOps.exif_transpose(img)
+    if too_big:
+        img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+        _image_stats["resized"] += 1
+    else:
+        _image_stats["reencoded"] += 1
+    out = io.BytesIO()
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    if fmt == "PNG" or has_alpha:
+        img.save(out, format="PNG", optimize=True)
+        return "image/png", out.getvalue()
+    img.convert("RGB").save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return "image/jpeg", out.getvalue()
+
+def prepare_image(file_info):
+    """下载并准备一张图片，返回 (data URL, 原图字节数, 发送的图片字节数, 是否缓存命中)；失败返回 (None, 0, 0, False)"""
+    global _image_cache_bytes
+    file_id = file_info.get("id")
+    if file_id:
+        with _image_cache_lock:
+            cached = _image_cache.get(file_id)
+            if cached is not None:
+                _image_cache.move_to_end(file_id)
+                _image_stats["cache_hits"] += 1
+                return cached + (True,)
     try:
-        resp = requests.get(url, headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}, timeout=30)
-        if resp.status_code == 200:
-            return base64.b64encode(resp.content).decode('utf-8')
-    except:
-        pass
-    return None
+        downloaded = download_file(file_info["url_private"])
+    except FileTooLarge:
+        downloaded = None
+    if not downloaded:
+        return None, 0, 0, False
+    try:
+        data = downloaded.read_bytes()
+        mime, encoded = _encode_image(data)
+    except Exception as e:
+        print(f"[Image] {file_info.get('name', '图片')} 处理失败: {e}")
+        _image_stats["errors"] += 1
+        return None, 0, 0, False
+    finally:
+        downloaded.cleanup()
+    url = f"data:{mime};base64,{base64.b64encode(encoded).decode('utf-8')}"
+    entry = (url, len(data), len(encoded))
+    _image_stats["prepared"] += 1
+    if file_id and len(url) <= IMAGE_CACHE_MAX_BYTES:
+        with _image_cache_lock:
+            if file_id not in _image_cache:
+                _image_cache[file_id] = entry
+                _image_cache_bytes += len(url)
+            while _image_cache_bytes > IMAGE_CACHE_MAX_BYTES:
+                _, (old_url, _, _) = _image_cache.popitem(last=False)
+                _image_cache_bytes -= len(old_url)
+    return entry + (False,)
+
+def prepare_images(file_infos):
+    """并发准备多张图片，按原顺序返回 data URL 列表（失败的跳过），并记录本次请求的字节数"""
+    if not file_infos:
+        return []
+    results = list(_get_file_io_pool().map(prepare_image, file_infos))
+    urls = [url for url, _, _, _ in results if url]
+    bytes_in = sum(size_in for _, size_in, _, hit in results if not hit)
+    bytes_out = sum(size_out for _, _, size_out, hit in results if not hit)
+    hit_bytes = sum(size_out for _, _, size_out, hit in results if hit)
+    with _image_cache_lock:
+        _image_stats["bytes_in"] += bytes_in
+        _image_stats["bytes_out"] += bytes_out
+        _image_stats["cache_hit_bytes"] += hit_bytes
+    print(f"[Image] 本次 {len(urls)}/{len(file_infos)} 张，原图 {bytes_in}B → 发送 {bytes_out}B，缓存命中 {hit_bytes}B")
+    return urls
+
+def get_image_stats():
+    with _image_cache_lock:
+        return dict(_image_stats, cache_entries=len(_image_cache), cache_bytes=_image_cache_bytes)
 
 def execute_extra_actions(actions, user_id, channel, msg_ts=None, mode="long"):
     for action in actions:
@@ -1423,7 +3743,7 @@ def observe_channel(channel_id):
         if not members:
             return
         
-        user_data_template = load_user_data().get(members[0], {})
+        user_data_template = load_user(members[0])
         api = user_data_template.get("api", DEFAULT_API)
         
         prompt = f"""你正在观察频道 {get_channel_name(channel_id)}。
@@ -1470,32 +3790,41 @@ def process_message_with_rework(user_id, user, channel, text, api_name, mode, ms
     """处理消息，如果积分到 -10 且违规则返工"""
     print(f"[Debug] process_message_with_rework: mode={mode}, msg_count={msg_count}")
     
-    system = get_system_prompt(mode, user_id, channel, msg_count)
+    system = get_system_prompt(mode, user_id, channel)
+    history, history_tokens = build_history_messages(user, channel, api_name, with_tokens=True)
     messages = [{"role": "system", "content": system}]
-    messages.extend(build_history_messages(user, channel, api_name))
-    messages.append({"role": "user", "content": text})
+    messages.extend(history)
+    messages.append({"role": "user", "content": with_turn_context(get_turn_context(mode, user_id, msg_count, user), text)})
     
-    for attempt in range(MAX_REWORK_ATTEMPTS + 1):
-        reply = call_ai(messages, api_name)
-        visible, has_hidden, original, extra_actions = parse_hidden_commands(reply, user_id, channel)
-        
-        # 只在短句模式下评估
-        if mode != "short":
-            return visible, has_hidden, original, extra_actions, []
-        
-        violations, need_rework = evaluate_ai_response(user_id, user, channel, text, visible, msg_count)
-        
-        if not need_rework:
-            return visible, has_hidden, original, extra_actions, violations
-        
-        if attempt >= MAX_REWORK_ATTEMPTS:
-            print(f"[返工] 已达最大次数 {MAX_REWORK_ATTEMPTS}，使用默认回复")
-            return "好的~", False, "好的~", [], violations
-        
-        print(f"[返工] 第 {attempt + 1} 次，违规: {violations}")
-        
-        # 添加返工提示
-        rework_prompt = f"""
+    # 返工多次的扣分/加分都记在同一个账本里，整条消息结束时一次写入
+    ledger = AiPointsLedger(user_id, user.get("ai_points", AI_POINTS_DEFAULT))
+    try:
+        for attempt in range(MAX_REWORK_ATTEMPTS + 1):
+            # 长句模式不会返工，可以直接流式刷到 Typing 消息上
+            if mode != "short" and typing_ts and supports_streaming(api_name):
+                reply = call_ai_stream(messages, api_name, make_stream_updater(channel, typing_ts, api_name))
+            else:
+                reply = call_ai(messages, api_name)
+            visible, has_hidden, original, extra_actions = parse_hidden_commands(reply, user_id, channel)
+            
+            # 只在短句模式下评估
+            if mode != "short":
+                return visible, has_hidden, original, extra_actions, []
+            
+            violations, need_rework = evaluate_ai_response(user_id, user, channel, text, visible, msg_count,
+                                                           history, history_tokens, ledger)
+            
+            if not need_rework:
+                return visible, has_hidden, original, extra_actions, violations
+            
+            if attempt >= MAX_REWORK_ATTEMPTS:
+                print(f"[返工] 已达最大次数 {MAX_REWORK_ATTEMPTS}，使用默认回复")
+                return "好的~", False, "好的~", [], violations
+            
+            print(f"[返工] 第 {attempt + 1} 次，违规: {violations}")
+            
+            # 添加返工提示
+            rework_prompt = f"""
 🚨 你的回复被拒绝了！违规内容：{', '.join(violations)}
 
 你必须重新生成回复！要求：
@@ -1505,15 +3834,41 @@ def process_message_with_rework(user_id, user, channel, text, api_name, mode, ms
 - 用户发了 {msg_count} 条消息
 
 重新生成："""
+            
+            messages.append({"role": "assistant", "content": reply})
+            messages.append({"role": "user", "content": rework_prompt})
         
-        messages.append({"role": "assistant", "content": reply})
-        messages.append({"role": "user", "content": rework_prompt})
-    
-    return "好的~", False, "好的~", [], violations
+        return "好的~", False, "好的~", [], violations
+    finally:
+        ledger.commit()
+
+def _touch_user_activity(user_id, channel, now):
+    """记录用户最近活跃时间和所在频道"""
+    def apply(user):
+        user["last_active"] = now
+        if is_dm_channel(channel):
+            user["dm_channel"] = channel
+        else:
+            user["last_channel"] = channel
+            user.setdefault("channel_last_active", {})[channel] = now
+    update_user(user_id, apply)
+
+def _append_dm_history(user_id, user_text, reply, now):
+    """把这一轮私聊写进 dm_history（过长截断）"""
+    def apply(user):
+        user.setdefault("dm_history", [])
+        if user_text:
+            stored = user_text if len(user_text) <= MAX_DM_MSG_LEN else user_text[:MAX_DM_MSG_LEN] + f"\n...(已截断，原始{len(user_text)}字)"
+            user["dm_history"].append({"role": "user", "content": stored, "timestamp": now,
+                                       "token_features": token_features(stored)})
+        if reply:
+            stored = reply if len(reply) <= MAX_DM_MSG_LEN else reply[:MAX_DM_MSG_LEN] + f"\n...(已截断，原始{len(reply)}字)"
+            user["dm_history"].append({"role": "assistant", "content": stored, "timestamp": now + 0.001,
+                                       "token_features": token_features(stored)})
+    update_user(user_id, apply)
 
 def process_message(user_id, channel, text, files=None, message_ts=None, msg_count=1):
-    all_data = load_user_data()
-    user = all_data.get(user_id, {
+    user = load_user(user_id, {
         "dm_history": [], "api": DEFAULT_API, "mode": "long",
         "points_used": 0, "user_id": user_id, "ai_points": AI_POINTS_DEFAULT
     })
@@ -1530,19 +3885,13 @@ def process_message(user_id, channel, text, files=None, message_ts=None, msg_cou
 
     display_name = get_display_name(user_id)
     now = get_cn_time().timestamp()
-    user["last_active"] = now
     
-    if is_dm:
-        user["dm_channel"] = channel
-    else:
-        user["last_channel"] = channel
-        user.setdefault("channel_last_active", {})[channel] = now
+    if not is_dm:
         add_channel_message(channel, user_id, display_name, text)
 
     # 处理文件
     images, file_texts = [], []
-    for f in (files or []):
-        ftype, content = process_file(f)
+    for ftype, content in process_files(files or []):
         if ftype == "image":
             images.append(content)
         elif content:
@@ -1553,27 +3902,25 @@ def process_message(user_id, channel, text, files=None, message_ts=None, msg_cou
     log_message(user_id, channel, "user", full_text, username=display_name)
     
     # 保存用户数据
-    all_data[user_id] = user
-    save_user_data(all_data)
+    _touch_user_activity(user_id, channel, now)
 
     typing_ts = send_slack(channel, "_Typing..._")
     
     # 如果有图片，构建特殊消息格式
     if images:
-        system = get_system_prompt(mode, user_id, channel, msg_count)
+        system = get_system_prompt(mode, user_id, channel)
         messages = [{"role": "system", "content": system}]
         messages.extend(build_history_messages(user, channel, api))
         
-        content = []
-        if full_text:
-            content.append({"type": "text", "text": full_text})
-        for url in images:
-            img_data = download_image(url)
-            if img_data:
-                content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_data}"}})
+        content = [{"type": "text", "text": with_turn_context(get_turn_context(mode, user_id, msg_count, user), full_text)}]
+        for url in prepare_images(images):
+            content.append({"type": "image_url", "image_url": {"url": url}})
         
         messages.append({"role": "user", "content": content})
-        reply = call_ai(messages, api, has_image=True)
+        if mode != "short" and typing_ts and supports_streaming(api):
+            reply = call_ai_stream(messages, api, make_stream_updater(channel, typing_ts, api), has_image=True)
+        else:
+            reply = call_ai(messages, api, has_image=True)
         visible, has_hidden, original, extra_actions = parse_hidden_commands(reply, user_id, channel)
         violations = []
     else:
@@ -1586,17 +3933,8 @@ def process_message(user_id, channel, text, files=None, message_ts=None, msg_cou
     log_message(user_id, channel, "assistant", original, model=model_name, hidden=has_hidden)
 
     # 更新历史
-    all_data = load_user_data()
-    user = all_data.get(user_id, {})
-    
     if is_dm:
-        user.setdefault("dm_history", [])
-        if full_text:
-            stored = full_text if len(full_text) <= MAX_DM_MSG_LEN else full_text[:MAX_DM_MSG_LEN] + f"\n...(已截断，原始{len(full_text)}字)"
-            user["dm_history"].append({"role": "user", "content": stored, "timestamp": now})
-        if original:
-            stored = original if len(original) <= MAX_DM_MSG_LEN else original[:MAX_DM_MSG_LEN] + f"\n...(已截断，原始{len(original)}字)"
-            user["dm_history"].append({"role": "assistant", "content": stored, "timestamp": now + 0.001})
+        _append_dm_history(user_id, full_text, original, now)
     else:
         if original:
             add_channel_message(channel, "BOT", "AI", original, is_bot=True)
@@ -1608,9 +3946,6 @@ def process_message(user_id, channel, text, files=None, message_ts=None, msg_cou
         except Exception:
             pass
 
-    all_data[user_id] = user
-    save_user_data(all_data)
-
     check_pending_clear(user_id, channel)
     execute_extra_actions(extra_actions, user_id, channel, message_ts, mode)
 
@@ -1626,8 +3961,6 @@ def process_message(user_id, channel, text, files=None, message_ts=None, msg_cou
         update_slack(channel, typing_ts, visible)
 
 def delayed_process(user_id, channel, message_ts=None):
-    time.sleep(5)
-    
     if user_id not in pending_messages or not pending_messages[user_id]:
         return
     
@@ -1636,8 +3969,7 @@ def delayed_process(user_id, channel, message_ts=None):
     combined = "\n".join(msgs)
     pending_messages[user_id] = []
 
-    all_data = load_user_data()
-    user = all_data.get(user_id, {
+    user = load_user(user_id, {
         "dm_history": [], "api": DEFAULT_API, "mode": "short",
         "points_used": 0, "user_id": user_id, "ai_points": AI_POINTS_DEFAULT
     })
@@ -1656,15 +3988,10 @@ def delayed_process(user_id, channel, message_ts=None):
     log_message(user_id, channel, "user", combined, username=display_name)
 
     now = get_cn_time().timestamp()
-    if is_dm:
-        user["dm_channel"] = channel
-    else:
-        user["last_channel"] = channel
-        user.setdefault("channel_last_active", {})[channel] = now
+    if not is_dm:
         add_channel_message(channel, user_id, display_name, combined)
     
-    all_data[user_id] = user
-    save_user_data(all_data)
+    _touch_user_activity(user_id, channel, now)
 
     visible, has_hidden, original, extra_actions, violations = process_message_with_rework(
         user_id, user, channel, combined, api, "short", msg_count, typing_ts
@@ -1674,17 +4001,8 @@ def delayed_process(user_id, channel, message_ts=None):
     log_message(user_id, channel, "assistant", original, model=model_name, hidden=has_hidden)
 
     # 更新历史
-    all_data = load_user_data()
-    user = all_data.get(user_id, {})
-    
     if is_dm:
-        user.setdefault("dm_history", [])
-        if combined:
-            stored = combined if len(combined) <= MAX_DM_MSG_LEN else combined[:MAX_DM_MSG_LEN] + f"\n...(已截断，原始{len(combined)}字)"
-            user["dm_history"].append({"role": "user", "content": stored, "timestamp": now})
-        if original:
-            stored = original if len(original) <= MAX_DM_MSG_LEN else original[:MAX_DM_MSG_LEN] + f"\n...(已截断，原始{len(original)}字)"
-            user["dm_history"].append({"role": "assistant", "content": stored, "timestamp": now + 0.001})
+        _append_dm_history(user_id, combined, original, now)
     else:
         if original:
             add_channel_message(channel, "BOT", "AI", original, is_bot=True)
@@ -1695,10 +4013,6 @@ def delayed_process(user_id, channel, message_ts=None):
                 activate_channel_conversation(member_id, channel)
         except Exception:
             pass
-    
-    user["last_active"] = now
-    all_data[user_id] = user
-    save_user_data(all_data)
 
     check_pending_clear(user_id, channel)
     execute_extra_actions(extra_actions, user_id, channel, message_ts, "short")
@@ -1714,6 +4028,154 @@ def delayed_process(user_id, channel, message_ts=None):
             visible += f"\n\n_剩余积分: {remaining}_"
         update_slack(channel, typing_ts, visible)
 
+# ========== 任务分发 ==========
+# 固定大小的工作线程池 + 队列。同一个 key（通常是 (user_id, channel)）的任务严格按提交顺序
+# 串行执行，不同 key 之间并发；WORKER_POOL_SIZE 就是同时在跑的任务上限。
+WORKER_POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", 8))
+DISPATCH_QUEUE_LIMIT = int(os.environ.get("DISPATCH_QUEUE_LIMIT", 500))  # 排队任务上限，超过直接拒绝
+SHORT_MODE_WAIT = float(os.environ.get("SHORT_MODE_WAIT", 10))  # 短句模式攒消息的等待时间（秒）
+DISPATCH_RETRY_DELAY = float(os.environ.get("DISPATCH_RETRY_DELAY", 2))  # 延迟任务到点时队列满，隔多久再试
+DISPATCH_RETRY_MAX_AGE = float(os.environ.get("DISPATCH_RETRY_MAX_AGE", 120))  # 超过预定时间这么久还提交不进去就放弃
+DISPATCH_BUSY_TEXT = "⚠️ 现在排队的消息太多了，这条没能处理，稍后再发一次吧"
+DISPATCH_BUSY_COMMAND_TEXT = "❌ 现在太忙了，命令没有执行，稍后再试"
+
+_dispatch_cond = threading.Condition()
+_dispatch_ready = deque()  # 可以运行的 key（每个 key 最多出现一次）
+_dispatch_queues = {}  # {key: deque([(fn, args, enqueued_at), ...])}
+_dispatch_active = set()  # 已排进 ready 或正在运行的 key
+_dispatch_delayed = []  # 延迟任务堆 [(run_at, seq, key, fn, args, debounce_key, due_at)]，due_at 是最初预定的时间
+_dispatch_debounce = {}  # {debounce_key: 最新的 seq}，旧的延迟任务到点后直接丢弃
+_dispatch_seq = 0
+_dispatch_workers = []
+_dispatch_stats = {"submitted": 0, "completed": 0, "errors": 0, "rejected": 0, "debounced": 0,
+                   "delayed_retries": 0, "delayed_dropped": 0,
+                   "pending": 0, "max_pending": 0, "in_flight": 0,
+                   "wait_total_ms": 0.0, "wait_max_ms": 0.0}
+
+def _ensure_dispatch_workers():
+    """第一次提交时启动工作线程和延迟任务线程（调用方持有 _dispatch_cond）"""
+    if _dispatch_workers:
+        return
+    for i in range(WORKER_POOL_SIZE):
+        t = threading.Thread(target=_dispatch_worker, name=f"worker-{i}", daemon=True)
+        t.start()
+        _dispatch_workers.append(t)
+    t = threading.Thread(target=_dispatch_timer, name="dispatch-timer", daemon=True)
+    t.start()
+    _dispatch_workers.append(t)
+
+def dispatch(key, fn, args=()):
+    """提交任务，同 key 串行；队列满时返回 False"""
+    with _dispatch_cond:
+        _ensure_dispatch_workers()
+        if _dispatch_stats["pending"] >= DISPATCH_QUEUE_LIMIT:
+            _dispatch_stats["rejected"] += 1
+            print(f"[Dispatch] 队列已满（{DISPATCH_QUEUE_LIMIT}），丢弃任务 {key}")
+            return False
+        _dispatch_queues.setdefault(key, deque()).append((fn, args, time.time()))
+        _dispatch_stats["submitted"] += 1
+        _dispatch_stats["pending"] += 1
+        _dispatch_stats["max_pending"] = max(_dispatch_stats["max_pending"], _dispatch_stats["pending"])
+        if key not in _dispatch_active:
+            _dispatch_active.add(key)
+            _dispatch_ready.append(key)
+            _dispatch_cond.notify_all()  # 延迟任务线程也等在这个条件上，notify() 可能只叫醒它
+        return True
+
+def dispatch_later(delay, key, fn, args=(), debounce_key=None):
+    """delay 秒后提交任务；同一个 debounce_key 只有最后一次提交会执行。队列已满时不排、返回 False"""
+    global _dispatch_seq
+    with _dispatch_cond:
+        _ensure_dispatch_workers()
+        if _dispatch_stats["pending"] >= DISPATCH_QUEUE_LIMIT:
+            _dispatch_stats["rejected"] += 1
+            print(f"[Dispatch] 队列已满（{DISPATCH_QUEUE_LIMIT}），不排延迟任务 {key}")
+            return False
+        _dispatch_seq += 1
+        if debounce_key is not None:
+            if debounce_key in _dispatch_debounce:
+                _dispatch_stats["debounced"] += 1
+            _dispatch_debounce[debounce_key] = _dispatch_seq
+        run_at = time.time() + delay
+        heapq.heappush(_dispatch_delayed, (run_at, _dispatch_seq, key, fn, args, debounce_key, run_at))
+        _dispatch_cond.notify_all()
+        return True
+
+def _dispatch_timer():
+    global _dispatch_seq
+    while True:
+        with _dispatch_cond:
+            while not _dispatch_delayed or _dispatch_delayed[0][0] > time.time():
+                timeout = _dispatch_delayed[0][0] - time.time() if _dispatch_delayed else None
+                _dispatch_cond.wait(timeout)
+            run_at, seq, key, fn, args, debounce_key, due_at = heapq.heappop(_dispatch_delayed)
+            if debounce_key is not None:
+                if _dispatch_debounce.get(debounce_key) != seq:
+                    continue
+                del _dispatch_debounce[debounce_key]
+        if dispatch(key, fn, args):
+            continue
+        # 到点时队列满：过一会儿再试（不再参与防抖），一直进不去才放弃
+        with _dispatch_cond:
+            if time.time() - due_at < DISPATCH_RETRY_MAX_AGE:
+                _dispatch_seq += 1
+                heapq.heappush(_dispatch_delayed, (time.time() + DISPATCH_RETRY_DELAY, _dispatch_seq, key, fn, args, None, due_at))
+                _dispatch_stats["delayed_retries"] += 1
+                continue
+            _dispatch_stats["delayed_dropped"] += 1
+        print(f"[Dispatch] 延迟任务 {key} 超过 {DISPATCH_RETRY_MAX_AGE:.0f}s 仍提交不进队列，放弃")
+
+def _dispatch_worker():
+    while True:
+        with _dispatch_cond:
+            while not _dispatch_ready:
+                _dispatch_cond.wait()
+            key = _dispatch_ready.popleft()
+            fn, args, enqueued_at = _dispatch_queues[key].popleft()
+            wait_ms = (time.time() - enqueued_at) * 1000
+            _dispatch_stats["pending"] -= 1
+            _dispatch_stats["in_flight"] += 1
+            _dispatch_stats["wait_total_ms"] += wait_ms
+            _dispatch_stats["wait_max_ms"] = max(_dispatch_stats["wait_max_ms"], wait_ms)
+        if wait_ms > 5000:
+            print(f"[Dispatch] 任务 {key} 排队 {wait_ms / 1000:.1f}s")
+        failed = False
+        try:
+            fn(*args)
+        except Exception as e:
+            failed = True
+            print(f"[Dispatch] 任务 {key} 出错: {e}")
+            traceback.print_exc()
+        with _dispatch_cond:
+            _dispatch_stats["in_flight"] -= 1
+            _dispatch_stats["completed"] += 1
+            if failed:
+                _dispatch_stats["errors"] += 1
+            if _dispatch_queues[key]:
+                _dispatch_ready.append(key)
+                _dispatch_cond.notify_all()
+            else:
+                del _dispatch_queues[key]
+                _dispatch_active.discard(key)
+
+def notify_busy(user_id, channel, is_dm):
+    """消息因为队列满没排进去时告诉用户，别让消息无声无息地丢掉"""
+    text = DISPATCH_BUSY_TEXT if is_dm else f"<@{user_id}> {DISPATCH_BUSY_TEXT}"
+    try:
+        send_slack(channel, text)
+    except Exception as e:
+        print(f"[Dispatch] 通知用户 {user_id} 失败: {e}")
+
+def get_dispatch_stats():
+    with _dispatch_cond:
+        stats = dict(_dispatch_stats, workers=WORKER_POOL_SIZE, delayed=len(_dispatch_delayed),
+                     active_keys=len(_dispatch_active))
+    started = stats["completed"] + stats["in_flight"]
+    stats["wait_avg_ms"] = round(stats["wait_total_ms"] / started, 1) if started else 0.0
+    stats["wait_total_ms"] = round(stats["wait_total_ms"], 1)
+    stats["wait_max_ms"] = round(stats["wait_max_ms"], 1)
+    return stats
+
 # ========== Slack 事件 ==========
 
 @app.route("/slack/events", methods=["POST"])
@@ -1732,6 +4194,14 @@ def events():
 
     event = data.get("event", {})
     
+    if event.get("type") in ["user_change", "team_join"]:
+        handle_user_change(event.get("user", {}))
+        return jsonify({"ok": True})
+
+    if event.get("type") in CHANNEL_DIRECTORY_EVENTS:
+        handle_channel_event(event)
+        return jsonify({"ok": True})
+
     if event.get("type") not in ["app_mention", "message"]:
         return jsonify({"ok": True})
     # 过滤自己的消息（防止死循环），但允许其他bot（如清言）
@@ -1777,24 +4247,26 @@ def events():
         print(f"[Debug] 频道消息计数: {channel_message_counts.get(channel, 0)}")
         if should_trigger_observation(channel):
             print(f"[Debug] 触发频道观察: {channel}")
-            threading.Thread(target=observe_channel, args=[channel]).start()
+            dispatch(("observe", channel), observe_channel, [channel])
         return jsonify({"ok": True})
     
     if not text and not files:
         return jsonify({"ok": True})
 
-    user_data = load_user_data().get(user_id, {})
-    mode = user_data.get("mode", "long")
+    mode = load_user(user_id).get("mode", "long")
 
     if mode == "short" and not files:
         pending_messages.setdefault(user_id, []).append(text)
-        if user_id in pending_timers:
-            pending_timers[user_id].cancel()
-        timer = threading.Timer(5.0, delayed_process, args=[user_id, channel, message_ts])
-        timer.start()
-        pending_timers[user_id] = timer
+        accepted = dispatch_later(SHORT_MODE_WAIT, (user_id, channel), delayed_process, [user_id, channel, message_ts],
+                                  debounce_key=user_id)
+        if not accepted:
+            pending = pending_messages.get(user_id)
+            if pending and pending[-1] == text:
+                pending.pop()
     else:
-        threading.Thread(target=process_message, args=[user_id, channel, text, files, message_ts, 1]).start()
+        accepted = dispatch((user_id, channel), process_message, [user_id, channel, text, files, message_ts, 1])
+    if not accepted:
+        notify_busy(user_id, channel, is_dm)
 
     return jsonify({"ok": True})
 
@@ -1812,24 +4284,24 @@ def commands():
     if cmd == "/reset":
         def do_reset():
             print(f"[Reset] 开始重置用户 {user_id}")
-            data = load_user_data()
-            if user_id in data:
-                if is_dm:
-                    data[user_id]["dm_history"] = []
-                    data[user_id]["points_used"] = 0
-                    scheds = load_schedules()
-                    if user_id in scheds:
-                        scheds[user_id] = {"timed": [], "daily": [], "special_dates": {}}
-                        save_schedules(scheds)
-                else:
-                    data[user_id].setdefault("channel_reset_times", {})[channel] = get_cn_time().timestamp()
-                save_user_data(data)
+            with _get_user_lock(user_id):
+                user = storage.load_key("user_data", user_id)
+                if user is not None:
+                    if is_dm:
+                        user["dm_history"] = []
+                        user["points_used"] = 0
+                        with _get_schedule_lock(user_id):
+                            save_user_schedules(user_id, {"timed": [], "daily": [], "special_dates": {}})
+                    else:
+                        user.setdefault("channel_reset_times", {})[channel] = get_cn_time().timestamp()
+                    save_user(user_id, user)
             # 同时清空该频道的内存缓存
             with _channel_cache_lock:
                 _channel_messages_cache.pop(channel, None)
             print(f"[Reset] 重置完成")
         
-        threading.Thread(target=do_reset).start()
+        if not dispatch((user_id, channel), do_reset):
+            return jsonify({"response_type": "ephemeral", "text": DISPATCH_BUSY_COMMAND_TEXT})
         print(f"[Reset] 设置 pending_clear_logs: {user_id}")
         pending_clear_logs[user_id] = {"channel": channel, "count": 5, "channel_only": None if is_dm else channel}
         print(f"[Reset] pending_clear_logs 现在是: {pending_clear_logs}")
@@ -1845,7 +4317,8 @@ def commands():
             return jsonify({"response_type": "ephemeral", "text": f"📝 记忆（{total}/{MEMORY_LIMIT}字）：\n{mem}" if mem else "📝 暂无记忆"})
         
         if text_lower == "clear":
-            threading.Thread(target=clear_memories, args=[user_id]).start()
+            if not dispatch(("memory", user_id), clear_memories, [user_id]):
+                return jsonify({"response_type": "ephemeral", "text": DISPATCH_BUSY_COMMAND_TEXT})
             return jsonify({"response_type": "ephemeral", "text": "✅ 记忆已清空"})
         
         if text_lower.startswith("delete "):
@@ -1859,34 +4332,35 @@ def commands():
         return jsonify({"response_type": "ephemeral", "text": "用法:\n/memory - 查看\n/memory clear - 清空\n/memory delete 编号"})
 
     if cmd == "/model":
-        all_data = load_user_data()
+        user = load_user(user_id)
         
         if not text:
             info = "\n".join([f"{n} ({v['cost']}分) {'📷' if v.get('vision') else ''}" for n, v in APIS.items()])
-            current = all_data.get(user_id, {}).get("api", DEFAULT_API)
-            used = all_data.get(user_id, {}).get("points_used", 0)
+            current = user.get("api", DEFAULT_API)
+            used = user.get("points_used", 0)
             remaining = "∞" if is_unlimited_user(user_id) else f"{POINTS_LIMIT - used}/{POINTS_LIMIT}"
             return jsonify({"response_type": "ephemeral", "text": f"当前: {current}\n积分: {remaining}\n\n{info}"})
         
         if text in APIS:
-            all_data.setdefault(user_id, {})["api"] = text
-            save_user_data(all_data)
+            def apply(user):
+                user["api"] = text
+            update_user(user_id, apply)
             v = APIS[text]
             return jsonify({"response_type": "ephemeral", "text": f"✅ {text} ({v['cost']}分，图片{'✅' if v.get('vision') else '❌'})"})
         
         return jsonify({"response_type": "ephemeral", "text": "❌ 无效模型"})
 
     if cmd == "/mode":
-        all_data = load_user_data()
         text_lower = text.lower()
         
         if not text_lower:
-            current = all_data.get(user_id, {}).get("mode", "long")
+            current = load_user(user_id).get("mode", "long")
             return jsonify({"response_type": "ephemeral", "text": f"当前: {current}\n可用: long, short"})
         
         if text_lower in ["long", "short"]:
-            all_data.setdefault(user_id, {})["mode"] = text_lower
-            save_user_data(all_data)
+            def apply(user):
+                user["mode"] = text_lower
+            update_user(user_id, apply)
             return jsonify({"response_type": "ephemeral", "text": f"✅ {text_lower}"})
         
         return jsonify({"response_type": "ephemeral", "text": "❌ 只能 long 或 short"})
@@ -1913,11 +4387,23 @@ def commands():
         if is_unlimited_user(user_id):
             return jsonify({"response_type": "ephemeral", "text": "✨ 你是无限用户"})
         
-        all_data = load_user_data()
-        used = all_data.get(user_id, {}).get("points_used", 0)
+        used = load_user(user_id).get("points_used", 0)
         return jsonify({"response_type": "ephemeral", "text": f"剩余积分: {POINTS_LIMIT - used}/{POINTS_LIMIT}"})
 
     if cmd == "/aipoints":
+        if text == "log":
+            user = load_user(user_id)
+            log = storage.load_key("ai_points_log", user_id) or user.get("ai_points_log")
+            events = (log or {}).get("events", [])[-10:]
+            if not events:
+                return jsonify({"response_type": "ephemeral", "text": "还没有积分记录"})
+            replayed, mismatches = replay_ai_points(user, log)
+            lines = [f"{datetime.fromtimestamp(ts, CN_TIMEZONE).strftime('%m-%d %H:%M')} {kind}{' ' + reason if reason else ''} → {after}"
+                     for ts, kind, after, reason in events]
+            check = "✅ 重放一致" if not mismatches else f"⚠️ 重放有 {mismatches} 处对不上"
+            return jsonify({"response_type": "ephemeral",
+                            "text": f"最近 {len(events)} 条积分变动：\n" + "\n".join(lines) + f"\n重放结果: {replayed} {check}"})
+        
         points = get_ai_points(user_id)
         status_msg = ""
         if points <= AI_POINTS_MIN:
@@ -1940,217 +4426,480 @@ def commands():
             with _channel_cache_lock:
                 _channel_messages_cache.pop(channel, None)
                 _channel_cache_dirty.discard(channel)
-            messages = load_channel_messages()
-            messages[channel] = []
-            save_channel_messages(messages)
+            storage.save_key("channel_messages", channel, [])
             print(f"[ClearChannel] 已清空频道 {channel} 的消息历史")
-        threading.Thread(target=do_clear).start()
+        if not dispatch(("channel", channel), do_clear):
+            return jsonify({"response_type": "ephemeral", "text": DISPATCH_BUSY_COMMAND_TEXT})
         return jsonify({"response_type": "in_channel", "text": f"✅ 已清空 {get_channel_name(channel)} 的消息历史，Claude将以干净状态重新开始"})
 
     return jsonify({"response_type": "ephemeral", "text": "未知命令"})
 
 # ========== 定时任务 ==========
+# 最小堆里放每个任务的下一次触发时间，线程睡到最早的那个为止。
+# 每日任务记录 last_fired（日期），特殊日期记录 special_fired（{MM-DD: 年份}），
+# 所以处理慢了或者重启后，SCHEDULER_CATCHUP_WINDOW 以内错过的任务会补发。
+# 任何地方保存某个用户的 schedules 都会通知调度器只重算这个用户的条目。
+SCHEDULER_CATCHUP_WINDOW = int(os.environ.get("SCHEDULER_CATCHUP_WINDOW", 6 * 3600))
+SCHEDULER_RESYNC_INTERVAL = int(os.environ.get("SCHEDULER_RESYNC_INTERVAL", 600))  # 兜底全量重建堆
+SCHEDULER_RETRY_DELAY = int(os.environ.get("SCHEDULER_RETRY_DELAY", 60))  # 没送出去的任务隔多久再试
+SCHEDULER_MAX_RETRIES = int(os.environ.get("SCHEDULER_MAX_RETRIES", 5))  # 连续这么多次没送出去就放弃
+SCHEDULER_META_KEY = "_scheduler"  # schedules 文档里存调度器自己状态（上次积分重置日期）的 key
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 8))  # 同时处理的用户数
+SCHEDULER_PROVIDER_CONCURRENCY = int(os.environ.get("SCHEDULER_PROVIDER_CONCURRENCY", 3))
+# 按服务商单独设置，例如 "api.gptsapi.net=6,API_URL_2的域名=2"
+SCHEDULER_PROVIDER_LIMITS = {
+    k.strip(): int(v) for k, v in
+    (item.split("=", 1) for item in os.environ.get("SCHEDULER_PROVIDER_LIMITS", "").split(",") if "=" in item)
+}
+SCHEDULE_KIND_LABELS = {"timed": "定时", "daily": "每日", "special": "特殊日期"}
+
+_sched_heap = []  # [(fire_ts, seq, user_id, kind, key, gen)]
+_sched_gen = {}  # {user_id: 当前代数}，重算用户时加一，堆里旧代的条目出堆时丢弃
+_sched_running = set()  # 正在执行的用户，期间的重算推迟到执行完
+_sched_pending_rebuild = set()
+_sched_cond = threading.Condition()
+_sched_seq = itertools.count()
+_points_reset_day = None  # 最近一次执行积分重置的日期（同时存在 schedules[SCHEDULER_META_KEY]，重启后不会重复重置）
+_sched_retry_at = {}  # {(user_id, kind, key): (时间戳, 已重试次数)}，没送出去的任务在这之前不再触发
+_sched_stats = {"fired": 0, "caught_up": 0, "skipped_stale": 0, "retries": 0, "gave_up": 0, "rebuilds": 0, "full_rebuilds": 0,
+                "commits": 0, "max_commit_users": 0}
+_sched_executor = None  # 首次触发时创建
+_sched_provider_slots = {}  # {服务商: Semaphore}，限制同时在跑的 AI 调用
+_sched_provider_inflight = {}
+_sched_done = []  # 执行完、等待合并写入的 (user_id, dm_messages, entries)
+_sched_done_lock = threading.Lock()
+_sched_commit_lock = threading.Lock()
+_sched_lag = deque(maxlen=1000)  # 最近任务的触发→送达延迟（秒）
+
+def _parse_hhmm(time_str):
+    h, m = time_str.split(":")
+    return int(h), int(m)
+
+def _at(day, hour, minute):
+    return datetime(day.year, day.month, day.day, hour, minute, tzinfo=CN_TIMEZONE)
+
+def _next_daily_fire(item, now):
+    """每日任务的下一次触发时间；last_fired 之后错过的、且在补发窗口内的返回过去的时间"""
+    hour, minute = _parse_hhmm(item["time"])
+    last = item.get("last_fired")
+    if last:
+        day = datetime.strptime(last, "%Y-%m-%d").date() + timedelta(days=1)
+        fire = _at(day, hour, minute)
+        if (now - fire).total_seconds() <= SCHEDULER_CATCHUP_WINDOW:
+            return fire
+    # 没有记录（老数据或刚添加）或错过太久：只看之后的
+    fire = _at(now.date(), hour, minute)
+    return fire if fire > now else fire + timedelta(days=1)
+
+def _next_special_fire(md, fired_year, now):
+    month, day = map(int, md.split("-"))
+    for year in (now.year, now.year + 1):
+        if fired_year and year <= int(fired_year):
+            continue
+        try:
+            fire = datetime(year, month, day, tzinfo=CN_TIMEZONE)
+        except ValueError:  # 02-29 之类
+            continue
+        if fire > now or (fired_year and (now - fire).total_seconds() <= SCHEDULER_CATCHUP_WINDOW):
+            return fire
+    return None
 
-def run_scheduler():
-    while True:
+def _schedule_entries(user_id, scheds, now):
+    """算出一个用户所有任务的 (触发时间, 类型, key)"""
+    entries = []
+    for item in scheds.get("timed", []):
+        try:
+            hour, minute = _parse_hhmm(item.get("time", ""))
+            day = datetime.strptime(item.get("date", ""), "%Y-%m-%d")
+            entries.append((_at(day, hour, minute), "timed", (item["date"], item["time"], item.get("hint", ""))))
+        except Exception:
+            continue
+    for item in scheds.get("daily", []):
+        try:
+            entries.append((_next_daily_fire(item, now), "daily", (item["time"], item.get("topic", ""))))
+        except Exception:
+            continue
+    special_fired = scheds.get("special_fired", {})
+    for md in scheds.get("special_dates", {}):
         try:
-            now = get_cn_time()
-            current_time = now.strftime("%H:%M")
-            current_date = now.strftime("%Y-%m-%d")
-            current_md = now.strftime("%m-%d")
-
-            # 每日重置积分
-            if current_time == "00:00":
-                all_data = load_user_data()
-                for uid in all_data:
-                    all_data[uid]["points_used"] = 0
-                save_user_data(all_data)
-                print("[Scheduler] 用户积分已重置")
-
-            all_data = load_user_data()
-            schedules = load_schedules()
-            print(f"[Scheduler] 加载 schedules: {len(schedules)} 个用户") # 新增调试打印
-
-            # 如果 schedules 为空且不应该为空，跳过这次保存
-            if not schedules: # 新增保护逻辑
-                print(f"[Scheduler] schedules 为空，跳过本轮处理")
-                time.sleep(60)
+            fire = _next_special_fire(md, special_fired.get(md), now)
+        except Exception:
+            continue
+        if fire:
+            entries.append((fire, "special", md))
+    return entries
+
+def _push_user_entries(user_id, entries):
+    """调用方持有 _sched_cond"""
+    gen = _sched_gen.get(user_id, 0) + 1
+    _sched_gen[user_id] = gen
+    # 已经删掉的任务不用再记重试时间
+    current = {(user_id, kind, key) for _, kind, key in entries}
+    for stale in [k for k in _sched_retry_at if k[0] == user_id and k not in current]:
+        del _sched_retry_at[stale]
+    for fire, kind, key in entries:
+        fire_ts = max(fire.timestamp(), _sched_retry_at.get((user_id, kind, key), (0, 0))[0])
+        heapq.heappush(_sched_heap, (fire_ts, next(_sched_seq), user_id, kind, key, gen))
+
+def rebuild_user_schedule(user_id):
+    scheds = load_user_schedules(user_id)
+    entries = _schedule_entries(user_id, scheds, get_cn_time())
+    with _sched_cond:
+        if user_id in _sched_running:
+            _sched_pending_rebuild.add(user_id)
+            return
+        _push_user_entries(user_id, entries)
+        _sched_stats["rebuilds"] += 1
+        _sched_cond.notify()
+
+def rebuild_all_schedules():
+    global _points_reset_day
+    schedules = load_schedules()
+    meta = schedules.pop(SCHEDULER_META_KEY, None) or {}
+    if (meta.get("points_reset_day") or "") > (_points_reset_day or ""):
+        _points_reset_day = meta["points_reset_day"]
+    now = get_cn_time()
+    today_midnight = _at(now.date(), 0, 0)
+    with _sched_cond:
+        _sched_heap.clear()
+        for user_id, scheds in schedules.items():
+            if user_id not in _sched_running:
+                _push_user_entries(user_id, _schedule_entries(user_id, scheds, now))
+        # 积分重置：今天还没做过就排在今天 0 点（已过则立刻执行），否则排明天 0 点
+        reset_at = today_midnight
+        if _points_reset_day == today_midnight.strftime("%Y-%m-%d"):
+            reset_at += timedelta(days=1)
+        heapq.heappush(_sched_heap, (reset_at.timestamp(), next(_sched_seq), None, "points_reset",
+                                     reset_at.strftime("%Y-%m-%d"), 0))
+        _sched_stats["full_rebuilds"] += 1
+        _sched_cond.notify()
+    print(f"[Scheduler] 重建任务堆: {len(schedules)} 个用户, {len(_sched_heap)} 个条目")
+
+def scheduler_notify(user_id):
+    """某个用户的 schedules 被保存后调用，只重算这个用户"""
+    try:
+        rebuild_user_schedule(user_id)
+    except Exception as e:
+        print(f"[Scheduler] 重算 {user_id} 出错: {e}")
+
+def _pop_due_entries():
+    """睡到堆顶到期（或该做全量重建），返回到期的有效条目"""
+    with _sched_cond:
+        deadline = time.time() + SCHEDULER_RESYNC_INTERVAL
+        while True:
+            now_ts = time.time()
+            if _sched_heap and _sched_heap[0][0] <= now_ts:
+                break
+            if now_ts >= deadline:
+                return None
+            wait = deadline - now_ts
+            if _sched_heap:
+                wait = min(wait, _sched_heap[0][0] - now_ts)
+            _sched_cond.wait(wait)
+        due = []
+        while _sched_heap and _sched_heap[0][0] <= time.time():
+            entry = heapq.heappop(_sched_heap)
+            fire_ts, _, user_id, kind, key, gen = entry
+            if user_id is not None and gen != _sched_gen.get(user_id):
+                _sched_stats["skipped_stale"] += 1
                 continue
+            due.append(entry)
+        for entry in due:
+            if entry[2] is not None:
+                _sched_running.add(entry[2])
+        return due
+
+def reset_daily_points(day):
+    """每日 0 点重置用量积分，用户记录里的 points_reset_date 保证一天只重置一次；
+    重置日期存进 schedules 文档，重启后 rebuild_all_schedules 读回来，不会在白天再跑一次"""
+    global _points_reset_day
+    _points_reset_day = day
+    storage.save_key("schedules", SCHEDULER_META_KEY, {"points_reset_day": day})
+    count = 0
+    for user_id, user in load_user_data().items():
+        if user.get("points_reset_date") == day:
+            continue
+        def apply(u):
+            u["points_used"] = 0
+            u["points_reset_date"] = day
+        update_user(user_id, apply)
+        count += 1
+    print(f"[Scheduler] 用户积分已重置: {count} 人")
+
+def api_provider(api_name):
+    """同一个服务商（按 URL 域名区分）共用并发额度"""
+    url = APIS.get(api_name, APIS[DEFAULT_API]).get("url") or ""
+    return urlparse(url).netloc or api_name
+
+class _ProviderSlot:
+    def __init__(self, provider):
+        self.provider = provider
+        with _sched_cond:
+            if provider not in _sched_provider_slots:
+                limit = SCHEDULER_PROVIDER_LIMITS.get(provider, SCHEDULER_PROVIDER_CONCURRENCY)
+                _sched_provider_slots[provider] = threading.BoundedSemaphore(max(1, limit))
+            self.sem = _sched_provider_slots[provider]
+
+    def __enter__(self):
+        self.sem.acquire()
+        with _sched_cond:
+            _sched_provider_inflight[self.provider] = _sched_provider_inflight.get(self.provider, 0) + 1
+
+    def __exit__(self, *exc):
+        with _sched_cond:
+            _sched_provider_inflight[self.provider] -= 1
+        self.sem.release()
+
+def _scheduler_provider_slot(api_name):
+    return _ProviderSlot(api_provider(api_name))
+
+def _resolve_schedule_channel(user_id, user):
+    dm_channel = user.get("dm_channel")
+    if not dm_channel and not user.get("last_channel"):
+        dm_channel = get_user_dm_channel(user_id)
+        if dm_channel:
+            def apply(u):
+                u["dm_channel"] = dm_channel
+            update_user(user_id, apply)
+    return dm_channel or user.get("last_channel")
+
+def _deliver_scheduled_message(user_id, user, target_channel, task_prompt):
+    """让 AI 生成并发送一条定时消息；发到私聊时返回原文（由调用方写进 dm_history）"""
+    api = user.get("api", DEFAULT_API)
+    mode = user.get("mode", "long")
 
-            for user_id, user in all_data.items():
-                dm_channel = user.get("dm_channel")
-                last_channel = user.get("last_channel")
-                
-                if not dm_channel and not last_channel:
-                    dm_channel = get_user_dm_channel(user_id)
-                    if dm_channel:
-                        user["dm_channel"] = dm_channel
-                        all_data[user_id] = user
-                    else:
-                        continue
-                
-                channel = dm_channel or last_channel
-                if not channel:
-                    continue
+    system = get_system_prompt(mode, user_id, target_channel) + task_prompt
+    messages = [{"role": "system", "content": system}]
+    messages.extend(build_history_messages(user, target_channel, api))
+    messages.append({"role": "user", "content": with_turn_context(get_turn_context(mode, user_id, 1, user), "[定时任务触发]")})
 
-                user_scheds = schedules.get(user_id, {"timed": [], "daily": [], "special_dates": {}})
-                api = user.get("api", DEFAULT_API)
-                mode = user.get("mode", "long")
-
-                # 定时消息
-                new_timed = []
-                for item in user_scheds.get("timed", []):
-                    item_date = item.get("date", "")
-                    item_time = item.get("time", "")
-                    
-                    if not item_date or not item_time:
-                        continue
-                    
-                    # 标准化时间
-                    if len(item_time.split(":")[0]) == 1:
-                        item_time = "0" + item_time
-                    
-                    try:
-                        target = datetime.strptime(f"{item_date} {item_time}", "%Y-%m-%d %H:%M")
-                        target = target.replace(tzinfo=CN_TIMEZONE)
-                    except:
-                        new_timed.append(item)
-                        continue
-                    
-                    if now >= target:
-                        hint = item.get("hint", "")
-                        print(f"[Scheduler] 触发定时: {hint[:30]}...")
-                        
-                        target_channel = dm_channel or channel
-                        
-                        system = get_system_prompt(mode, user_id, target_channel, 1)
-                        system += f"\n\n=== 定时任务 ===\n你设定了：{hint}\n时间到了，发消息给用户。不想发就回复 [不发]"
-                        
-                        messages = [{"role": "system", "content": system}]
-                        messages.extend(build_history_messages(user, target_channel, api))
-                        messages.append({"role": "user", "content": "[定时任务触发]"}) # 新增占位符
-                        
-                        reply = call_ai(messages, api)
-                        
-                        if "[不发]" not in reply:
-                            visible, has_hidden, original, extra = parse_hidden_commands(reply, user_id, target_channel)
-                            
-                            if visible.strip() and "[不回]" not in visible:
-                                if mode == "short" and "|||" in visible:
-                                    send_multiple_slack(target_channel, visible.split("|||"))
-                                else:
-                                    send_slack(target_channel, visible)
-                                
-                                log_message(user_id, target_channel, "assistant", original, 
-                                           model=APIS.get(api, {}).get("model"), hidden=has_hidden)
-                                
-                                if is_dm_channel(target_channel):
-                                    user.setdefault("dm_history", []).append({
-                                        "role": "assistant", "content": original, 
-                                        "timestamp": now.timestamp()
-                                    })
-                                else:
-                                    add_channel_message(target_channel, "BOT", "AI", original, is_bot=True)
-                                
-                                execute_extra_actions(extra, user_id, target_channel, None, mode)
-                    else:
-                        new_timed.append(item)
-                
-                user_scheds["timed"] = new_timed
-
-                # 每日消息
-                for item in user_scheds.get("daily", []):
-                    item_time = item.get("time", "")
-                    if len(item_time.split(":")[0]) == 1:
-                        item_time = "0" + item_time
-                    
-                    if item_time == current_time:
-                        topic = item.get("topic", "")
-                        print(f"[Scheduler] 触发每日: {topic[:30]}...")
-                        
-                        target_channel = dm_channel or channel
-                        
-                        system = get_system_prompt(mode, user_id, target_channel, 1)
-                        system += f"\n\n=== 每日任务 ===\n主题：{topic}\n不想发就回复 [不发]"
-                        
-                        messages = [{"role": "system", "content": system}]
-                        messages.extend(build_history_messages(user, target_channel, api))
-                        messages.append({"role": "user", "content": "[定时任务触发]"}) # 新增占位符
-                        
-                        reply = call_ai(messages, api)
-                        
-                        if "[不发]" not in reply:
-                            visible, has_hidden, original, extra = parse_hidden_commands(reply, user_id, target_channel)
-                            
-                            if visible.strip() and "[不回]" not in visible:
-                                if mode == "short" and "|||" in visible:
-                                    send_multiple_slack(target_channel, visible.split("|||"))
-                                else:
-                                    send_slack(target_channel, visible)
-                                
-                                log_message(user_id, target_channel, "assistant", original,
-                                           model=APIS.get(api, {}).get("model"), hidden=has_hidden)
-                                
-                                if is_dm_channel(target_channel):
-                                    user.setdefault("dm_history", []).append({
-                                        "role": "assistant", "content": original,
-                                        "timestamp": now.timestamp()
-                                    })
-                                else:
-                                    add_channel_message(target_channel, "BOT", "AI", original, is_bot=True)
-                                
-                                execute_extra_actions(extra, user_id, target_channel, None, mode)
-
-                # 特殊日期
-                if current_time == "00:00":
-                    special = user_scheds.get("special_dates", {}).get(current_md)
-                    if special:
-                        print(f"[Scheduler] 触发特殊日期: {special[:30]}...")
-                        
-                        target_channel = dm_channel or channel
-                        
-                        system = get_system_prompt(mode, user_id, target_channel, 1)
-                        system += f"\n\n=== 特殊日期 ===\n今天是：{special}\n发一条祝福吧！不想发就回复 [不发]"
-                        
-                        messages = [{"role": "system", "content": system}]
-                        messages.extend(build_history_messages(user, target_channel, api))
-                        messages.append({"role": "user", "content": "[定时任务触发]"}) # 新增占位符
-                        
-                        reply = call_ai(messages, api)
-                        
-                        if "[不发]" not in reply:
-                            visible, has_hidden, original, extra = parse_hidden_commands(reply, user_id, target_channel)
-                            
-                            if visible.strip() and "[不回]" not in visible:
-                                if mode == "short" and "|||" in visible:
-                                    send_multiple_slack(target_channel, visible.split("|||"))
-                                else:
-                                    send_slack(target_channel, visible)
-                                
-                                log_message(user_id, target_channel, "assistant", original,
-                                           model=APIS.get(api, {}).get("model"), hidden=has_hidden)
-                                
-                                if is_dm_channel(target_channel):
-                                    user.setdefault("dm_history", []).append({
-                                        "role": "assistant", "content": original,
-                                        "timestamp": now.timestamp()
-                                    })
-                                else:
-                                    add_channel_message(target_channel, "BOT", "AI", original, is_bot=True)
-                                
-                                execute_extra_actions(extra, user_id, target_channel, None, mode)
-
-                schedules[user_id] = user_scheds
-
-            save_schedules(schedules)
-            save_user_data(all_data)
+    with _scheduler_provider_slot(api):
+        reply = call_ai(messages, api)
+    if "[不发]" in reply:
+        return None
+    visible, has_hidden, original, extra = parse_hidden_commands(reply, user_id, target_channel)
+    if not visible.strip() or "[不回]" in visible:
+        return None
+
+    if mode == "short" and "|||" in visible:
+        send_multiple_slack(target_channel, visible.split("|||"))
+    else:
+        send_slack(target_channel, visible)
+    # 消息已经发出去了：后面的记录和附带动作出错只打日志，不能让整条任务重试再发一遍
+    try:
+        log_message(user_id, target_channel, "assistant", original,
+                    model=APIS.get(api, {}).get("model"), hidden=has_hidden)
+        if not is_dm_channel(target_channel):
+            add_channel_message(target_channel, "BOT", "AI", original, is_bot=True)
+        execute_extra_actions(extra, user_id, target_channel, None, mode)
+    except Exception as e:
+        print(f"[Scheduler] {user_id} 定时消息已发送，后续处理出错: {e}")
+    return original if is_dm_channel(target_channel) else None
+
+def _scheduled_task_prompt(kind, key, scheds):
+    if kind == "timed":
+        return f"\n\n=== 定时任务 ===\n你设定了：{key[2]}\n时间到了，发消息给用户。不想发就回复 [不发]"
+    if kind == "daily":
+        return f"\n\n=== 每日任务 ===\n主题：{key[1]}\n不想发就回复 [不发]"
+    special = scheds.get("special_dates", {}).get(key, "")
+    return f"\n\n=== 特殊日期 ===\n今天是：{special}\n发一条祝福吧！不想发就回复 [不发]"
+
+def _run_user_tasks(user_id, entries):
+    """按触发时间顺序执行一个用户到期的任务，返回 (要写进 dm_history 的消息, 已送达或放弃的条目)。
+    没送出去的（没有用户记录、找不到频道、出错）不算触发，SCHEDULER_RETRY_DELAY 秒后再试，
+    连续 SCHEDULER_MAX_RETRIES 次都没送出去就放弃，当作已触发"""
+    user = storage.load_key("user_data", user_id)
+    channel = None
+    if user is not None:
+        user["user_id"] = user_id
+        channel = _resolve_schedule_channel(user_id, user)
+    if not channel:
+        return [], _retry_later(user_id, entries)
+    scheds = load_user_schedules(user_id)
+    dm_messages, delivered = [], []
+    for entry in sorted(entries):
+        fire_ts, _, _, kind, key, _ = entry
+        label = key[2] if kind == "timed" else key[1] if kind == "daily" else scheds.get("special_dates", {}).get(key, key)
+        print(f"[Scheduler] 触发{SCHEDULE_KIND_LABELS[kind]}: {label[:30]}...")
+        try:
+            original = _deliver_scheduled_message(user_id, user, channel, _scheduled_task_prompt(kind, key, scheds))
+        except Exception as e:
+            print(f"[Scheduler] 任务出错 {user_id}/{kind}: {e}")
+            delivered.extend(_retry_later(user_id, [entry]))
+            continue
+        delivered.append(entry)
+        with _sched_cond:
+            _sched_retry_at.pop((user_id, kind, key), None)
+        lag = time.time() - fire_ts
+        with _sched_done_lock:
+            _sched_lag.append(lag)
+        print(f"[Scheduler] {user_id}/{kind} 完成，触发到送达 {lag:.1f}s")
+        if original:
+            msg = {"role": "assistant", "content": original, "timestamp": get_cn_time().timestamp(),
+                   "token_features": token_features(original)}
+            dm_messages.append(msg)
+            # 同一轮后面的任务也能看到这条
+            user.setdefault("dm_history", []).append(msg)
+    return dm_messages, delivered
+
+def _retry_later(user_id, entries):
+    """SCHEDULER_RETRY_DELAY 秒后再试；已经重试过 SCHEDULER_MAX_RETRIES 次的放弃，返回这些条目（调用方当作已触发）"""
+    retry_at = time.time() + SCHEDULER_RETRY_DELAY
+    given_up = []
+    with _sched_cond:
+        for entry in entries:
+            retry_key = (user_id, entry[3], entry[4])
+            attempts = _sched_retry_at.get(retry_key, (0, 0))[1] + 1
+            if attempts > SCHEDULER_MAX_RETRIES:
+                _sched_retry_at.pop(retry_key, None)
+                _sched_stats["gave_up"] += 1
+                given_up.append(entry)
+            else:
+                _sched_retry_at[retry_key] = (retry_at, attempts)
+                _sched_stats["retries"] += 1
+    for entry in given_up:
+        print(f"[Scheduler] {user_id}/{entry[3]} 重试 {SCHEDULER_MAX_RETRIES} 次仍没送出去，放弃")
+    return given_up
+
+def _mark_fired(scheds, entries):
+    for fire_ts, _, _, kind, key, _ in entries:
+        fire_day = datetime.fromtimestamp(fire_ts, CN_TIMEZONE)
+        if kind == "timed":
+            scheds["timed"] = [t for t in scheds.get("timed", [])
+                               if (t.get("date"), t.get("time"), t.get("hint", "")) != key]
+        elif kind == "daily":
+            for item in scheds.get("daily", []):
+                if (item.get("time"), item.get("topic", "")) == key:
+                    item["last_fired"] = fire_day.strftime("%Y-%m-%d")
+        else:
+            scheds.setdefault("special_fired", {})[key] = str(fire_day.year)
+
+def _commit_task_batch(batch):
+    """把一批用户的执行结果合并回最新的 schedules 和 dm_history，每个文档只写一次"""
+    user_ids = sorted({user_id for user_id, _, _ in batch})
+    with contextlib.ExitStack() as stack:
+        for user_id in user_ids:
+            stack.enter_context(_get_schedule_lock(user_id))
+        scheds = {user_id: load_user_schedules(user_id) for user_id in user_ids}
+        for user_id, _, entries in batch:
+            _mark_fired(scheds[user_id], entries)
+        storage.save_keys("schedules", scheds)
+
+    dm_messages = {}
+    for user_id, messages, _ in batch:
+        if messages:
+            dm_messages.setdefault(user_id, []).extend(messages)
+    if dm_messages:
+        with contextlib.ExitStack() as stack:
+            for user_id in sorted(dm_messages):
+                stack.enter_context(_get_user_lock(user_id))
+            users = {}
+            for user_id, messages in dm_messages.items():
+                user = load_user(user_id)
+                user.setdefault("dm_history", []).extend(messages)
+                users[user_id] = user
+            storage.save_keys("user_data", users)
+
+    with _sched_cond:
+        _sched_stats["commits"] += 1
+        _sched_stats["max_commit_users"] = max(_sched_stats["max_commit_users"], len(user_ids))
+
+def _group_commit(result):
+    """组提交：拿到提交锁的线程把这期间所有执行完的用户一起写掉，其余线程直接返回"""
+    with _sched_done_lock:
+        _sched_done.append(result)
+    while True:
+        if not _sched_commit_lock.acquire(blocking=False):
+            return
+        try:
+            with _sched_done_lock:
+                batch = _sched_done[:]
+                _sched_done.clear()
+            if batch:
+                try:
+                    _commit_task_batch(batch)
+                except Exception as e:
+                    print(f"[Scheduler] 合并写入出错: {e}")
+                    traceback.print_exc()
+                finally:
+                    for user_id, _, _ in batch:
+                        _finish_user_tasks(user_id)
+        finally:
+            _sched_commit_lock.release()
+        # 释放锁之后再看一眼，避免别的线程刚好放进来却没人提交
+        with _sched_done_lock:
+            if not _sched_done:
+                return
+
+def _finish_user_tasks(user_id):
+    with _sched_cond:
+        _sched_running.discard(user_id)
+        _sched_pending_rebuild.discard(user_id)
+    rebuild_user_schedule(user_id)
+
+def _user_task_job(user_id, entries):
+    dm_messages, fired = [], []
+    try:
+        dm_messages, fired = _run_user_tasks(user_id, entries)
+    except Exception as e:
+        print(f"[Scheduler] 处理 {user_id} 出错: {e}")
+        traceback.print_exc()
+        fired = _retry_later(user_id, entries)
+    _group_commit((user_id, dm_messages, fired))
+
+def _fire_due_entries(due):
+    """到期任务按用户分组交给线程池；同一用户的任务在一个作业里按顺序执行"""
+    global _sched_executor
+    now_ts = time.time()
+    by_user = {}
+    for entry in due:
+        fire_ts, _, user_id, kind, key, _ = entry
+        if now_ts - fire_ts > 90:
+            _sched_stats["caught_up"] += 1
+        _sched_stats["fired"] += 1
+        if kind == "points_reset":
+            reset_daily_points(key)
+            next_midnight = _at(datetime.strptime(key, "%Y-%m-%d").date() + timedelta(days=1), 0, 0)
+            with _sched_cond:
+                heapq.heappush(_sched_heap, (next_midnight.timestamp(), next(_sched_seq), None, "points_reset",
+                                             next_midnight.strftime("%Y-%m-%d"), 0))
+            continue
+        by_user.setdefault(user_id, []).append(entry)
+    if by_user and _sched_executor is None:
+        _sched_executor = ThreadPoolExecutor(max_workers=SCHEDULER_WORKERS, thread_name_prefix="sched")
+    for user_id, entries in by_user.items():
+        _sched_executor.submit(_user_task_job, user_id, entries)
+
+def get_scheduler_stats():
+    with _sched_cond:
+        stats = dict(_sched_stats, heap_size=len(_sched_heap), running=len(_sched_running))
+        if _sched_heap:
+            stats["next_fire_in_s"] = round(_sched_heap[0][0] - time.time(), 1)
+        stats["providers"] = {
+            provider: {"inflight": _sched_provider_inflight.get(provider, 0),
+                       "limit": SCHEDULER_PROVIDER_LIMITS.get(provider, SCHEDULER_PROVIDER_CONCURRENCY)}
+            for provider in _sched_provider_slots
+        }
+    with _sched_done_lock:
+        lag = sorted(_sched_lag)
+    stats["lag_p50_s"] = round(lag[len(lag) // 2], 1) if lag else None
+    stats["lag_p95_s"] = round(lag[int(len(lag) * 0.95)], 1) if lag else None
+    stats["lag_max_s"] = round(lag[-1], 1) if lag else None
+    return stats
 
+def run_scheduler():
+    while True:
+        try:
+            rebuild_all_schedules()
+            while True:
+                due = _pop_due_entries()
+                if due is None:
+                    break  # 到了兜底重建的时间
+                _fire_due_entries(due)
         except Exception as e:
             print(f"[Scheduler] 出错: {e}")
-            import traceback
             traceback.print_exc()
-
-        time.sleep(60)
+            time.sleep(60)
 
 # ========== 启动 ==========
 
@@ -2162,10 +4911,65 @@ def cron_job():
 def home():
     return "Bot is running! 🤖"
 
-scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
-scheduler_thread.start()
-print("[Startup] 定时任务线程已启动")
+@app.route("/stats")
+def stats():
+    return jsonify({
+        "jsonbin_cache": get_jsonbin_cache_stats(),
+        "storage": storage.stats(),
+        "chat_logs": get_chat_log_stats(),
+        "user_cache": get_user_cache_stats(),
+        "channel_directory": get_channel_directory_stats(),
+        "http": get_http_stats(),
+        "dispatch": get_dispatch_stats(),
+        "streaming": get_stream_stats(),
+        "token_calibration": get_token_calibration_stats(),
+        "scheduler": get_scheduler_stats(),
+        "prompt_cache": get_prompt_cache_stats(),
+        "files": get_file_pipeline_stats(),
+        "file_cache": get_file_cache_stats(),
+        "images": get_image_stats(),
+        "ai_points": get_ai_points_stats(),
+        "provider_cache": get_provider_cache_stats(),
+        "routing": get_route_stats(),
+        "providers": get_provider_gate_stats(),
+    })
+
+# 命令行工具模式（python main.py migrate）不启动后台线程
+CLI_COMMAND = sys.argv[1] if __name__ == "__main__" and len(sys.argv) > 1 else None
+# 附件解析子进程（spawn）也会 import 本模块，后台线程和退出钩子只在主进程里挂
+IS_MAIN_PROCESS = multiprocessing.parent_process() is None
+# BACKGROUND_TASKS=0 时 import 本模块不启动任何后台线程、不挂退出钩子（压测脚本用），需要时手动调 start_background_tasks()
+BACKGROUND_TASKS = os.environ.get("BACKGROUND_TASKS", "1") != "0"
+_background_started = False
+
+def start_background_tasks():
+    """启动 JSONBin 回写线程和退出钩子；命令行模式以外再启动定时任务、用户缓存预热和频道目录刷新"""
+    global _background_started, jsonbin_flusher_thread, scheduler_thread
+    if _background_started:
+        return
+    _background_started = True
+    jsonbin_flusher_thread = threading.Thread(target=_run_jsonbin_flusher, daemon=True)
+    jsonbin_flusher_thread.start()
+    atexit.register(flush_jsonbin_cache)
+    atexit.register(save_token_calibration)
+    print(f"[Startup] JSONBin 回写线程已启动，间隔 {JSONBIN_FLUSH_INTERVAL}s")
+    if CLI_COMMAND:
+        return
+    scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
+    scheduler_thread.start()
+    print(f"[Startup] 定时任务线程已启动，存储后端: {storage.name}")
+
+    threading.Thread(target=warm_user_cache, daemon=True).start()
+    threading.Thread(target=_run_channel_directory_refresher, daemon=True).start()
+
+if IS_MAIN_PROCESS and BACKGROUND_TASKS:
+    start_background_tasks()
 
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
+    if CLI_COMMAND == "migrate":
+        migrate_jsonbin_to_sqlite()
+    elif CLI_COMMAND:
+        print(f"未知命令: {CLI_COMMAND}（可用: migrate）")
+    else:
+        port = int(os.environ.get("PORT", 8080))
+        app.run(host="0.0.0.0", port=port)